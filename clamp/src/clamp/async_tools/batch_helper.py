@@ -18,16 +18,64 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import abc
+import asyncio
+import collections
 import dataclasses
+import math
+import time
 from abc import ABC
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Callable, Dict, Generic, List, Tuple, TypeVar, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Counter,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from clamp.async_tools.limits import TimeoutBarrier
 from clamp.util.unit import UNIT, Unit
 
 I = TypeVar("I")
 O = TypeVar("O")
+T = TypeVar("T")
+
+# In a task started by `start_batched`, resolved by `mark_submitted`.
+_submitted: "ContextVar[Optional[asyncio.Future[None]]]" = ContextVar(
+    "_submitted", default=None
+)
+
+
+def mark_submitted() -> None:
+    """Tells `start_batched` that the current task has handed off its input, e.g.
+    added it to a batch, so that the caller can do other work in the meantime."""
+    submitted = _submitted.get()
+    if submitted is not None and not submitted.done():
+        submitted.set_result(None)
+
+
+async def start_batched(awaitable: Awaitable[T]) -> "asyncio.Future[T]":
+    """Starts `awaitable` in a task, and returns the task once it has called
+    `mark_submitted` or finished.
+
+    This lets the caller overlap other work with a batched call: once the input
+    is in a batch, the batch can run without the caller, e.g. on an executor,
+    and the inputs of other tasks can still join it."""
+    submitted: "asyncio.Future[None]" = asyncio.get_event_loop().create_future()
+    # The task copies the context, so only it and the tasks it starts see `submitted`.
+    token = _submitted.set(submitted)
+    try:
+        task = asyncio.ensure_future(awaitable)
+    finally:
+        _submitted.reset(token)
+    await asyncio.wait([submitted, task], return_when=asyncio.FIRST_COMPLETED)
+    return task
 
 
 class BatchMaker(Generic[I, O], ABC):
@@ -52,6 +100,83 @@ class BatchMaker(Generic[I, O], ABC):
         """Batched operation on inputs."""
 
 
+@dataclass
+class AdaptiveBatchingPolicy:
+    """Adjusts the batch size and the time to wait for a batch to fill up.
+
+    Like AdaptiveLimiter, the batch size limit increases additively while full
+    batches finish within `latency_target`, and decreases multiplicatively when
+    any batch takes longer. The wait window grows when inputs for the same
+    batch arrive right after a batch was released because the wait ran out,
+    and shrinks when waiting didn't gather any other inputs.
+
+    The limits of each BatchMaker remain upper bounds."""
+
+    # Seconds that one batched call should take.
+    latency_target: float
+    max_batch_size: int = 64
+    min_wait: float = 0.0001
+    max_wait: float = 0.01
+
+    batch_size: float = 1
+    wait: float = 0.001
+
+    def update(
+        self, batch_size: int, timed_out: bool, latency: float, queue_depth: int
+    ) -> None:
+        """Updates the limits after a batch of `batch_size` inputs took `latency` seconds.
+
+        `timed_out` is whether the batch was released by the wait window running out.
+        `queue_depth` is how many inputs for the same BatchMaker arrived while it was running."""
+        if latency > self.latency_target:
+            self.batch_size = max(1.0, self.batch_size * 0.9)
+            self.wait = max(self.min_wait, self.wait * 0.5)
+            return
+
+        if not timed_out:
+            self.batch_size = min(float(self.max_batch_size), self.batch_size + 1)
+        elif queue_depth > 0:
+            self.wait = min(self.max_wait, self.wait * 1.5)
+        elif batch_size == 1:
+            self.wait = max(self.min_wait, self.wait * 0.75)
+
+
+def _log2_bucket(value: float) -> float:
+    """Rounds `value` up to a power of 2, for histograms."""
+    if value <= 0:
+        return 0.0
+    return 2.0 ** math.ceil(math.log2(value))
+
+
+@dataclass
+class BatchingStats:
+    """Histograms of the batches run by a BatchingHelper."""
+
+    batch_sizes: Counter[int] = dataclasses.field(default_factory=collections.Counter)
+    # Seconds from the first input arriving to the batch starting, rounded up to a power of 2.
+    waits: Counter[float] = dataclasses.field(default_factory=collections.Counter)
+    # Seconds taken by `BatchMaker.execute`, rounded up to a power of 2.
+    latencies: Counter[float] = dataclasses.field(default_factory=collections.Counter)
+
+    def record(self, batch_size: int, wait: float, latency: float) -> None:
+        self.batch_sizes[batch_size] += 1
+        self.waits[_log2_bucket(wait)] += 1
+        self.latencies[_log2_bucket(latency)] += 1
+
+    @property
+    def num_batches(self) -> int:
+        return sum(self.batch_sizes.values())
+
+    @property
+    def mean_batch_size(self) -> float:
+        if not self.batch_sizes:
+            return 0.0
+        return (
+            sum(size * count for size, count in self.batch_sizes.items())
+            / self.num_batches
+        )
+
+
 @dataclass
 class PendingContainer(Generic[I, O]):
     """Used inside BatchingHelper."""
@@ -62,28 +187,57 @@ class PendingContainer(Generic[I, O]):
     inputs: List[I] = dataclasses.field(default_factory=list)
     barrier: TimeoutBarrier = dataclasses.field(init=False)
     result: Union[O, Unit] = UNIT
+    # Number of callers of `enqueue_and_wait` which have not yet taken `result`.
+    num_unread: int = 0
+    done: bool = False
+    created_at: float = dataclasses.field(default_factory=time.perf_counter)
 
     def __post_init__(self):
-        self.barrier = TimeoutBarrier(
-            self.batch_key.max_batch_size, self.batch_key.timeout, self._execute
-        )
+        max_batch_size, timeout = self.batching_helper.limits(self.batch_key)
+        self.barrier = TimeoutBarrier(max_batch_size, timeout, self._execute)
 
     async def enqueue_and_wait(self, inp: I) -> Tuple[O, int]:
         i = len(self.inputs)
         self.inputs.append(inp)
-        await self.barrier.arrive_and_wait()
-        assert not isinstance(self.result, Unit)
-        return self.result, i
+        self.num_unread += 1
+        mark_submitted()
+        try:
+            await self.barrier.arrive_and_wait()
+            assert not isinstance(self.result, Unit)
+            return self.result, i
+        finally:
+            self.num_unread -= 1
+            if self.num_unread == 0:
+                self._release_references()
+
+    def _release_references(self) -> None:
+        """Drops the inputs and outputs once every caller has its result.
+
+        `barrier.callback` refers back to this object, so without this the
+        inputs and outputs (which may hold large hidden states) would stay
+        alive until the cycle is garbage collected."""
+        self.done = True
+        self.inputs = []
+        self.result = UNIT
+        self.barrier.callback = lambda: None
 
     @property
     def closed(self) -> bool:
-        return bool(self.barrier.currently_releasing or self.result is not UNIT)
+        return bool(
+            self.done or self.barrier.currently_releasing or self.result is not UNIT
+        )
 
     async def _execute(self) -> None:
+        start = time.perf_counter()
         self.result = await self.batch_key.execute(self.inputs)
         self.batching_helper._del_pending_container(  # pylint: disable=protected-access
             self
         )
+        self.batching_helper.record_batch(
+            self,
+            wait=start - self.created_at,
+            latency=time.perf_counter() - start,
+        )
 
 
 @dataclass
@@ -98,6 +252,10 @@ class BatchingHelper(Generic[I, O]):
         default_factory=dict
     )
 
+    # If set, adapts the batch size and wait time within the limits of each BatchMaker.
+    policy: Optional[AdaptiveBatchingPolicy] = None
+    stats: BatchingStats = dataclasses.field(default_factory=BatchingStats)
+
     async def execute(self, inp: I) -> Tuple[O, int]:
         """Given an input of type I, this class uses `batch_key_fn` to create a BatchKey.
         Inputs with the same BatchKey are coalesced together.
@@ -116,6 +274,30 @@ class BatchingHelper(Generic[I, O]):
 
         return await pending_container.enqueue_and_wait(inp)
 
+    def limits(self, batch_maker: BatchMaker[I, O]) -> Tuple[int, float]:
+        """Returns the maximum batch size and the time to wait for a new batch."""
+        if self.policy is None:
+            return batch_maker.max_batch_size, batch_maker.timeout
+        return (
+            max(1, min(batch_maker.max_batch_size, int(self.policy.batch_size))),
+            self.policy.wait,
+        )
+
+    def record_batch(
+        self, container: PendingContainer[I, O], wait: float, latency: float
+    ) -> None:
+        batch_size = len(container.inputs)
+        self.stats.record(batch_size, wait, latency)
+        if self.policy is not None:
+            # Inputs which arrived for the same BatchMaker while this batch was running.
+            next_container = self.pending.get(container.batch_key)
+            self.policy.update(
+                batch_size,
+                timed_out=batch_size < container.barrier.parties,
+                latency=latency,
+                queue_depth=len(next_container.inputs) if next_container else 0,
+            )
+
     def _del_pending_container(self, container: PendingContainer[I, O]):
         """When a PendingContainer is done executing, immediately remove it from `self.pending`"""
         if self.pending.get(container.batch_key) is container:
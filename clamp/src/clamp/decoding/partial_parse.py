@@ -43,3 +43,8 @@ class PartialParse(ABC):
     @abstractmethod
     def append(self, token: int) -> "PartialParse":
         """Return a new PartialParse created by appending this token."""
+
+    def prefetch(self) -> None:
+        """Optionally precomputes some of the work for `allowed_next`.
+
+        Called while the model computes the distribution over the next token."""
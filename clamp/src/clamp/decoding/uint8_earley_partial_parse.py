@@ -37,6 +37,7 @@ from typing import (
     Dict,
     Iterable,
     Iterator,
+    List,
     Optional,
     Sequence,
     Set,
@@ -49,10 +50,11 @@ import torch
 from cached_property import cached_property
 
 from clamp.decoding.partial_parse import PartialParse
-from clamp.earley.earley import EarleyChart
+from clamp.earley.earley import EarleyChart, EarleyStats
 from clamp.earley.grammar import Grammar
 from clamp.earley.input import Position, SigmaStarTriePosition
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.tokenization.token_table import VocabTrieNode
 
 T = TypeVar("T")
 
@@ -105,11 +107,21 @@ class UInt8GrammarTokenizerInfo:
     tokens: Sequence[Sequence[np.uint8]]
     # Used for special tokens like `<|endoftext|>` which we should never allow.
     banned_token_ids: Set[int]
+    # Trie of `tokens`, e.g. the one cached in the tokenizer's TokenTable.
+    # Built from `tokens` if not given.
+    shared_vocab_trie: Optional[VocabTrieNode] = None
 
     @cached_property
     def vocab_size(self) -> int:
         return len(self.tokens)
 
+    @cached_property
+    def vocab_trie(self) -> VocabTrieNode:
+        """Trie of all tokens, including `banned_token_ids`."""
+        if self.shared_vocab_trie is not None:
+            return self.shared_vocab_trie
+        return VocabTrieNode.build(self.tokens)
+
     @staticmethod
     def from_clamp_tokenizer(
         grammar: Grammar[np.uint8, Any], tokenizer: ClampTokenizer
@@ -118,17 +130,20 @@ class UInt8GrammarTokenizerInfo:
             encoded_tokens,
             banned_token_ids,
         ) = UInt8GrammarTokenizerInfo.prepare_tokens_from_clamp_tokenizer(tokenizer)
-        return UInt8GrammarTokenizerInfo(grammar, encoded_tokens, banned_token_ids)
+        return UInt8GrammarTokenizerInfo(
+            grammar,
+            encoded_tokens,
+            banned_token_ids,
+            shared_vocab_trie=tokenizer.token_table.vocab_trie,
+        )
 
     @staticmethod
     def prepare_tokens_from_clamp_tokenizer(
         tokenizer: ClampTokenizer,
     ) -> Tuple[Sequence[Sequence[np.uint8]], Set[int]]:
         return (
-            [
-                np.frombuffer(tokenizer.id_to_utf8_token_map[i], dtype=np.uint8)
-                for i in range(len(tokenizer.id_to_utf8_token_map))
-            ],
+            # Views of the tokenizer's table, so every grammar shares the same bytes.
+            tokenizer.token_table.token_arrays,
             {tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id},
         )
 
@@ -148,7 +163,12 @@ class UInt8EarleyPartialParse(PartialParse):
         # TODO: Use optimizations already in EarleyPartialParse, and others identified but not implemented:
         # - Only check the first N tokens from ordered_ids with `token_id_is_valid`;
         #   for the rest, intersect grammar_node with the vocab trie
-        assert ordered_ids is not None
+        can_end = self.grammar_node.chart.was_found(
+            self.grammar_node.chart.grammar.root, self.start_pos, self.grammar_node.pos
+        )
+        if ordered_ids is None:
+            return self._all_allowed_next(), can_end
+
         ordered_ids_list = ordered_ids.tolist()
         all_tokens = self.info.tokens
         vocab_size = self.info.vocab_size
@@ -169,12 +189,36 @@ class UInt8EarleyPartialParse(PartialParse):
         # TODO: Add special case where grammar_node.children has no elements
         # (i.e. tokens_list will be empty)
         tokens_list = list(itertools.islice(produce_valid_tokens(), top_k))
-        can_end = self.grammar_node.chart.was_found(
-            self.grammar_node.chart.grammar.root, self.start_pos, self.grammar_node.pos
-        )
         # pylint: disable=not-callable
         return torch.tensor(tokens_list, dtype=torch.long), can_end
 
+    def _all_allowed_next(self) -> torch.Tensor:
+        """Finds every allowed token by walking the grammar and the vocab trie together.
+
+        This only visits prefixes of tokens which the grammar allows, rather than
+        checking each token in the vocabulary."""
+        banned_token_ids = self.info.banned_token_ids
+        tokens_list: List[int] = []
+        stack = [(self.grammar_node, self.info.vocab_trie)]
+        while stack:
+            node, trie_node = stack.pop()
+            for i in trie_node.token_ids:
+                if i not in banned_token_ids:
+                    self._next_node_cache[i] = node
+                    tokens_list.append(i)
+            for byte, trie_child in trie_node.children.items():
+                child = node.children.get(byte)
+                if child is not None:
+                    stack.append((child, trie_child))
+        tokens_list.sort()
+        # pylint: disable=not-callable
+        return torch.tensor(tokens_list, dtype=torch.long)
+
+    def prefetch(self) -> None:
+        # Advancing the chart past the nonterminals at this position is most of the
+        # work of checking the first byte of each token.
+        _ = self.grammar_node.children
+
     def append(self, token: int) -> "UInt8EarleyPartialParse":
         """Return a new PartialParse created by appending this token."""
         if token in self._next_node_cache:
@@ -190,8 +234,11 @@ class UInt8EarleyPartialParse(PartialParse):
         return UInt8EarleyPartialParse(node_for_result, self.info, self.start_pos)
 
     @staticmethod
-    def initial(info: UInt8GrammarTokenizerInfo) -> "UInt8EarleyPartialParse":
-        chart = EarleyChart(info.grammar, use_backpointers=False)
+    def initial(
+        info: UInt8GrammarTokenizerInfo, earley_stats: Optional[EarleyStats] = None
+    ) -> "UInt8EarleyPartialParse":
+        """If `earley_stats` is given, it counts the work done in the chart."""
+        chart = EarleyChart(info.grammar, use_backpointers=False, stats=earley_stats)
         start_pos = SigmaStarTriePosition[np.uint8]()
         chart.seek(info.grammar.root, start_pos)
         grammar_node = UInt8GrammarNode(chart, lambda: start_pos)
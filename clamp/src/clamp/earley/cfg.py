@@ -21,6 +21,7 @@
 import ast
 import collections
 import functools
+import hashlib
 import itertools
 import os
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union, cast
@@ -170,6 +171,11 @@ def parse_re_char_set(s: str) -> SpanSet:
 def load_grammar_from_directory(
     path: str, start_nt: Optional[str] = None
 ) -> DFAGrammar:
+    return load_grammar_from_fragments(read_grammar_fragments(path), start_nt)
+
+
+def read_grammar_fragments(path: str) -> List[str]:
+    """Reads the *.cfg files in `path` and its subdirectories."""
     # TODO: Merge this blobfile.glob snippet with the one in read_grammar.py
     paths = set(
         itertools.chain(
@@ -185,8 +191,15 @@ def load_grammar_from_directory(
         # pylint: disable=not-context-manager
         with BlobFile(grammar_path, streaming=False) as bf:
             fragments.append(bf.read())
+    return fragments
+
 
-    return load_grammar_from_fragments(fragments, start_nt)
+def grammar_digest(fragments: Iterable[str]) -> str:
+    """Identifies the grammar made of `fragments`, regardless of their order."""
+    digest = hashlib.sha1()
+    for fragment in sorted(fragments):
+        digest.update(hashlib.sha1(fragment.encode("utf-8")).digest())
+    return digest.hexdigest()
 
 
 def load_grammar_from_traversable(
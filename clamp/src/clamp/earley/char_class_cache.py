@@ -0,0 +1,143 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Caches the UTF-8 byte ranges that character classes compile to.
+
+`fsa_builders.re_ranges_span_set` turns a set of code point spans into sequences
+of byte ranges with `Utf8Sequences`, once for every occurrence of a character
+class in every grammar. Large classes like Unicode categories take thousands of
+steps, but the result only depends on the spans, so it is cached:
+- in memory, for the lifetime of the process;
+- in unicode_category_byte_ranges.json, which ships with the package and covers
+  every general category in unicode_categories.json;
+- optionally in a directory on disk, shared between processes and runs, for
+  all other character classes.
+
+Run this module to regenerate unicode_category_byte_ranges.json.
+"""
+import functools
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import importlib_resources
+
+from clamp.earley.unicode_categories_spans import category_to_span_set, raw_data
+from clamp.earley.utf8_ranges import Utf8Sequences
+from clamp.util.span import Span, SpanSet
+
+# The half-open (begin, end) code point intervals of a normalized SpanSet.
+SpanSetKey = Tuple[Tuple[int, int], ...]
+# Alternative sequences of inclusive (start, end) byte ranges, in matching order.
+ByteRangeSequences = Tuple[Tuple[Tuple[int, int], ...], ...]
+
+CATEGORY_TABLE_FILE = "unicode_category_byte_ranges.json"
+# Used as the default for `set_disk_cache_dir`.
+DISK_CACHE_DIR_ENV_VAR = "CLAMP_CHAR_CLASS_CACHE_DIR"
+# Change this if the format of the cached files changes.
+_DISK_CACHE_VERSION = 1
+
+_disk_cache_dir: Optional[Path] = (
+    Path(os.environ[DISK_CACHE_DIR_ENV_VAR])
+    if os.environ.get(DISK_CACHE_DIR_ENV_VAR)
+    else None
+)
+
+
+def set_disk_cache_dir(directory: Optional[Path]) -> None:
+    """Sets the directory where byte ranges are cached across processes, or None to disable it."""
+    global _disk_cache_dir  # pylint: disable=global-statement
+    _disk_cache_dir = directory
+
+
+def span_set_key(span_set: SpanSet) -> SpanSetKey:
+    # SpanSet keeps its spans sorted and coalesced, so equal sets have equal keys.
+    return tuple(span.astuple() for span in span_set.spans)
+
+
+def utf8_byte_ranges(span_set: SpanSet) -> ByteRangeSequences:
+    """Returns sequences of byte ranges which together match exactly the UTF-8
+    encodings of the code points in `span_set`."""
+    return _byte_ranges_for_key(span_set_key(span_set))
+
+
+def compute_utf8_byte_ranges(key: SpanSetKey) -> ByteRangeSequences:
+    return tuple(
+        tuple((int(range_.start), int(range_.end)) for range_ in seq.ranges)
+        for begin, end in key
+        for seq in Utf8Sequences.from_span(Span(begin, end))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _byte_ranges_for_key(key: SpanSetKey) -> ByteRangeSequences:
+    category = _category_keys().get(key)
+    if category is not None:
+        return _from_json(_category_table()[category])
+    if _disk_cache_dir is None:
+        return compute_utf8_byte_ranges(key)
+
+    digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+    path = _disk_cache_dir / f"v{_DISK_CACHE_VERSION}_{digest}.json"
+    if path.exists():
+        with open(path) as f:
+            return _from_json(json.load(f))
+
+    result = compute_utf8_byte_ranges(key)
+    _disk_cache_dir.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, so that readers never see a partial file.
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(result, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _category_keys() -> Dict[SpanSetKey, str]:
+    return {span_set_key(category_to_span_set(name)): name for name in raw_data()}
+
+
+@functools.lru_cache(maxsize=None)
+def _category_table() -> Dict[str, List[List[List[int]]]]:
+    with importlib_resources.files(__package__).joinpath(
+        CATEGORY_TABLE_FILE
+    ).open() as f:
+        return json.load(f)
+
+
+def _from_json(seqs: List[List[List[int]]]) -> ByteRangeSequences:
+    return tuple(tuple((start, end) for start, end in seq) for seq in seqs)
+
+
+def write_category_table(path: Path) -> None:
+    table = {
+        name: compute_utf8_byte_ranges(span_set_key(category_to_span_set(name)))
+        for name in raw_data()
+    }
+    with open(path, "w") as f:
+        json.dump(table, f, separators=(",", ":"))
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    write_category_table(Path(__file__).parent / CATEGORY_TABLE_FILE)
@@ -40,7 +40,7 @@ from typing import (
 from lark import Token, Tree
 
 from clamp.earley.agenda import Attach, Bp, Column, Item, Meta, MetaOps, Predict, Scan
-from clamp.earley.grammar import DottedRule, Grammar, Nonterm, RuleResult
+from clamp.earley.grammar import DFAGrammar, DottedRule, Grammar, Nonterm, RuleResult
 from clamp.earley.input import Position, Terminal
 from clamp.util.keydefaultdict import KeyDefaultDict
 
@@ -182,6 +182,41 @@ class Fail(PackedForest, Generic[Terminal]):
     pass
 
 
+# The operations of Earley's algorithm, as counted by EarleyStats.
+PREDICTED = "predicted"
+SCANNED = "scanned"
+ATTACHED = "attached"
+
+
+@dataclass
+class EarleyStats:
+    """Counts the items that each operation of an EarleyChart pushes onto a column,
+    including the ones that were already there.
+
+    Subclasses like EarleyProfile can override `add` to record more detail."""
+
+    predicted: int = 0
+    scanned: int = 0
+    attached: int = 0
+
+    def add(
+        self,
+        operation: str,
+        item: Item[Any, Any],
+        col: Column[Any, Any],
+        added: bool,
+    ) -> None:
+        """Records that `operation` pushed `item` onto `col`, where `added` is
+        whether the item was new to the column."""
+        del item, col, added
+        if operation == PREDICTED:
+            self.predicted += 1
+        elif operation == SCANNED:
+            self.scanned += 1
+        else:
+            self.attached += 1
+
+
 class EarleyChart(Generic[Terminal, RuleResult]):
     """A chart for Earley's algorithm.  Allows fine-grained external control,
     or it can be subclassed to add a control mechanism like exhaustive search
@@ -191,10 +226,16 @@ class EarleyChart(Generic[Terminal, RuleResult]):
     cols: KeyDefaultDict[Position[Terminal], Column[Terminal, RuleResult]]
 
     def __init__(
-        self, grammar: Grammar[Terminal, RuleResult], use_backpointers: bool
+        self,
+        grammar: Grammar[Terminal, RuleResult],
+        use_backpointers: bool,
+        stats: Optional[EarleyStats] = None,
     ) -> None:
         self.grammar = grammar
         self.use_backpointers = use_backpointers
+        # If set, counts the work done in this chart. Without it, the only
+        # overhead is checking whether it's set.
+        self.stats = stats
         self.cols = KeyDefaultDict(
             partial(Column[Terminal, RuleResult], use_backpointers=use_backpointers)
         )
@@ -373,27 +414,53 @@ class EarleyChart(Generic[Terminal, RuleResult]):
                         if self.use_backpointers
                         else None
                     )
-                    future_col.push(new_item, meta)
+                    added = future_col.push(new_item, meta)
+                    if self.stats is not None:
+                        self.stats.add(ATTACHED, new_item, future_col, added)
                     # logging.debug("\tAttached to get: %s in %s", new_item, future_col)
 
         # now do a traditional predict operation
         if nonterm not in col.predicted:
-            # don't add all the same rules to this col if we already did
-            col.predicted.add(nonterm)  # remember not to do it again
-            for rule in self.grammar.get_expansions(nonterm):
-                new_item = Item(rule, col)
-                meta = (
-                    MetaOps.pure(Predict(new_item=new_item))
-                    if self.use_backpointers
-                    else None
-                )
-                col.push(item=new_item, meta=meta)
-                # logging.debug("\tPredicted: %s in %s", new_item, col)
+            if isinstance(self.grammar, DFAGrammar):
+                self._predict_closure(nonterm, col)
+            else:
+                # don't add all the same rules to this col if we already did
+                col.predicted.add(nonterm)  # remember not to do it again
+                for rule in self.grammar.get_expansions(nonterm):
+                    self._push_predicted(rule, col)
 
         # customer is now waiting for anything that comes back from the prediction
         if customer is not None:
             col.customers[nonterm].append(customer)
 
+    def _predict_closure(
+        self, nonterm: Nonterm, col: Column[Terminal, RuleResult]
+    ) -> None:
+        """Predicts `nonterm` and everything that predicting it would lead to, at once.
+
+        Popping the new items still predicts their next nonterminals, to register
+        the items as customers, but the rules have already been added."""
+        for rule in self.grammar.prediction_closure(nonterm):  # type: ignore
+            # The closure of an already predicted nonterminal was already added.
+            if rule.lhs not in col.predicted:
+                col.predicted.add(rule.lhs)
+                self._push_predicted(rule, col)
+        col.predicted.add(nonterm)
+
+    def _push_predicted(
+        self,
+        rule: DottedRule[Terminal, RuleResult],
+        col: Column[Terminal, RuleResult],
+    ) -> None:
+        new_item = Item(rule, col)
+        meta = (
+            MetaOps.pure(Predict(new_item=new_item)) if self.use_backpointers else None
+        )
+        added = col.push(item=new_item, meta=meta)
+        if self.stats is not None:
+            self.stats.add(PREDICTED, new_item, col, added)
+        # logging.debug("\tPredicted: %s in %s", new_item, col)
+
     def _scan(
         self,
         item: Item[Terminal, RuleResult],
@@ -413,7 +480,9 @@ class EarleyChart(Generic[Terminal, RuleResult]):
                     if self.use_backpointers
                     else None
                 )
-                future_col.push(item=new_item, meta=meta)
+                added = future_col.push(item=new_item, meta=meta)
+                if self.stats is not None:
+                    self.stats.add(SCANNED, new_item, future_col, added)
                 # logging.debug("\tScanned to get: %s in %s", new_item, future_col)
             yield future_pos
 
@@ -442,7 +511,9 @@ class EarleyChart(Generic[Terminal, RuleResult]):
                     if self.use_backpointers
                     else None
                 )
-                col.push(new_item, meta=meta)
+                added = col.push(new_item, meta=meta)
+                if self.stats is not None:
+                    self.stats.add(ATTACHED, new_item, col, added)
                 # logging.debug("\tAttached to get: %s in %s", new_item, col)
         # past_col must remember that this item came looking
         past_col.servers[lhs].append((server, col, rule_result))
@@ -0,0 +1,130 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Breaks down the work of an EarleyChart by column and by nonterminal.
+
+Pass an EarleyProfile as the `stats` of a chart, parse, and then look at its
+`report()` to find the columns and nonterminals where the parser spends its
+work. `folded()` aggregates the same counts as folded stacks, the input format
+of flamegraph.pl (https://github.com/brendangregg/FlameGraph) and speedscope,
+with one root frame per grammar so that the profiles of several grammars can
+be combined."""
+import collections
+import dataclasses
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Counter, Dict, List, Tuple
+
+from clamp.earley.agenda import Column, Item
+from clamp.earley.earley import ATTACHED, PREDICTED, SCANNED, EarleyStats
+
+
+@dataclass
+class ColumnWork:
+    # Items pushed onto the column, including ones that were already there.
+    pushed: int = 0
+    # Distinct items in the column.
+    items: int = 0
+    # The most items that were waiting in the column's agenda at once.
+    max_agenda: int = 0
+
+
+@dataclass
+class EarleyProfile(EarleyStats):
+    """EarleyStats which also counts the pushed items by column and by the
+    nonterminal on the left of their rule.
+
+    In a DFAGrammar, all the rules of a nonterminal are compiled into one DFA,
+    so the work of a nonterminal is the work of its rules."""
+
+    # Columns whose positions have the same length (in bytes, for
+    # SigmaStarTriePosition) are combined.
+    columns: Dict[int, ColumnWork] = dataclasses.field(default_factory=dict)
+    by_nonterm: Counter[Tuple[str, str]] = dataclasses.field(
+        default_factory=collections.Counter
+    )
+
+    def add(
+        self,
+        operation: str,
+        item: Item[Any, Any],
+        col: Column[Any, Any],
+        added: bool,
+    ) -> None:
+        super().add(operation, item, col, added)
+        column = self.columns.get(len(col.pos))
+        if column is None:
+            column = self.columns[len(col.pos)] = ColumnWork()
+        column.pushed += 1
+        if added:
+            column.items += 1
+            column.max_agenda = max(column.max_agenda, len(col))
+        self.by_nonterm[item.dotted_rule.lhs.name, operation] += 1
+
+    def hottest_nonterms(self, n: int) -> List[Tuple[str, int]]:
+        """Returns the `n` nonterminals with the most pushed items, and their counts."""
+        totals: Counter[str] = collections.Counter()
+        for (nonterm, _), count in self.by_nonterm.items():
+            totals[nonterm] += count
+        return totals.most_common(n)
+
+    def report(self, top: int = 20) -> str:
+        columns = list(self.columns.values())
+        lines = [
+            f"Pushed items: {self.predicted} predicted, {self.scanned} scanned, "
+            f"{self.attached} attached",
+            f"Columns: {len(columns)}, {sum(c.items for c in columns)} distinct items, "
+            f"largest agenda {max((c.max_agenda for c in columns), default=0)}",
+            "",
+            f"Hottest nonterminals (of {len({nt for nt, _ in self.by_nonterm})}):",
+            f"{'pushed':>10} {PREDICTED:>10} {SCANNED:>10} {ATTACHED:>10}  nonterminal",
+        ]
+        for nonterm, total in self.hottest_nonterms(top):
+            counts = [
+                self.by_nonterm[nonterm, op] for op in (PREDICTED, SCANNED, ATTACHED)
+            ]
+            lines.append(
+                f"{total:>10} {counts[0]:>10} {counts[1]:>10} {counts[2]:>10}  {nonterm}"
+            )
+        lines += [
+            "",
+            f"Busiest columns (of {len(columns)}):",
+            f"{'pushed':>10} {'items':>10} {'max agenda':>10}  position length",
+        ]
+        busiest = sorted(
+            self.columns.items(), key=lambda kv: kv[1].pushed, reverse=True
+        )[:top]
+        for length, column in busiest:
+            lines.append(
+                f"{column.pushed:>10} {column.items:>10} {column.max_agenda:>10}  {length}"
+            )
+        return "\n".join(lines)
+
+    def folded(self, root: str) -> List[str]:
+        """Returns lines of the form "root;nonterminal;operation count"."""
+        return [
+            f"{root};{nonterm};{operation} {count}"
+            for (nonterm, operation), count in sorted(self.by_nonterm.items())
+        ]
+
+    def dump(self, directory: Path, name: str) -> None:
+        """Writes `report()` to directory/name.txt and `folded(name)` to directory/name.folded."""
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"{name}.txt").write_text(self.report() + "\n")
+        (directory / f"{name}.folded").write_text("\n".join(self.folded(name)) + "\n")
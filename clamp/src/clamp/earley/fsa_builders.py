@@ -37,6 +37,7 @@ from typing import Callable, Iterable, List, Optional, Sequence, Tuple, Union
 import more_itertools
 import numpy as np
 
+from clamp.earley.char_class_cache import utf8_byte_ranges
 from clamp.earley.fsa import (
     Alternation,
     CompiledDFA,
@@ -49,7 +50,6 @@ from clamp.earley.fsa import (
     Sink,
     UInt8Ranges,
 )
-from clamp.earley.utf8_ranges import Utf8Sequences
 from clamp.util.span import Span, SpanSet
 from clamp.util.util import identity
 
@@ -215,17 +215,19 @@ def re_ranges_span_set(included_span_set: SpanSet) -> NFAFrag[I]:
         included_span_set.spans[-1].end <= 0x110000
     )  # Maximum Unicode character is 10FFFF
 
+    # Cached, since the same character classes appear in many grammars.
+    byte_range_seqs = utf8_byte_ranges(included_span_set)
+
     def fragment(out: NFAState[I]) -> NFAState[I]:
         heads: List[UInt8Ranges] = []
-        for span in included_span_set.spans:
-            for seq in Utf8Sequences.from_span(span):
-                last = out
-                for range_ in seq.reverse().ranges:
-                    bounds = (int(range_.start), int(range_.end + 1))
-                    values = (None, last, None)
-                    last = UInt8Ranges(is_final=False, bounds=bounds, values=values)
-                assert isinstance(last, UInt8Ranges)
-                heads.append(last)
+        for seq in byte_range_seqs:
+            last = out
+            for start, end in reversed(seq):
+                bounds = (start, end + 1)
+                values = (None, last, None)
+                last = UInt8Ranges(is_final=False, bounds=bounds, values=values)
+            assert isinstance(last, UInt8Ranges)
+            heads.append(last)
 
         if len(heads) == 1:
             return heads[0]
@@ -17,6 +17,7 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import dataclasses
 import itertools
 
 # see https://github.com/pytorch/pytorch/issues/47027
@@ -24,12 +25,15 @@ from collections import abc as abc  # pylint: disable=C0414
 from collections.abc import Sized
 from dataclasses import dataclass
 from typing import (
+    AbstractSet,
     Any,
     ClassVar,
     Dict,
+    FrozenSet,
     Generic,
     Hashable,
     Iterable,
+    List,
     Optional,
     Set,
     Tuple,
@@ -38,6 +42,7 @@ from typing import (
 )
 
 import numpy as np
+from cached_property import cached_property
 from typing_extensions import Protocol
 
 from clamp.earley.fsa import CompiledDFA
@@ -357,9 +362,79 @@ class DFAGrammar:
 
     root: Nonterm
     expansions: Dict[Nonterm, DFADottedRule]
+    # Memoizes `prediction_closure`.
+    _closures: Dict[Nonterm, Tuple[DFADottedRule, ...]] = dataclasses.field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
 
     def get_expansions(self, nonterm: Nonterm) -> Iterable[DottedRule[np.uint8, Any]]:
         if nonterm in self.expansions:
             return (self.expansions[nonterm],)
         else:
             return ()
+
+    @cached_property
+    def nullable_nonterms(self) -> FrozenSet[Nonterm]:
+        """The nonterminals which can expand to the empty string."""
+        nullable: Set[Nonterm] = set()
+        changed = True
+        while changed:
+            changed = False
+            for nonterm, rule in self.expansions.items():
+                if nonterm not in nullable and any(
+                    rule.dfa.is_final_dfa(state_id)
+                    for state_id in self._states_after_nullable(rule, nullable)
+                ):
+                    nullable.add(nonterm)
+                    changed = True
+        return frozenset(nullable)
+
+    def prediction_closure(self, nonterm: Nonterm) -> Tuple[DFADottedRule, ...]:
+        """The initial rules of every nonterminal which predicting `nonterm` leads
+        to predicting, starting with `nonterm`'s own rule.
+
+        Besides the nonterminals that a rule can start with, this includes those
+        that can follow a prefix of nullable nonterminals, as in Aycock and
+        Horspool (2002), "Practical Earley Parsing"."""
+        closure = self._closures.get(nonterm)
+        if closure is None:
+            closure = self._closures[nonterm] = self._compute_prediction_closure(
+                nonterm
+            )
+        return closure
+
+    def _compute_prediction_closure(
+        self, nonterm: Nonterm
+    ) -> Tuple[DFADottedRule, ...]:
+        nullable = self.nullable_nonterms
+        # In the order that Earley's algorithm would predict them.
+        queue = [nonterm]
+        seen = {nonterm}
+        rules: List[DFADottedRule] = []
+        for current in queue:
+            rule = self.expansions.get(current)
+            if rule is None:
+                continue
+            rules.append(rule)
+            for state_id in self._states_after_nullable(rule, nullable):
+                for label in rule.dfa.next_labels(state_id):
+                    if isinstance(label, Nonterm) and label not in seen:
+                        seen.add(label)
+                        queue.append(label)
+        return tuple(rules)
+
+    @staticmethod
+    def _states_after_nullable(
+        rule: DFADottedRule, nullable: AbstractSet[Nonterm]
+    ) -> List[int]:
+        """The states of `rule.dfa` reachable from `rule.state_id` through `nullable` alone."""
+        states = [rule.state_id]
+        seen = {rule.state_id}
+        for state_id in states:
+            for label in rule.dfa.next_labels(state_id):
+                if label in nullable:
+                    next_state_id = rule.dfa.transition_dfa(state_id, label)
+                    if next_state_id is not None and next_state_id not in seen:
+                        seen.add(next_state_id)
+                        states.append(next_state_id)
+        return states
@@ -18,11 +18,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import asyncio
-import gc
 import itertools
-from typing import Dict, List, Optional, Set, Tuple
-
-import torch
+import time
+from dataclasses import dataclass
+from typing import AsyncGenerator, Dict, Generic, List, Optional, Set, Tuple
 
 from clamp.search.beam_search_event_listener import (
     BeamSearchEventListener,
@@ -30,82 +29,217 @@ from clamp.search.beam_search_event_listener import (
     HashableNodeWrapper,
 )
 from clamp.search.problem import Problem, PSNSub, SearchNode
+from clamp.seq2seq.hidden_state_tracker import HiddenStateStats
 from clamp.seq2seq.seq2seq_model import HS
 
 MAX_STEPS = 1000
 
 
-async def beam_search(
+@dataclass
+class BeamSearchStepStats:
+    """Counts and timings for a single step of beam search."""
+
+    # Number of nodes which were expanded in this step.
+    num_expanded: int
+    # Number of distinct expansions produced by those nodes.
+    num_candidates: int
+    # Seconds spent in this step, and since the start of the search.
+    step_elapsed: float
+    total_elapsed: float
+    # Hidden states still alive at the end of the step, if the model reports them.
+    hidden_states: Optional[HiddenStateStats] = None
+
+
+@dataclass
+class BeamSearchStep(Generic[HS]):
+    """The state of beam search after one step, as yielded by `beam_search_stream`."""
+
+    step_index: int
+    # Unfinished nodes which will be expanded in the next step.
+    beam: List[FullSearchNode[HS]]
+    # Finished nodes which are currently competitive with `beam`.
+    finished: List[FullSearchNode[HS]]
+    # Finished nodes which first appeared in `finished` during this step.
+    newly_finished: List[FullSearchNode[HS]]
+    # Finished nodes which fell out of the beam but were kept because of `keep_finished_nodes`.
+    finished_extra: List[FullSearchNode[HS]]
+    stats: BeamSearchStepStats
+
+    @property
+    def best(self) -> Optional[FullSearchNode[HS]]:
+        """The lowest-cost node, finished or not."""
+        return min(
+            itertools.chain(self.beam, self.finished),
+            key=lambda n: n.cost,
+            default=None,
+        )
+
+    @property
+    def stable_prefix(self) -> Tuple[int, ...]:
+        """The longest token prefix shared by every node in `beam`, `finished`,
+        and `finished_extra`.
+
+        Beam search can only return hypotheses which extend this prefix,
+        so consumers can safely start working on it before the search is done.
+        With `keep_finished_nodes`, nodes which finished long ago can still be
+        returned, so the prefix is often shorter."""
+        nodes = list(itertools.chain(self.beam, self.finished, self.finished_extra))
+        if not nodes:
+            return ()
+        prefix = nodes[0].tokens
+        for node in nodes[1:]:
+            tokens = node.tokens
+            length = 0
+            for a, b in zip(prefix, tokens):
+                if a != b:
+                    break
+                length += 1
+            prefix = prefix[:length]
+        return prefix
+
+    def results(self, beam_size: int) -> List[FullSearchNode[HS]]:
+        """The finished nodes that `beam_search` returns if the search stops here."""
+        return sorted(
+            itertools.chain(self.finished, self.finished_extra),
+            key=lambda n: n.cost,
+        )[: beam_size * 2]
+
+
+async def beam_search_stream(
     problem: Problem[HS, PSNSub],
     initial: SearchNode[HS, PSNSub],
     beam_size: int,
     max_steps: Optional[int] = None,
     event_listener: BeamSearchEventListener = BeamSearchEventListener(),
     keep_finished_nodes: bool = False,
-) -> List[FullSearchNode[HS]]:
+) -> AsyncGenerator[BeamSearchStep[HS], None]:
+    """Runs beam search, yielding the state of the search after every step.
+
+    The last yielded step contains the final results; see `BeamSearchStep.results`."""
     max_steps = MAX_STEPS if max_steps is None else max_steps
 
     finished: Set[HashableNodeWrapper[HS]] = set()
     finished_extra: Set[HashableNodeWrapper[HS]] = set()
 
     beam: List[SearchNode[HS, PSNSub]] = [initial]
+    search_start_time = time.perf_counter()
 
     for step_index in range(max_steps):
         if not beam:
             break
+        step_start_time = time.perf_counter()
 
-        async def expand(
-            node: SearchNode[HS, PSNSub]
-        ) -> Tuple[SearchNode[HS, PSNSub], List[FullSearchNode]]:
-            expansions = await problem.expand(node)
-            return node, expansions
-
-        candidates: Set[HashableNodeWrapper[HS]] = set()
-        step_info: Dict[
-            Tuple[int, ...], Tuple[SearchNode[HS, PSNSub], List[FullSearchNode[HS]]]
-        ] = {}
-        for node, per_node_expansion in await asyncio.gather(
-            *(expand(node) for node in beam)
-        ):
-            candidates_for_node: List[FullSearchNode] = []
-            packed_node = node.packed if isinstance(node, FullSearchNode) else node
-            step_info[packed_node.tokens] = (node, candidates_for_node)
-            for new_node in per_node_expansion:
-                candidates_for_node.append(new_node)
-                candidates.add(HashableNodeWrapper(new_node))
+        step_info = await _expand_beam(problem, beam)
         event_listener.step(step_info)
+        num_expanded = len(beam)
 
-        # We allow `candidates` and `finished` to compete with each other,
-        # as the score will no longer decrease monotonically when we have a length penalty.
-        sorted_candidates_plus_finished = sorted(
-            itertools.chain(candidates, finished), key=lambda n: n.underlying.cost
+        previously_finished = set(finished)
+        beam, num_candidates = _select(
+            step_info, finished, finished_extra, beam_size, keep_finished_nodes
+        )
+        # Hidden states are owned by the nodes which refer to them, and freed by
+        # reference counting. This frees the hidden states of pruned candidates now,
+        # rather than once the next step's model calls are done.
+        del step_info
+
+        now = time.perf_counter()
+        yield BeamSearchStep(
+            step_index,
+            beam=[n for n in beam if isinstance(n, FullSearchNode)],
+            finished=sorted((n.underlying for n in finished), key=lambda n: n.cost),
+            newly_finished=sorted(
+                (n.underlying for n in finished - previously_finished),
+                key=lambda n: n.cost,
+            ),
+            finished_extra=[n.underlying for n in finished_extra],
+            stats=BeamSearchStepStats(
+                num_expanded=num_expanded,
+                num_candidates=num_candidates,
+                step_elapsed=now - step_start_time,
+                total_elapsed=now - search_start_time,
+                hidden_states=problem.hidden_state_stats(),
+            ),
         )
-        beam = []
-        finished.clear()
-        for n in sorted_candidates_plus_finished[:beam_size]:
+
+
+async def beam_search(
+    problem: Problem[HS, PSNSub],
+    initial: SearchNode[HS, PSNSub],
+    beam_size: int,
+    max_steps: Optional[int] = None,
+    event_listener: BeamSearchEventListener = BeamSearchEventListener(),
+    keep_finished_nodes: bool = False,
+) -> List[FullSearchNode[HS]]:
+    last_step: Optional[BeamSearchStep[HS]] = None
+    async for step in beam_search_stream(
+        problem,
+        initial,
+        beam_size,
+        max_steps=max_steps,
+        event_listener=event_listener,
+        keep_finished_nodes=keep_finished_nodes,
+    ):
+        last_step = step
+
+    if last_step is None:
+        return []
+    return last_step.results(beam_size)
+
+
+async def _expand_beam(
+    problem: Problem[HS, PSNSub], beam: List[SearchNode[HS, PSNSub]]
+) -> Dict[Tuple[int, ...], Tuple[SearchNode[HS, PSNSub], List[FullSearchNode[HS]]]]:
+    async def expand(
+        node: SearchNode[HS, PSNSub]
+    ) -> Tuple[SearchNode[HS, PSNSub], List[FullSearchNode]]:
+        expansions = await problem.expand(node)
+        return node, expansions
+
+    step_info: Dict[
+        Tuple[int, ...], Tuple[SearchNode[HS, PSNSub], List[FullSearchNode[HS]]]
+    ] = {}
+    for node, per_node_expansion in await asyncio.gather(
+        *(expand(node) for node in beam)
+    ):
+        packed_node = node.packed if isinstance(node, FullSearchNode) else node
+        step_info[packed_node.tokens] = (node, list(per_node_expansion))
+    return step_info
+
+
+def _select(
+    step_info: Dict[
+        Tuple[int, ...], Tuple[SearchNode[HS, PSNSub], List[FullSearchNode[HS]]]
+    ],
+    finished: Set[HashableNodeWrapper[HS]],
+    finished_extra: Set[HashableNodeWrapper[HS]],
+    beam_size: int,
+    keep_finished_nodes: bool,
+) -> Tuple[List[SearchNode[HS, PSNSub]], int]:
+    """Picks the next beam from the expansions in `step_info`, updating `finished` and `finished_extra`.
+
+    Returns the new beam and the number of distinct candidates."""
+    candidates: Set[HashableNodeWrapper[HS]] = set()
+    for _, expansions in step_info.values():
+        for new_node in expansions:
+            candidates.add(HashableNodeWrapper(new_node))
+
+    # We allow `candidates` and `finished` to compete with each other,
+    # as the score will no longer decrease monotonically when we have a length penalty.
+    sorted_candidates_plus_finished = sorted(
+        itertools.chain(candidates, finished), key=lambda n: n.underlying.cost
+    )
+    beam: List[SearchNode[HS, PSNSub]] = []
+    finished.clear()
+    for n in sorted_candidates_plus_finished[:beam_size]:
+        if n.underlying.is_finished:
+            finished.add(n)
+        else:
+            beam.append(n.underlying)
+
+    # If there's a less-competitive candidate which is finished, then keep it for later
+    if keep_finished_nodes:
+        for n in sorted_candidates_plus_finished[beam_size:]:
             if n.underlying.is_finished:
-                finished.add(n)
-            else:
-                beam.append(n.underlying)
-
-        # If there's a less-competitive candidate which is finished, then keep it for later
-        if keep_finished_nodes:
-            for n in sorted_candidates_plus_finished[beam_size:]:
-                if n.underlying.is_finished:
-                    finished_extra.add(n)
-
-        # Due to cycles or some other reason, hidden states are not freed on
-        # time unless we manually collect.
-        if step_index % 50 == 0 and step_index > 0:
-            print("Garbage collecting ...")
-            gc.collect()
-            torch.cuda.empty_cache()
-
-    print("Garbage collecting ...")
-    gc.collect()
-    torch.cuda.empty_cache()
-
-    return sorted(
-        (x.underlying for x in itertools.chain(finished, finished_extra)),
-        key=lambda n: n.cost,
-    )[: beam_size * 2]
+                finished_extra.add(n)
+
+    return beam, len(candidates)
@@ -79,10 +79,7 @@ class LoggingEventListener(BeamSearchEventListener):
                 node_cost_str = ""
 
             duplicates = 0
-            # `node` expands to the nodes in `expansions`.
-            print(
-                f"Completions for {self.tokenizer.decode(list(node.tokens))!r}{node_cost_str}:"
-            )
+            printed: List[FullSearchNode[Any]] = []
             for expansion in heapq.nsmallest(
                 self.beam_size * 2, expansions, key=lambda n: n.cost
             ):
@@ -91,21 +88,30 @@ class LoggingEventListener(BeamSearchEventListener):
                     duplicates += 1
                     continue
                 already_printed.add(deduplicating_node)
+                printed.append(expansion)
 
+            # Finished expansions are printed in full, others by their new tokens.
+            node_text, *expansion_texts = self.tokenizer.batch_decode(
+                [node.tokens]
+                + [
+                    expansion.tokens
+                    if expansion.is_finished
+                    else expansion.tokens[len(node.tokens) :]
+                    for expansion in printed
+                ]
+            )
+            # `node` expands to the nodes in `expansions`.
+            print(f"Completions for {node_text!r}{node_cost_str}:")
+            for expansion, text in zip(printed, expansion_texts):
                 if expansion.is_finished:
-                    complete = self.tokenizer.decode(list(expansion.tokens))
-                    print(f"- Finished: {complete!r} -> [{expansion.cost:.3f}]")
-                else:
-                    last_token = self.tokenizer.decode(
-                        list(expansion.tokens[len(node.tokens) :])
+                    print(f"- Finished: {text!r} -> [{expansion.cost:.3f}]")
+                elif isinstance(node, FullSearchNode):
+                    print(
+                        f"- {text!r} [{expansion.unnormalized_cost - node.unnormalized_cost:.3f}] -> [{expansion.cost:.3f}]"
                     )
-                    if isinstance(node, FullSearchNode):
-                        print(
-                            f"- {last_token!r} [{expansion.unnormalized_cost - node.unnormalized_cost:.3f}] -> [{expansion.cost:.3f}]"
-                        )
-                    else:
-                        # TODO: Get the cost of the node so that we can report the difference
-                        print(f"- {last_token!r} -> [{expansion.cost:.3f}]")
+                else:
+                    # TODO: Get the cost of the node so that we can report the difference
+                    print(f"- {text!r} -> [{expansion.cost:.3f}]")
 
             if duplicates:
                 print(f"- [{duplicates} duplicates of already printed in depth]")
@@ -17,16 +17,41 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import dataclasses
 from dataclasses import dataclass
-from typing import Callable, Generic, List, Optional
+from typing import AsyncGenerator, Callable, Generic, List, Optional
 
-from clamp.search.beam_search import beam_search
-from clamp.search.beam_search_event_listener import LoggingEventListener
+from clamp.search.beam_search import BeamSearchStepStats, beam_search_stream
+from clamp.search.beam_search_event_listener import (
+    BeamSearchEventListener,
+    LoggingEventListener,
+)
 from clamp.search.datum import DatumSub, FullDatumSub
 from clamp.search.model import Model, ModelResult
 from clamp.search.problem_factory import ProblemFactory
+from clamp.search.search_node import FullSearchNode
 from clamp.seq2seq.seq2seq_model import HS
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.util.stage_timer import StageTimer, maybe_count
+
+
+@dataclass
+class PartialPrediction:
+    """Progress of `BeamSearchSemanticParser.predict_stream` after one search step,
+    or the results of the search once it is complete."""
+
+    step_index: int
+    # Decoded text of the lowest-cost hypothesis so far, finished or not.
+    best_text: str
+    # Decoded text of the token prefix shared by all hypotheses that can still be
+    # returned. It will not change in later steps except by being extended.
+    stable_prefix_text: str
+    # Hypotheses that finished in this step.
+    newly_finished: List[ModelResult]
+    # None in the trailing item with `final_results`, which repeats the last step.
+    stats: Optional[BeamSearchStepStats]
+    # Set only in the trailing item, once the search is complete.
+    final_results: Optional[List[ModelResult]] = None
 
 
 @dataclass
@@ -39,21 +64,75 @@ class BeamSearchSemanticParser(Model[DatumSub], Generic[DatumSub, FullDatumSub,
     beam_size: int
     max_steps_fn: Optional[Callable[[DatumSub], Optional[int]]] = None
     keep_finished_nodes: bool = False  # save finished entries in beam separately
+    # Creates the event listener used by `predict` for each datum.
+    # If None, every step is printed with LoggingEventListener.
+    event_listener_factory: Optional[
+        Callable[[DatumSub], BeamSearchEventListener]
+    ] = None
+    # Counts the steps of the search as "search_steps".
+    stage_timer: Optional[StageTimer] = None
 
     async def predict(self, test_datum: DatumSub) -> List[ModelResult]:
         """Returns tuple of (hypothesis, whether hypothesis was artificially kept
         alive using force_decode, k-best list"""
+        if self.event_listener_factory is None:
+            event_listener: BeamSearchEventListener = LoggingEventListener(
+                self.tokenizer, self.beam_size
+            )
+        else:
+            event_listener = self.event_listener_factory(test_datum)
+        results: List[ModelResult] = []
+        async for partial in self.predict_stream(test_datum, event_listener):
+            if partial.final_results is not None:
+                results = partial.final_results
+        return results
+
+    async def predict_stream(
+        self,
+        test_datum: DatumSub,
+        event_listener: BeamSearchEventListener = BeamSearchEventListener(),
+    ) -> AsyncGenerator[PartialPrediction, None]:
+        """Like `predict`, but yields the progress of the search after every step.
+
+        Each step is yielded as soon as it is done. A trailing PartialPrediction follows
+        the last step, with `final_results` set to what `predict` returns.
+        By default, no per-step logging is printed; pass an `event_listener` to get it."""
         max_steps = self.max_steps_fn(test_datum) if self.max_steps_fn else None
-        results = await beam_search(
+        steps = beam_search_stream(
             self.problem_factory.problem,
             self.problem_factory.initial(test_datum),
             self.beam_size,
-            event_listener=LoggingEventListener(self.tokenizer, self.beam_size),
+            event_listener=event_listener,
             max_steps=max_steps,
             keep_finished_nodes=self.keep_finished_nodes,
         )
+        last: Optional[PartialPrediction] = None
+        last_step = None
+        async for step in steps:
+            maybe_count(self.stage_timer, "search_steps")
+            best = step.best
+            last = PartialPrediction(
+                step.step_index,
+                best_text=self.tokenizer.decode(list(best.tokens)) if best else "",
+                stable_prefix_text=self.tokenizer.decode(list(step.stable_prefix)),
+                newly_finished=self._to_model_results(step.newly_finished),
+                stats=step.stats,
+            )
+            last_step = step
+            yield last
+
+        if last is None or last_step is None:
+            return
+        yield dataclasses.replace(
+            last,
+            newly_finished=[],
+            stats=None,
+            final_results=self._to_model_results(last_step.results(self.beam_size)),
+        )
+
+    def _to_model_results(self, nodes: List[FullSearchNode[HS]]) -> List[ModelResult]:
         model_results = []
-        for n in results:
+        for n in nodes:
             text = self.problem_factory.decoding_setup.finalize(n.tokens)  # type: ignore
             token_costs = [
                 (self.tokenizer.id_to_utf8_token_map[t], cost)
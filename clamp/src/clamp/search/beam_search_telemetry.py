@@ -0,0 +1,365 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Structured, low-overhead recording of beam search steps.
+
+`LoggingEventListener` decodes and prints every expansion at every step, which
+is expensive enough to show up in decoding profiles. `TelemetryEventListener`
+instead copies token ids and costs into preallocated numpy buffers, which a
+`TelemetryWriter` hands to a background thread to be written to disk.
+Use `read_telemetry` (or clamp_experiments.print_search_telemetry) to inspect
+the result offline.
+
+Each record describes one expansion: the tokens of the node which was expanded,
+the token which was appended to it (-1 if the expansion is finished), and the
+cost of the resulting node.
+"""
+import heapq
+import json
+import math
+import queue
+import random
+import threading
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from clamp.search.beam_search_event_listener import BeamSearchEventListener
+from clamp.search.search_node import FullSearchNode, SearchNode
+
+ROW_DTYPE = np.dtype(
+    [
+        # Index into the datum ids of the chunk which contains the row.
+        ("datum", "<i4"),
+        ("step", "<i4"),
+        # The tokens of the expanded node are tokens[parent_offset : parent_offset + parent_length].
+        ("parent_offset", "<i8"),
+        ("parent_length", "<i4"),
+        # NaN if the expanded node was a PackedSearchNode.
+        ("parent_cost", "<f4"),
+        # -1 for finished expansions.
+        ("token", "<i4"),
+        ("cost", "<f4"),
+        ("unnormalized_cost", "<f4"),
+        ("finished", "?"),
+    ]
+)
+
+
+class TelemetryFormat(Enum):
+    # One JSON object per expansion.
+    JSONL = "jsonl"
+    # A sequence of chunks, each of which is three arrays written with `np.save`:
+    # the rows (with ROW_DTYPE), the flat token buffer, and the datum ids.
+    NPY = "npy"
+
+
+@dataclass(frozen=True)
+class TelemetryRecord:
+    datum_id: str
+    step: int
+    parent_tokens: Tuple[int, ...]
+    parent_cost: Optional[float]
+    token: Optional[int]
+    cost: float
+    unnormalized_cost: float
+    finished: bool
+
+    @property
+    def tokens(self) -> Tuple[int, ...]:
+        if self.token is None:
+            return self.parent_tokens
+        return self.parent_tokens + (self.token,)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "datum_id": self.datum_id,
+            "step": self.step,
+            "parent_tokens": list(self.parent_tokens),
+            "parent_cost": self.parent_cost,
+            "token": self.token,
+            "cost": self.cost,
+            "unnormalized_cost": self.unnormalized_cost,
+            "finished": self.finished,
+        }
+
+    @staticmethod
+    def from_json(obj: Dict[str, Any]) -> "TelemetryRecord":
+        return TelemetryRecord(
+            datum_id=obj["datum_id"],
+            step=obj["step"],
+            parent_tokens=tuple(obj["parent_tokens"]),
+            parent_cost=obj["parent_cost"],
+            token=obj["token"],
+            cost=obj["cost"],
+            unnormalized_cost=obj["unnormalized_cost"],
+            finished=obj["finished"],
+        )
+
+
+class _Buffer:
+    """Preallocated storage for a chunk of rows, reused after it is written out."""
+
+    def __init__(self, max_rows: int, max_tokens: int):
+        self.rows = np.zeros(max_rows, dtype=ROW_DTYPE)
+        self.tokens = np.zeros(max_tokens, dtype=np.int32)
+        self.datum_ids: List[str] = []
+        self.num_rows = 0
+        self.num_tokens = 0
+
+    def reset(self) -> None:
+        self.datum_ids = []
+        self.num_rows = 0
+        self.num_tokens = 0
+
+    def datum_index(self, datum_id: str) -> int:
+        # Consecutive rows almost always belong to the same datum; if datums interleave,
+        # the same id can appear more than once in `datum_ids`, which is harmless.
+        if not self.datum_ids or self.datum_ids[-1] != datum_id:
+            self.datum_ids.append(datum_id)
+        return len(self.datum_ids) - 1
+
+    def records(self) -> Iterator[TelemetryRecord]:
+        return _records_from_arrays(
+            self.rows[: self.num_rows], self.tokens[: self.num_tokens], self.datum_ids
+        )
+
+
+def _records_from_arrays(
+    rows: np.ndarray, tokens: np.ndarray, datum_ids: List[str]
+) -> Iterator[TelemetryRecord]:
+    token_list = tokens.tolist()
+    for row in rows.tolist():
+        (
+            datum,
+            step,
+            parent_offset,
+            parent_length,
+            parent_cost,
+            token,
+            cost,
+            unnormalized_cost,
+            finished,
+        ) = row
+        yield TelemetryRecord(
+            datum_id=datum_ids[datum],
+            step=step,
+            parent_tokens=tuple(
+                token_list[parent_offset : parent_offset + parent_length]
+            ),
+            parent_cost=None if math.isnan(parent_cost) else parent_cost,
+            token=None if token < 0 else token,
+            cost=cost,
+            unnormalized_cost=unnormalized_cost,
+            finished=finished,
+        )
+
+
+class TelemetryWriter:
+    """Accumulates expansions in preallocated buffers and writes them to `path` on a background thread.
+
+    The file is opened for appending, so that resumed runs add to it.
+    Once all `num_buffers` buffers are waiting to be written, recording blocks until one is free."""
+
+    def __init__(
+        self,
+        path: Path,
+        fmt: TelemetryFormat = TelemetryFormat.JSONL,
+        max_rows_per_chunk: int = 1 << 16,
+        max_tokens_per_chunk: int = 1 << 20,
+        num_buffers: int = 2,
+    ):
+        self.path = path
+        self.fmt = fmt
+        self._file: BinaryIO = open(path, "ab")
+        self._free: "queue.Queue[_Buffer]" = queue.Queue()
+        for _ in range(num_buffers):
+            self._free.put(_Buffer(max_rows_per_chunk, max_tokens_per_chunk))
+        self._to_write: "queue.Queue[Optional[_Buffer]]" = queue.Queue()
+        self._current: _Buffer = self._free.get()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(
+            target=self._write_loop, name="beam-search-telemetry", daemon=True
+        )
+        self._thread.start()
+        self.closed = False
+
+    def record_step(
+        self,
+        datum_id: str,
+        step: int,
+        all_expansions: Dict[
+            Tuple[int, ...], Tuple[SearchNode[Any, Any], List[FullSearchNode[Any]]]
+        ],
+        max_expansions_per_node: Optional[int] = None,
+    ) -> None:
+        self._check_error()
+        for node, expansions in all_expansions.values():
+            if max_expansions_per_node is not None:
+                expansions = heapq.nsmallest(
+                    max_expansions_per_node, expansions, key=lambda n: n.cost
+                )
+            parent_cost = node.cost if isinstance(node, FullSearchNode) else math.nan
+            self._record_node(datum_id, step, node.tokens, parent_cost, expansions)
+
+    def _record_node(
+        self,
+        datum_id: str,
+        step: int,
+        parent_tokens: Tuple[int, ...],
+        parent_cost: float,
+        expansions: List[FullSearchNode[Any]],
+    ) -> None:
+        parent_length = len(parent_tokens)
+        start = 0
+        while start < len(expansions):
+            buf = self._current
+            if buf.num_rows == len(buf.rows) or buf.num_tokens + parent_length > len(
+                buf.tokens
+            ):
+                if buf.num_rows == 0:
+                    raise ValueError(
+                        f"Node with {parent_length} tokens does not fit in a telemetry chunk"
+                    )
+                self.flush()
+                continue
+
+            parent_offset = buf.num_tokens
+            buf.tokens[parent_offset : parent_offset + parent_length] = parent_tokens
+            buf.num_tokens += parent_length
+
+            chunk = expansions[start : start + len(buf.rows) - buf.num_rows]
+            rows = buf.rows[buf.num_rows : buf.num_rows + len(chunk)]
+            rows["datum"] = buf.datum_index(datum_id)
+            rows["step"] = step
+            rows["parent_offset"] = parent_offset
+            rows["parent_length"] = parent_length
+            rows["parent_cost"] = parent_cost
+            rows["token"] = [
+                -1 if n.is_finished else n.tokens[parent_length] for n in chunk
+            ]
+            rows["cost"] = [n.cost for n in chunk]
+            rows["unnormalized_cost"] = [n.unnormalized_cost for n in chunk]
+            rows["finished"] = [n.is_finished for n in chunk]
+            buf.num_rows += len(chunk)
+            start += len(chunk)
+
+    def flush(self) -> None:
+        """Hands the current buffer to the writer thread, if it has anything in it."""
+        if self._current.num_rows == 0:
+            return
+        self._to_write.put(self._current)
+        self._current = self._free.get()
+        self._check_error()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self._to_write.put(None)
+        self._thread.join()
+        self._file.close()
+        self._check_error()
+
+    def __enter__(self) -> "TelemetryWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _check_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"Writing to {self.path} failed") from self._error
+
+    def _write_loop(self) -> None:
+        while True:
+            buf = self._to_write.get()
+            if buf is None:
+                break
+            try:
+                if self._error is None:
+                    self._write(buf)
+            except BaseException as e:  # pylint: disable=broad-except
+                self._error = e
+            finally:
+                buf.reset()
+                self._free.put(buf)
+
+    def _write(self, buf: _Buffer) -> None:
+        if self.fmt is TelemetryFormat.JSONL:
+            for record in buf.records():
+                self._file.write(json.dumps(record.to_json()).encode("utf-8"))
+                self._file.write(b"\n")
+        else:
+            np.save(self._file, buf.rows[: buf.num_rows])
+            np.save(self._file, buf.tokens[: buf.num_tokens])
+            np.save(self._file, np.array(buf.datum_ids, dtype=str))
+        self._file.flush()
+
+
+def read_telemetry(path: Path, fmt: TelemetryFormat) -> Iterator[TelemetryRecord]:
+    if fmt is TelemetryFormat.JSONL:
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield TelemetryRecord.from_json(json.loads(line))
+    else:
+        with open(path, "rb") as f:
+            while f.peek(1):  # type: ignore[attr-defined]
+                rows = np.load(f)
+                tokens = np.load(f)
+                datum_ids = np.load(f).tolist()
+                yield from _records_from_arrays(rows, tokens, datum_ids)
+
+
+@dataclass
+class TelemetryEventListener(BeamSearchEventListener):
+    """Records a sample of beam search steps for one datum into `writer`."""
+
+    writer: TelemetryWriter
+    datum_id: str
+    # Fraction of steps to record.
+    sample_rate: float = 1.0
+    # Like `LoggingEventListener`, only keep the cheapest expansions of each node.
+    max_expansions_per_node: Optional[int] = None
+    seed: int = 0
+    last_step: int = 0
+
+    def __post_init__(self) -> None:
+        self._rng = random.Random(f"{self.seed}/{self.datum_id}")
+
+    # pylint: disable=arguments-renamed
+    def step(
+        self,
+        all_expansions: Dict[
+            Tuple[int, ...], Tuple[SearchNode[Any, Any], List[FullSearchNode[Any]]]
+        ],
+    ) -> None:
+        if self.sample_rate >= 1 or self._rng.random() < self.sample_rate:
+            self.writer.record_step(
+                self.datum_id,
+                self.last_step,
+                all_expansions,
+                self.max_expansions_per_node,
+            )
+        self.last_step += 1
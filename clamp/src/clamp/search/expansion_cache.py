@@ -0,0 +1,310 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Caches for the results of `ConstrainedDecodingProblem.expand`.
+
+`LRUExpansionCache` keeps expansions in memory, without their hidden states,
+up to a number of entries and an (estimated) number of bytes.
+`ExpansionDiskCache` stores only the tokens and log probabilities of the
+expansions in SQLite, so that they can be reused by later runs which decode
+the same datums with a different beam size or length penalty.
+"""
+import collections
+import copy
+import dataclasses
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (
+    Callable,
+    Counter,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
+
+from clamp.search.search_node import FullSearchNode, PackedSearchNode
+from clamp.seq2seq.seq2seq_model import HS
+
+# Rough size of a FullSearchNode and its PackedSearchNode, excluding their sequences.
+_NODE_OVERHEAD_BYTES = 400
+
+
+def estimate_expansions_nbytes(expansions: List[FullSearchNode]) -> int:
+    """Estimates the memory used by `expansions` once their hidden states are dropped.
+
+    Partial parses are not counted since they are mostly shared with other nodes."""
+    return sum(
+        _NODE_OVERHEAD_BYTES + 8 * (len(node.tokens) + len(node.token_costs))
+        for node in expansions
+    )
+
+
+@dataclass(frozen=True)
+class ExpansionCacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    num_entries: int
+    nbytes: int
+
+
+class LRUExpansionCache(
+    MutableMapping[PackedSearchNode, List[FullSearchNode[HS]]], Generic[HS]
+):
+    """A bounded cache for `ConstrainedDecodingProblem.cache`.
+
+    Hidden states are dropped from the expansions when they are stored;
+    ConstrainedDecodingProblem gives the nodes of a cached expansion the hidden
+    state of the node it expanded, and runs the model on their pending tokens
+    if they are expanded further."""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[List[FullSearchNode]], int] = estimate_expansions_nbytes,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries: "OrderedDict[PackedSearchNode, Tuple[List[FullSearchNode[HS]], int]]" = (
+            OrderedDict()
+        )
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key: PackedSearchNode) -> List[FullSearchNode[HS]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(
+        self, key: PackedSearchNode, expansions: List[FullSearchNode[HS]]
+    ) -> None:
+        if key in self._entries:
+            del self[key]
+        stripped = [
+            dataclasses.replace(node, hidden_state=None)
+            if node.hidden_state is not None
+            else node
+            for node in expansions
+        ]
+        nbytes = self.sizeof(stripped)
+        self._entries[key] = (stripped, nbytes)
+        self._nbytes += nbytes
+        self._evict()
+
+    def __delitem__(self, key: PackedSearchNode) -> None:
+        _, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def __iter__(self) -> Iterator[PackedSearchNode]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        # Unlike the default implementation, this doesn't count as a hit or miss.
+        return key in self._entries
+
+    def _evict(self) -> None:
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._nbytes > self.max_bytes)
+        ):
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def stats(self) -> ExpansionCacheStats:
+        return ExpansionCacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            num_entries=len(self._entries),
+            nbytes=self._nbytes,
+        )
+
+
+@dataclass(frozen=True)
+class ExpansionRecord:
+    """The model- and grammar-dependent part of an expansion, independent of search settings."""
+
+    # `top_k` used when computing the record.
+    top_k: Optional[int]
+    # Whether `tokens` contains every allowed token, rather than only the `top_k` most likely.
+    complete: bool
+    # Allowed next tokens in descending order of log probability.
+    # May include EOS tokens, since they take up places in the top k.
+    tokens: Tuple[int, ...]
+    logprobs: Tuple[float, ...]
+    # Log probability of ending here, or None if the grammar doesn't allow it.
+    eos_logprob: Optional[float]
+
+    def usable_for(self, top_k: Optional[int]) -> bool:
+        if self.complete:
+            return True
+        return top_k is not None and self.top_k is not None and top_k <= self.top_k
+
+    def token_and_logprobs(self, top_k: Optional[int]) -> Sequence[Tuple[int, float]]:
+        pairs = list(zip(self.tokens, self.logprobs))
+        return pairs if top_k is None else pairs[:top_k]
+
+
+class ExpansionDiskCache:
+    """Stores ExpansionRecords in a SQLite database.
+
+    `namespace` should identify the model, since records are otherwise keyed
+    only by `repr` of the PackedSearchNode. Use `for_grammar` to get the cache
+    for the records of a particular grammar.
+
+    New records are buffered and written in one transaction by `flush`, which
+    happens every `max_pending` records and should be called after each datum.
+    Several processes can share the database."""
+
+    def __init__(self, path: Path, namespace: str, max_pending: int = 1000):
+        self.path = path
+        self.namespace = namespace
+        self.max_pending = max_pending
+        # Shared with the views returned by `for_grammar`.
+        self._counts: Counter[str] = collections.Counter()
+        self._pending: Dict[str, ExpansionRecord] = {}
+        # Wait for other processes to finish writing, instead of failing.
+        self._conn = sqlite3.connect(str(path), timeout=600)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Commits survive this process crashing, though not the machine.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS expansions ("
+                "key TEXT PRIMARY KEY, top_k INTEGER, complete INTEGER, "
+                "tokens BLOB, logprobs BLOB, eos_logprob REAL)"
+            )
+
+    @property
+    def hits(self) -> int:
+        return self._counts["hits"]
+
+    @property
+    def misses(self) -> int:
+        return self._counts["misses"]
+
+    def for_grammar(self, digest: str) -> "ExpansionDiskCache":
+        """Returns a view of this cache for the records computed with the grammar
+        identified by `digest` (see `grammar_digest`), so that records computed
+        with an earlier version of the grammar are not used."""
+        view = copy.copy(self)
+        view.namespace = f"{self.namespace}\0{digest}"
+        return view
+
+    def _key(self, packed_node: PackedSearchNode) -> str:
+        return hashlib.sha1(
+            f"{self.namespace}\0{packed_node!r}".encode("utf-8")
+        ).hexdigest()
+
+    def get(
+        self, packed_node: PackedSearchNode, top_k: Optional[int]
+    ) -> Optional[ExpansionRecord]:
+        key = self._key(packed_node)
+        record = self._pending.get(key)
+        if record is None:
+            row = self._conn.execute(
+                "SELECT top_k, complete, tokens, logprobs, eos_logprob FROM expansions WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                record_top_k, complete, tokens, logprobs, eos_logprob = row
+                record = ExpansionRecord(
+                    record_top_k,
+                    bool(complete),
+                    tuple(np.frombuffer(tokens, dtype="<i4").tolist()),
+                    tuple(np.frombuffer(logprobs, dtype="<f8").tolist()),
+                    eos_logprob,
+                )
+        if record is not None and record.usable_for(top_k):
+            self._counts["hits"] += 1
+            return record
+        self._counts["misses"] += 1
+        return None
+
+    def put(self, packed_node: PackedSearchNode, record: ExpansionRecord) -> None:
+        key = self._key(packed_node)
+        existing = self._pending.get(key)
+        if existing is None or not _at_least_as_useful(
+            existing.top_k, existing.complete, record
+        ):
+            self._pending[key] = record
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered records."""
+        if not self._pending:
+            return
+        with self._conn:
+            for key, record in self._pending.items():
+                existing = self._conn.execute(
+                    "SELECT top_k, complete FROM expansions WHERE key = ?", (key,)
+                ).fetchone()
+                if existing is not None and _at_least_as_useful(
+                    existing[0], existing[1], record
+                ):
+                    continue
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO expansions VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        record.top_k,
+                        record.complete,
+                        np.array(record.tokens, dtype="<i4").tobytes(),
+                        np.array(record.logprobs, dtype="<f8").tobytes(),
+                        record.eos_logprob,
+                    ),
+                )
+        self._pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+
+def _at_least_as_useful(
+    top_k: Optional[int], complete: bool, record: ExpansionRecord
+) -> bool:
+    """Whether a record with `top_k` and `complete` is at least as useful as `record`."""
+    return bool(complete) or (
+        record.top_k is not None and top_k is not None and top_k >= record.top_k
+    )
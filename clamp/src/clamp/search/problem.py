@@ -17,13 +17,18 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import dataclasses
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Generic, Iterator, List, MutableMapping, Optional, Tuple
+from typing import Generic, List, MutableMapping, Optional, Sequence, Tuple
 
 import torch
 
+from clamp.async_tools.batch_helper import start_batched
+from clamp.decoding.partial_parse import PartialParse
+from clamp.search.expansion_cache import ExpansionDiskCache, ExpansionRecord
 from clamp.search.search_node import (
     FullSearchNode,
     PackedSearchNode,
@@ -31,7 +36,9 @@ from clamp.search.search_node import (
     SearchNode,
     SearchNodeUnpacker,
 )
+from clamp.seq2seq.hidden_state_tracker import HiddenStateStats
 from clamp.seq2seq.seq2seq_model import HS, AutoregressiveModel
+from clamp.util.stage_timer import StageTimer, maybe_count, maybe_stage
 
 
 class Problem(Generic[HS, PSNSub], ABC):
@@ -48,6 +55,9 @@ class Problem(Generic[HS, PSNSub], ABC):
     ) -> List[FullSearchNode[HS]]:
         pass
 
+    def hidden_state_stats(self) -> Optional[HiddenStateStats]:
+        return None
+
 
 @dataclass
 class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
@@ -64,35 +74,100 @@ class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
 
     # TODO: PackedSearchNode may not always be Hashable.
     cache: Optional[MutableMapping[PackedSearchNode, List[FullSearchNode[HS]]]] = None
+    # Persists the tokens and log probabilities of expansions, but not the hidden states.
+    disk_cache: Optional[ExpansionDiskCache] = None
+    # If set, asks the model for log probabilities of only the tokens that the partial
+    # parse allows, which can be much cheaper when the grammar is restrictive.
+    restrict_to_allowed_tokens: bool = False
+    # With `restrict_to_allowed_tokens`, whether the log probabilities must be normalized
+    # over the whole vocabulary rather than only the allowed tokens.
+    exact_normalizer: bool = True
+    # Records the time spent on the grammar as the "allowed_next" and "grammar"
+    # stages, and counts the expansions and cache hits.
+    stage_timer: Optional[StageTimer] = None
+
+    def hidden_state_stats(self) -> Optional[HiddenStateStats]:
+        return self.model.hidden_state_stats()
 
     async def expand(
         self, maybe_packed_node: SearchNode[HS, PSNSub]
     ) -> List[FullSearchNode[HS]]:
+        if isinstance(maybe_packed_node, FullSearchNode):
+            packed_node = maybe_packed_node.packed
+        else:
+            packed_node = maybe_packed_node
+
+        maybe_count(self.stage_timer, "expansions")
         if self.cache is not None:
-            if isinstance(maybe_packed_node, FullSearchNode):
-                packed_node = maybe_packed_node.packed
-            else:
-                packed_node = maybe_packed_node
             existing = self.cache.get(packed_node)
             if existing is not None:
                 logging.debug("\N{DIRECT HIT} %s", packed_node)
-                return existing
+                maybe_count(self.stage_timer, "expansion_cache_hits")
+                return _with_parent_hidden_state(existing, maybe_packed_node)
             else:
                 logging.debug("\N{HOURGLASS WITH FLOWING SAND} %s", packed_node)
 
+        record: Optional[ExpansionRecord] = None
+        if self.disk_cache is not None:
+            record = self.disk_cache.get(packed_node, self.top_k)
+            if record is not None:
+                maybe_count(self.stage_timer, "expansion_disk_cache_hits")
+
+        next_logprobs: Optional[torch.Tensor] = None
+        # With `restrict_to_allowed_tokens`, the result of `allowed_next()`.
+        all_allowed_next: Optional[Tuple[Optional[torch.Tensor], bool]] = None
+        new_hidden_state: Optional[HS]
+        # The number of tokens that the children's hidden state hasn't consumed.
+        num_pending_tokens = 1
         if isinstance(maybe_packed_node, FullSearchNode):
             assert not maybe_packed_node.is_finished
-            assert maybe_packed_node.hidden_state
-            logprobs, new_hidden_state = await self.model.extend(
-                maybe_packed_node.tokens[-1:], maybe_packed_node.hidden_state
-            )
+            pending_tokens = maybe_packed_node.tokens[
+                -maybe_packed_node.num_pending_tokens :
+            ]
+            if record is not None:
+                # The model runs on this node's pending tokens once a child is expanded.
+                new_hidden_state = maybe_packed_node.hidden_state
+                if new_hidden_state is not None:
+                    num_pending_tokens = maybe_packed_node.num_pending_tokens + 1
+            elif maybe_packed_node.hidden_state is None:
+                # Nodes which came from a cache don't have hidden states,
+                # so we recompute it from the tokens.
+                _, new_hidden_state, _ = await self.unpacker(packed_node)  # type: ignore
+                next_logprobs = await self.model.next_logprobs(new_hidden_state)  # type: ignore
+            elif self.restrict_to_allowed_tokens:
+                with maybe_stage(self.stage_timer, "allowed_next"):
+                    all_allowed_next = maybe_packed_node.partial_parse.allowed_next()
+                allowed_token_ids = self._allowed_token_ids(all_allowed_next[0])
+                (
+                    next_logprobs,
+                    new_hidden_state,
+                ) = await self.model.extend_next_logprobs(
+                    pending_tokens,
+                    maybe_packed_node.hidden_state,
+                    allowed_token_ids,
+                    self.exact_normalizer,
+                )
+            else:
+                # Once the model call has joined a batch, the grammar work overlaps
+                # with it if the model runs on an executor or in another process.
+                model_call = await start_batched(
+                    self.model.extend(pending_tokens, maybe_packed_node.hidden_state)
+                )
+                try:
+                    with maybe_stage(self.stage_timer, "grammar"):
+                        maybe_packed_node.partial_parse.prefetch()
+                except BaseException:
+                    # The batch may hold other nodes' inputs, so let it finish
+                    # rather than cancel it, and don't leave the task unobserved.
+                    await asyncio.gather(model_call, return_exceptions=True)
+                    raise
+                logprobs, new_hidden_state = await model_call
+                # The distribution after the last token.
+                next_logprobs = logprobs[-1]
 
-            next_logprobs = logprobs[0]  # Remove the sequence dimension
             unnormalized_cost = maybe_packed_node.unnormalized_cost
-            packed_node = maybe_packed_node.packed
             partial_parse = maybe_packed_node.partial_parse
             token_logprobs = maybe_packed_node.token_costs
-            # new_hidden_state already set
         else:
             (
                 partial_parse,
@@ -102,24 +177,30 @@ class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
                 maybe_packed_node
             )
 
-            next_logprobs = await self.model.next_logprobs(hidden_state)
+            if record is None:
+                next_logprobs = await self.model.next_logprobs(hidden_state)
             unnormalized_cost = -sum(existing_logprobs)
-            packed_node = maybe_packed_node
             # partial_parse already set
             new_hidden_state = hidden_state
             token_logprobs = []
 
         del maybe_packed_node
 
-        allowed_next, can_end = partial_parse.allowed_next(
-            argsort_without_negative_inf(next_logprobs, descending=True), self.top_k
-        )
+        eos_logprob: Optional[float]
+        token_and_logprobs: Sequence[Tuple[int, float]]
+        if record is None:
+            assert next_logprobs is not None
+            record = self._compute_record(
+                next_logprobs, partial_parse, all_allowed_next
+            )
+            if self.disk_cache is not None:
+                self.disk_cache.put(packed_node, record)
+        eos_logprob = record.eos_logprob
+        token_and_logprobs = record.token_and_logprobs(self.top_k)
 
         result: List[FullSearchNode[HS]] = []
-        if can_end:
-            eos_logprob = torch.logsumexp(next_logprobs[self.eos], dim=0)
-
-            new_unnorm_cost = unnormalized_cost - eos_logprob.item()
+        if eos_logprob is not None:
+            new_unnorm_cost = unnormalized_cost - eos_logprob
             result.append(
                 FullSearchNode(
                     packed_node,
@@ -132,41 +213,14 @@ class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
                         len(packed_node.tokens) + 1,
                     ),
                     unnormalized_cost=new_unnorm_cost,
-                    token_costs=token_logprobs + [-eos_logprob.item()],
-                )
-            )
-        token_and_logprob_iter: Iterator[Tuple[int, torch.Tensor]]
-        if allowed_next is None:
-            indices = torch.arange(next_logprobs.shape[0])
-            eligible_logprobs = next_logprobs
-        else:
-            indices = allowed_next
-            eligible_logprobs = next_logprobs[allowed_next]
-
-        if self.top_k is None:
-            token_and_logprob_iter = (
-                # .item() converts 0D tensor to a Python number
-                (token_id_tensor.item(), logprob)  # type: ignore
-                for token_id_tensor, logprob in zip(indices, eligible_logprobs)
-            )
-        else:
-            topk_eligible_logprobs = torch.topk(
-                eligible_logprobs,
-                k=min(self.top_k, eligible_logprobs.shape[0]),
-                sorted=False,
-            )
-            token_and_logprob_iter = (
-                (token_id_tensor.item(), logprob)  # type: ignore
-                for token_id_tensor, logprob in zip(
-                    indices[topk_eligible_logprobs.indices],
-                    topk_eligible_logprobs.values,
+                    token_costs=token_logprobs + [-eos_logprob],
                 )
             )
 
-        for token, logprob in token_and_logprob_iter:
+        for token, logprob in token_and_logprobs:
             if token in self.eos:
                 continue
-            new_unnorm_cost = unnormalized_cost - logprob.item()
+            new_unnorm_cost = unnormalized_cost - logprob
             result.append(
                 FullSearchNode(
                     packed_node.append(token),
@@ -178,7 +232,8 @@ class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
                         len(packed_node.tokens) + 1,
                     ),
                     unnormalized_cost=new_unnorm_cost,
-                    token_costs=token_logprobs + [-logprob.item()],
+                    token_costs=token_logprobs + [-logprob],
+                    num_pending_tokens=num_pending_tokens,
                 )
             )
 
@@ -186,6 +241,100 @@ class ConstrainedDecodingProblem(Problem[HS, PSNSub]):
             self.cache[packed_node] = result
         return result
 
+    def _allowed_token_ids(
+        self, allowed_next: Optional[torch.Tensor]
+    ) -> Optional[torch.Tensor]:
+        if allowed_next is None:
+            return None
+        # The EOS tokens are needed to score ending here.
+        return torch.cat([allowed_next, self.eos.to(allowed_next.device)])
+
+    def _compute_record(
+        self,
+        next_logprobs: torch.Tensor,
+        partial_parse: PartialParse,
+        all_allowed_next: Optional[Tuple[Optional[torch.Tensor], bool]] = None,
+    ) -> ExpansionRecord:
+        """Finds the allowed next tokens and their log probabilities, most likely first.
+
+        If `all_allowed_next` is given, it is the result of `partial_parse.allowed_next()`,
+        which is used instead of walking the grammar again."""
+        ordered_ids = argsort_without_negative_inf(next_logprobs, descending=True)
+        if all_allowed_next is None:
+            with maybe_stage(self.stage_timer, "allowed_next"):
+                allowed_next, can_end = partial_parse.allowed_next(
+                    ordered_ids, self.top_k
+                )
+        else:
+            all_allowed, can_end = all_allowed_next
+            allowed_next = (
+                None
+                if all_allowed is None
+                else _ordered_subset(
+                    ordered_ids, all_allowed, next_logprobs.shape[0], self.top_k
+                )
+            )
+
+        eos_logprob = (
+            torch.logsumexp(next_logprobs[self.eos], dim=0).item() if can_end else None
+        )
+
+        if allowed_next is None:
+            indices = torch.arange(next_logprobs.shape[0])
+            eligible_logprobs = next_logprobs
+        else:
+            indices = allowed_next
+            eligible_logprobs = next_logprobs[allowed_next]
+
+        if self.top_k is None:
+            sorted_eligible_logprobs = torch.sort(eligible_logprobs, descending=True)
+        else:
+            sorted_eligible_logprobs = torch.topk(
+                eligible_logprobs,
+                k=min(self.top_k, eligible_logprobs.shape[0]),
+                sorted=True,
+            )
+
+        return ExpansionRecord(
+            top_k=self.top_k,
+            # `allowed_next` returns fewer than `top_k` tokens only if there are no more.
+            complete=self.top_k is None or eligible_logprobs.shape[0] < self.top_k,
+            tokens=tuple(indices[sorted_eligible_logprobs.indices].tolist()),
+            logprobs=tuple(sorted_eligible_logprobs.values.tolist()),
+            eos_logprob=eos_logprob,
+        )
+
+
+def _ordered_subset(
+    ordered_ids: torch.Tensor, subset: torch.Tensor, size: int, top_k: Optional[int]
+) -> torch.Tensor:
+    """The first `top_k` of `ordered_ids` which are in `subset`, in order.
+
+    All of the IDs must be less than `size`."""
+    in_subset = torch.zeros(size, dtype=torch.bool, device=ordered_ids.device)
+    in_subset[subset.to(ordered_ids.device)] = True
+    return ordered_ids[in_subset[ordered_ids]][:top_k]
+
+
+def _with_parent_hidden_state(
+    expansions: List[FullSearchNode[HS]], parent: SearchNode[HS, PSNSub]
+) -> List[FullSearchNode[HS]]:
+    """Gives cached `expansions` of `parent` which have no hidden state, e.g. because
+    the cache dropped it, the parent's, so that expanding them runs the model on just
+    the pending tokens. Expansions which kept their hidden state are left as they are."""
+    if not isinstance(parent, FullSearchNode) or parent.hidden_state is None:
+        return expansions
+    return [
+        node
+        if node.is_finished or node.hidden_state is not None
+        else dataclasses.replace(
+            node,
+            hidden_state=parent.hidden_state,
+            num_pending_tokens=parent.num_pending_tokens + 1,
+        )
+        for node in expansions
+    ]
+
 
 def gnmt_length_normalization(alpha: float, unnormalized: float, length: int) -> float:
     """
@@ -24,10 +24,12 @@ from typing import Generic, List, MutableMapping, Optional
 from cached_property import cached_property
 
 from clamp.search.datum import DatumSub
+from clamp.search.expansion_cache import ExpansionDiskCache
 from clamp.search.problem import ConstrainedDecodingProblem, Problem
 from clamp.search.search_node import FullSearchNode, PackedSearchNode
 from clamp.search.seq2seq_decoding_step import DatumPackedSearchNode, DecodingSetup
 from clamp.seq2seq.seq2seq_model import HS, AutoregressiveModel
+from clamp.util.stage_timer import StageTimer
 
 
 @dataclass  # type: ignore
@@ -59,6 +61,10 @@ class ConstrainedDecodingProblemFactory(ProblemFactory[DatumSub, HS]):
     length_normalization: float = 0.7
     top_k: Optional[int] = None
     cache: Optional[MutableMapping[PackedSearchNode, List[FullSearchNode[HS]]]] = None
+    disk_cache: Optional[ExpansionDiskCache] = None
+    restrict_to_allowed_tokens: bool = False
+    exact_normalizer: bool = True
+    stage_timer: Optional[StageTimer] = None
 
     @cached_property
     def problem(
@@ -73,4 +79,8 @@ class ConstrainedDecodingProblemFactory(ProblemFactory[DatumSub, HS]):
             self.length_normalization,
             self.top_k,
             self.cache,
+            self.disk_cache,
+            self.restrict_to_allowed_tokens,
+            self.exact_normalizer,
+            self.stage_timer,
         )
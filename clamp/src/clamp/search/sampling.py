@@ -0,0 +1,187 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Samples outputs from the model, restricted to the tokens that the grammar allows.
+
+Each sample draws its next token from the model's distribution over the allowed
+tokens, sharpened or flattened by a temperature and optionally cut off to the
+smallest set of tokens covering `top_p` of the probability (nucleus sampling).
+The samples of a datum run concurrently, so with `max_batch_size` their model
+calls at each step are batched together. Each sample has its own random number
+generator seeded from `seed` and its index, so the results don't depend on how
+the calls were batched."""
+import asyncio
+from dataclasses import dataclass
+from typing import Callable, Dict, Generic, List, Optional, Tuple
+
+import torch
+
+from clamp.decoding.partial_parse import PartialParse
+from clamp.search.datum import DatumSub
+from clamp.search.model import Model, ModelResult
+from clamp.search.problem import ConstrainedDecodingProblem, gnmt_length_normalization
+from clamp.search.problem_factory import ProblemFactory
+from clamp.search.search_node import FullSearchNode, PackedSearchNode
+from clamp.seq2seq.seq2seq_model import HS
+from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+
+
+def sample_index(
+    logprobs: torch.Tensor,
+    temperature: float,
+    top_p: float,
+    generator: torch.Generator,
+) -> int:
+    """Samples an index of the 1D tensor `logprobs`.
+
+    A temperature of 0 picks the most likely index."""
+    if temperature == 0:
+        return int(torch.argmax(logprobs).item())
+    probs = torch.softmax(logprobs.float() / temperature, dim=0)
+    if top_p < 1:
+        sorted_probs, order = torch.sort(probs, descending=True)
+        # Keeps the most likely indices until their total reaches top_p.
+        keep = torch.cumsum(sorted_probs, dim=0) - sorted_probs < top_p
+        probs = torch.zeros_like(probs)
+        probs[order[keep]] = sorted_probs[keep]
+    return int(torch.multinomial(probs, 1, generator=generator).item())
+
+
+@dataclass
+class SamplingSemanticParser(Model[DatumSub], Generic[DatumSub, HS]):
+    problem_factory: ProblemFactory[DatumSub, HS]
+    tokenizer: ClampTokenizer
+
+    num_samples: int
+    temperature: float = 1.0
+    # If below 1, sample from the most likely tokens that cover this much probability.
+    top_p: float = 1.0
+    seed: int = 0
+    # Samples which don't finish within this many steps are dropped.
+    max_steps_fn: Optional[Callable[[DatumSub], Optional[int]]] = None
+
+    async def predict(self, test_datum: DatumSub) -> List[ModelResult]:
+        """Returns the distinct samples, in order of increasing cost.
+
+        As in beam search, the cost is the length-normalized negative log
+        probability under the model, without the temperature or top_p."""
+        problem = self.problem_factory.problem
+        if not isinstance(problem, ConstrainedDecodingProblem):
+            raise TypeError(
+                f"Sampling needs a ConstrainedDecodingProblem, not {type(problem).__name__}"
+            )
+        max_steps = self.max_steps_fn(test_datum) if self.max_steps_fn else None
+
+        initial = self.problem_factory.initial(test_datum)
+        partial_parse, hidden_state, existing_logprobs = await problem.unpacker(initial)
+        next_logprobs = await problem.model.next_logprobs(hidden_state)
+        samples = await asyncio.gather(
+            *[
+                self._sample(
+                    problem,
+                    initial,
+                    partial_parse,
+                    hidden_state,
+                    next_logprobs,
+                    -sum(existing_logprobs),
+                    max_steps,
+                    torch.Generator().manual_seed(self.seed + i),
+                )
+                for i in range(self.num_samples)
+            ]
+        )
+
+        distinct: Dict[Tuple[int, ...], FullSearchNode[HS]] = {}
+        for sample in samples:
+            if sample is not None:
+                distinct.setdefault(sample.tokens, sample)
+        return [
+            self._to_model_result(node)
+            for node in sorted(distinct.values(), key=lambda n: n.cost)
+        ]
+
+    async def _sample(
+        self,
+        problem: ConstrainedDecodingProblem[HS, PackedSearchNode],
+        packed_node: PackedSearchNode,
+        partial_parse: PartialParse,
+        hidden_state: HS,
+        next_logprobs: torch.Tensor,
+        unnormalized_cost: float,
+        max_steps: Optional[int],
+        generator: torch.Generator,
+    ) -> Optional[FullSearchNode[HS]]:
+        """Returns the finished node, or None if the sample ran out of steps or
+        reached a prefix that the grammar can't extend or end."""
+        token_costs: List[float] = []
+        eos = problem.eos.to(next_logprobs.device)
+        while max_steps is None or len(token_costs) < max_steps:
+            allowed_next, can_end = partial_parse.allowed_next()
+            if allowed_next is None:
+                candidates = torch.arange(next_logprobs.shape[0])
+            else:
+                candidates = allowed_next.to(next_logprobs.device)
+            candidates = candidates[(candidates[:, None] != eos[None, :]).all(dim=1)]
+            candidate_logprobs = next_logprobs[candidates]
+            if can_end:
+                # Ending is one more candidate, with the total probability of the EOS tokens.
+                candidate_logprobs = torch.cat(
+                    [
+                        candidate_logprobs,
+                        torch.logsumexp(next_logprobs[eos], dim=0)[None],
+                    ]
+                )
+            if candidate_logprobs.shape[0] == 0:
+                return None
+
+            index = sample_index(
+                candidate_logprobs, self.temperature, self.top_p, generator
+            )
+            logprob = candidate_logprobs[index].item()
+            unnormalized_cost -= logprob
+            token_costs.append(-logprob)
+            if index == candidates.shape[0]:
+                return FullSearchNode(
+                    packed_node,
+                    partial_parse,
+                    hidden_state=None,
+                    is_finished=True,
+                    cost=gnmt_length_normalization(
+                        problem.length_normalization,
+                        unnormalized_cost,
+                        len(packed_node.tokens) + 1,
+                    ),
+                    unnormalized_cost=unnormalized_cost,
+                    token_costs=token_costs,
+                )
+
+            token = int(candidates[index].item())
+            packed_node = packed_node.append(token)
+            partial_parse = partial_parse.append(token)
+            logprobs, hidden_state = await problem.model.extend([token], hidden_state)
+            next_logprobs = logprobs[0]  # Remove the sequence dimension
+        return None
+
+    def _to_model_result(self, node: FullSearchNode[HS]) -> ModelResult:
+        text = self.problem_factory.decoding_setup.finalize(node.tokens)  # type: ignore
+        token_costs = [
+            (self.tokenizer.id_to_utf8_token_map[t], cost)
+            for t, cost in zip(node.tokens, node.token_costs)
+        ]
+        return ModelResult(text, node.cost, token_costs)
@@ -77,6 +77,10 @@ class FullSearchNode(Generic[HS]):
     cost: float = 0
     unnormalized_cost: float = 0
     token_costs: List[float] = dataclasses.field(default_factory=list)
+    # The number of trailing tokens that `hidden_state` hasn't consumed yet.
+    # Nodes from cached expansions have their parent's hidden state, so it is more
+    # than 1 for them; the model runs on all of the pending tokens at once.
+    num_pending_tokens: int = 1
 
     @property
     def tokens(self) -> Tuple[int, ...]:
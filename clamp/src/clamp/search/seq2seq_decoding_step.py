@@ -104,26 +104,17 @@ class Seq2SeqDecodingSetup(DecodingSetup[DatumSub, HS]):
         self, packed_node: DatumPackedSearchNode
     ) -> Tuple[PartialParse, HS, Sequence[float]]:
         decoder_tokens = self.seq2seq_model.decoder_bos_ids + list(packed_node.tokens)
-        logprobs, hidden_state = await self.seq2seq_model.initial(
+        token_logprobs, hidden_state = await self.seq2seq_model.initial_scored(
             self.seq2seq_model.encode_for_encoder(packed_node.test_datum.natural),
             decoder_tokens,
+            num_scored=len(packed_node.tokens),
         )
-        assert hidden_state is not None
         # https://github.com/python/mypy/issues/708
         initial_partial_parse = self.partial_parse_builder(packed_node.test_datum)  # type: ignore
         for token in packed_node.tokens:
             initial_partial_parse = initial_partial_parse.append(token)
 
-        return (
-            initial_partial_parse,
-            hidden_state,
-            logprobs[
-                list(
-                    range(len(self.seq2seq_model.decoder_bos_ids), len(decoder_tokens))
-                ),
-                list(packed_node.tokens),
-            ].tolist(),
-        )
+        return initial_partial_parse, hidden_state, token_logprobs
 
     def finalize(self, tokens: List[int]) -> str:
         return self.seq2seq_model.decode_output(tokens)
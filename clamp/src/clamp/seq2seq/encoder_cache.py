@@ -0,0 +1,144 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Caches the encoder outputs of a seq2seq model for each input.
+
+The same input is encoded whenever a search is set up for it, whenever a search
+node is unpacked, and again for every configuration in a sweep over the same
+data. `EncoderCache` keeps recently used encoder outputs in memory, and can also
+write them to a directory as .npy files, which later runs memory-map instead of
+running the encoder again.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+@dataclass(frozen=True)
+class EncoderCacheStats:
+    hits: int
+    # Misses in memory which were found on disk.
+    disk_hits: int
+    misses: int
+    evictions: int
+    num_entries: int
+    nbytes: int
+
+
+class EncoderCache:
+    """LRU cache of encoder outputs in memory, up to `max_bytes`, keyed by the encoder tokens.
+
+    If `directory` is given, every entry is also written there, and entries missing
+    from memory are memory-mapped from there. `namespace` should identify the model,
+    including its precision, since entries are otherwise keyed only by the tokens."""
+
+    def __init__(
+        self, namespace: str, max_bytes: int, directory: Optional[Path] = None
+    ):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.directory: Optional[Path] = None
+        if directory is not None:
+            self.directory = (
+                directory / hashlib.sha1(namespace.encode("utf-8")).hexdigest()
+            )
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: Tuple[int, ...]) -> Path:
+        assert self.directory is not None
+        digest = hashlib.sha1(np.array(key, dtype="<i4").tobytes()).hexdigest()
+        return self.directory / f"{digest}.npy"
+
+    def get(
+        self, encoder_tokens: Sequence[int], dtype: torch.dtype, device: torch.device
+    ) -> Optional[torch.Tensor]:
+        """Returns the encoder outputs for `encoder_tokens`, of shape (sequence_length, embed_size).
+
+        Outputs read from disk are converted to `dtype` and moved to `device`."""
+        key = tuple(encoder_tokens)
+        encoder_outputs = self._entries.get(key)
+        if encoder_outputs is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return encoder_outputs
+
+        if self.directory is not None:
+            path = self._path(key)
+            if path.exists():
+                self.disk_hits += 1
+                # Copy-on-write, so that the tensor is writable without copying the file.
+                array = np.load(path, mmap_mode="c")
+                encoder_outputs = torch.from_numpy(array).to(device=device, dtype=dtype)
+                self._insert(key, encoder_outputs)
+                return encoder_outputs
+
+        self.misses += 1
+        return None
+
+    def put(self, encoder_tokens: Sequence[int], encoder_outputs: torch.Tensor) -> None:
+        key = tuple(encoder_tokens)
+        self._insert(key, encoder_outputs)
+        if self.directory is not None:
+            path = self._path(key)
+            if not path.exists():
+                # Write to a temporary file first, so that readers never see a partial file.
+                tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, "wb") as f:
+                    np.save(f, encoder_outputs.detach().float().cpu().numpy())
+                os.replace(tmp_path, path)
+
+    def _insert(self, key: Tuple[int, ...], encoder_outputs: torch.Tensor) -> None:
+        existing = self._entries.pop(key, None)
+        if existing is not None:
+            self._nbytes -= _nbytes(existing)
+        self._entries[key] = encoder_outputs
+        self._nbytes += _nbytes(encoder_outputs)
+        while self._nbytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= _nbytes(evicted)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> EncoderCacheStats:
+        return EncoderCacheStats(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            num_entries=len(self._entries),
+            nbytes=self._nbytes,
+        )
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
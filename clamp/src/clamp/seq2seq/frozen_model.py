@@ -0,0 +1,180 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Model weights stored in one flat file that can be memory-mapped.
+
+`from_pretrained` unpickles the whole state dict and copies it into a randomly
+initialized model. A frozen checkpoint maps its weights file instead and uses
+slices of it as the parameters, so loading does no copying or initialization;
+pages are read from disk, or shared from the page cache, when first used."""
+import functools
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Type, TypeVar
+
+import numpy as np
+import torch
+from transformers import PreTrainedModel
+from transformers.modeling_utils import no_init_weights
+
+WEIGHTS_FILE = "weights.bin"
+INDEX_FILE = "weights.json"
+# Byte alignment of each tensor within WEIGHTS_FILE.
+_ALIGNMENT = 64
+
+M = TypeVar("M", bound=PreTrainedModel)
+
+# Functions which torch modules use to initialize their parameters.
+_TORCH_INIT_FUNCTIONS = (
+    "uniform_",
+    "normal_",
+    "trunc_normal_",
+    "constant_",
+    "xavier_uniform_",
+    "xavier_normal_",
+    "kaiming_uniform_",
+    "kaiming_normal_",
+    "orthogonal_",
+)
+
+
+def source_signature(model_loc: Path) -> Dict[str, List[int]]:
+    """The size and modification time of each file in `model_loc`, to detect
+    a frozen checkpoint that is older than the model it came from."""
+    return {
+        path.name: [path.stat().st_size, path.stat().st_mtime_ns]
+        for path in sorted(model_loc.iterdir())
+        if path.is_file()
+    }
+
+
+@contextmanager
+def _skip_init() -> Iterator[None]:
+    """Skips initializing parameters while constructing a model, both by
+    transformers and by torch modules like nn.Linear."""
+    originals = {
+        name: getattr(torch.nn.init, name)
+        for name in _TORCH_INIT_FUNCTIONS
+        if hasattr(torch.nn.init, name)
+    }
+    for name in originals:
+        setattr(torch.nn.init, name, lambda tensor, *_args, **_kwargs: tensor)
+    try:
+        with no_init_weights():
+            yield
+    finally:
+        for name, original in originals.items():
+            setattr(torch.nn.init, name, original)
+
+
+def _named_tensors(model: torch.nn.Module) -> Iterator[Tuple[str, torch.Tensor]]:
+    # named_parameters skips tied parameters after their first occurrence.
+    yield from model.named_parameters()
+    yield from model.named_buffers()
+
+
+def save_frozen_model(
+    model: PreTrainedModel, directory: Path, source: Dict[str, List[int]]
+) -> None:
+    """Writes `model` to `directory`, to be loaded with `load_frozen_model`.
+
+    `source` is the `source_signature` of the directory the model was loaded from."""
+    directory.mkdir(parents=True, exist_ok=True)
+    model.config.save_pretrained(str(directory))
+    entries: List[Dict[str, Any]] = []
+    offset = 0
+    tmp_path = directory / f"{WEIGHTS_FILE}.tmp"
+    with open(tmp_path, "wb") as f:
+        for name, tensor in _named_tensors(model):
+            if tensor.dtype == torch.bfloat16:
+                raise ValueError(f"Can't freeze {name}: numpy has no bfloat16")
+            array = tensor.detach().cpu().contiguous().numpy()
+            padding = -offset % _ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            entries.append(
+                {
+                    "name": name,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "offset": offset,
+                }
+            )
+            f.write(array.tobytes())
+            offset += array.nbytes
+    os.replace(tmp_path, directory / WEIGHTS_FILE)
+    with open(directory / INDEX_FILE, "w") as f:
+        json.dump(
+            {
+                "model_class": type(model).__name__,
+                "source": source,
+                "tensors": entries,
+            },
+            f,
+        )
+
+
+def read_frozen_index(directory: Path) -> Dict[str, Any]:
+    with open(directory / INDEX_FILE) as f:
+        return json.load(f)
+
+
+def load_frozen_model(model_class: Type[M], directory: Path) -> M:
+    """Loads a model written by `save_frozen_model`.
+
+    The weights are mapped copy-on-write, so modifying them in place (e.g. with
+    `model.to(dtype)`) doesn't change the file."""
+    index = read_frozen_index(directory)
+    if index["model_class"] != model_class.__name__:
+        raise ValueError(
+            f"{directory} contains a {index['model_class']}, not a {model_class.__name__}"
+        )
+    config = model_class.config_class.from_pretrained(str(directory))
+    with _skip_init():
+        model = model_class(config)
+
+    weights = np.memmap(directory / WEIGHTS_FILE, dtype=np.uint8, mode="c")
+    for entry in index["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        start = entry["offset"]
+        end = start + int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        tensor = torch.from_numpy(weights[start:end].view(dtype).reshape(shape))
+        _set_tensor(model, entry["name"], tensor)
+    # The tied parameters still refer to the ones that were replaced.
+    model.tie_weights()
+    return model
+
+
+def _set_tensor(model: torch.nn.Module, name: str, tensor: torch.Tensor) -> None:
+    module_path, _, attr = name.rpartition(".")
+    module = functools.reduce(
+        getattr, module_path.split(".") if module_path else [], model
+    )
+    existing = getattr(module, attr)
+    if existing.shape != tensor.shape:
+        raise ValueError(
+            f"{name} has shape {tuple(tensor.shape)} in the frozen checkpoint, "
+            f"but {tuple(existing.shape)} in the model"
+        )
+    if isinstance(existing, torch.nn.Parameter):
+        tensor = torch.nn.Parameter(tensor, requires_grad=False)
+    setattr(module, attr, tensor)
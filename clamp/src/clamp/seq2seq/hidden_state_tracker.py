@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterable, List, Tuple
+
+import torch
+
+# Identifies a storage while it is alive: its device and data pointer.
+# Pointers on different devices can be equal, and a pointer can be reused once
+# its storage is freed.
+StorageKey = Tuple[str, int]
+
+
+def _storage_key_and_nbytes(tensor: torch.Tensor) -> Tuple[StorageKey, int]:
+    device = str(tensor.device)
+    # Newer versions of PyTorch deprecate `Tensor.storage` in favor of `untyped_storage`.
+    if hasattr(tensor, "untyped_storage"):
+        untyped = tensor.untyped_storage()
+        return (device, untyped.data_ptr()), untyped.nbytes()
+    storage = tensor.storage()
+    return (device, storage.data_ptr()), storage.size() * storage.element_size()
+
+
+def storage_nbytes(tensors: Iterable[torch.Tensor]) -> int:
+    """Total size of the storage underlying `tensors`, counting shared storage once."""
+    sizes = dict(_storage_key_and_nbytes(tensor) for tensor in tensors)
+    return sum(sizes.values())
+
+
+@dataclass(frozen=True)
+class HiddenStateStats:
+    """Snapshot of the hidden states a model has produced which are still alive."""
+
+    num_live: int
+    # Bytes of tensor storage referenced by live hidden states.
+    # Storage shared between several hidden states is only counted once.
+    live_bytes: int
+    # Highest value of `live_bytes` since the last `HiddenStateTracker.reset_peak`.
+    peak_bytes: int
+    num_created: int
+    num_released: int
+
+
+class HiddenStateTracker:
+    """Accounts for the memory held by hidden states.
+
+    Hidden states are owned by the search nodes that reference them, and are
+    freed by reference counting as soon as the last such node is dropped.
+    The tracker observes this with `weakref.finalize` rather than holding on
+    to the hidden states itself.
+
+    Hidden states can be created and freed on several threads, e.g. when the model
+    runs on an executor. Finalizers can also run in the middle of `track` when the
+    garbage collector kicks in, so they only queue the release, which is applied
+    under the lock before the tracker is next used. A storage is only freed after
+    the finalizers of the hidden states using it have run, so its entry is gone
+    before another storage can be tracked at the same address."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Storage key -> (number of live hidden states using it, size in bytes)
+        self._storages: Dict[StorageKey, Tuple[int, int]] = {}
+        # Storage keys of hidden states which were freed but not yet released.
+        self._pending_releases: Deque[List[StorageKey]] = collections.deque()
+        self._num_live = 0
+        self._live_bytes = 0
+        self._peak_bytes = 0
+        self._num_created = 0
+        self._num_released = 0
+
+    def track(self, hidden_state: Any, tensors: Iterable[torch.Tensor]) -> None:
+        """Starts accounting for `hidden_state`, which references `tensors`, until it is garbage."""
+        storages: Dict[StorageKey, int] = {}
+        for tensor in tensors:
+            key, nbytes = _storage_key_and_nbytes(tensor)
+            storages.setdefault(key, nbytes)
+
+        with self._lock:
+            self._apply_pending_releases()
+            for key, storage_nbytes in storages.items():
+                count, nbytes = self._storages.get(key, (0, storage_nbytes))
+                if count == 0:
+                    self._live_bytes += nbytes
+                self._storages[key] = (count + 1, nbytes)
+
+            self._num_live += 1
+            self._num_created += 1
+            self._peak_bytes = max(self._peak_bytes, self._live_bytes)
+        weakref.finalize(hidden_state, self._pending_releases.append, list(storages))
+
+    def _apply_pending_releases(self) -> None:
+        """Must be called with `_lock` held."""
+        while self._pending_releases:
+            for key in self._pending_releases.popleft():
+                count, nbytes = self._storages[key]
+                if count == 1:
+                    del self._storages[key]
+                    self._live_bytes -= nbytes
+                else:
+                    self._storages[key] = (count - 1, nbytes)
+            self._num_live -= 1
+            self._num_released += 1
+
+    def stats(self) -> HiddenStateStats:
+        with self._lock:
+            self._apply_pending_releases()
+            return HiddenStateStats(
+                num_live=self._num_live,
+                live_bytes=self._live_bytes,
+                peak_bytes=self._peak_bytes,
+                num_created=self._num_created,
+                num_released=self._num_released,
+            )
+
+    def reset_peak(self) -> None:
+        with self._lock:
+            self._apply_pending_releases()
+            self._peak_bytes = self._live_bytes
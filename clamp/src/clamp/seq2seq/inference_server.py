@@ -0,0 +1,445 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Serves one seq2seq model to several decoding processes on the same machine.
+
+Decoding is CPU-bound in Python (parsing and search) as well as in the model, so
+running several decoding processes helps, but each would load its own copy of the
+weights. Instead, `InferenceServer` loads the model once in a server process, and each
+decoding process uses a `RemoteSeq2SeqModel` which sends it `initial`/`extend`
+requests over torch.multiprocessing queues. Tensors sent through the queues are
+moved to shared memory rather than copied through a pipe.
+
+Hidden states stay in the server, and clients refer to them by ID. When the last
+reference to a `RemoteState` is dropped, the client tells the server to free it.
+Requests from different clients are batched together by the server model, e.g.
+Seq2SeqBart with `max_batch_size`.
+
+If the server process exits, e.g. because it ran out of memory, the pending and
+later requests of its clients fail with `InferenceServerExited`; the process that
+started the server must call `InferenceServer.check` regularly to notice a crash.
+"""
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import traceback
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.multiprocessing
+
+from clamp.async_tools.batch_helper import mark_submitted
+from clamp.seq2seq.seq2seq_helper import Seq2SeqHelper
+from clamp.seq2seq.seq2seq_model import Seq2SeqModel
+from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+
+# Client ID, request ID, method name, and arguments.
+Request = Tuple[int, int, str, Tuple[Any, ...]]
+# Request ID, result, and the formatted exception if the request failed.
+Response = Tuple[int, Any, Optional[str]]
+
+# How often clients check whether the server has exited while they wait.
+_POLL_SECONDS = 1.0
+
+
+class InferenceServerExited(RuntimeError):
+    pass
+
+
+@dataclass
+class ServerConnection:
+    """What a client process needs to talk to the server; picklable for passing to it."""
+
+    client_id: int
+    requests: Any  # torch.multiprocessing.Queue of Request
+    responses: Any  # torch.multiprocessing.Queue of Response
+    # A torch.multiprocessing.Event, set once the server has exited.
+    server_exited: Any
+
+
+class RemoteState:
+    """A hidden state held by the server."""
+
+    __slots__ = ("state_id", "__weakref__")
+
+    def __init__(self, state_id: int):
+        self.state_id = state_id
+
+    def __repr__(self) -> str:
+        return f"RemoteState({self.state_id})"
+
+
+class _Server:
+    def __init__(self, model: Seq2SeqModel, requests: Any, responses: List[Any]):
+        self.model = model
+        self.requests = requests
+        self.responses = responses
+        self.states: Dict[int, Any] = {}
+        self.next_state_id = itertools.count()
+
+    def _add_state(self, state: Any) -> Optional[int]:
+        if state is None:
+            return None
+        state_id = next(self.next_state_id)
+        self.states[state_id] = state
+        return state_id
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            request: Optional[Request] = await loop.run_in_executor(
+                None, self.requests.get
+            )
+            if request is None:
+                return
+            client_id, request_id, method, args = request
+            if method == "release":
+                self.states.pop(args[0], None)
+            else:
+                asyncio.ensure_future(self._handle(client_id, request_id, method, args))
+
+    async def _handle(
+        self, client_id: int, request_id: int, method: str, args: Tuple[Any, ...]
+    ) -> None:
+        response: Response
+        try:
+            result = await getattr(self, f"_{method}")(*args)
+            response = (request_id, result, None)
+        except Exception:  # pylint: disable=broad-except
+            response = (request_id, None, traceback.format_exc())
+        self.responses[client_id].put(response)
+
+    # The log probabilities are copied so that they don't share storage with the rest of a batch.
+
+    async def _initial(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        drop_next_hidden_state: bool,
+    ) -> Tuple[torch.Tensor, Optional[int]]:
+        logprobs, state = await self.model.initial(
+            encoder_tokens, decoder_tokens, drop_next_hidden_state
+        )
+        return logprobs.clone(), self._add_state(state)
+
+    async def _extend(
+        self, tokens: Sequence[int], state_id: int, drop_next_hidden_state: bool
+    ) -> Tuple[torch.Tensor, Optional[int]]:
+        logprobs, state = await self.model.extend(
+            tokens, self.states[state_id], drop_next_hidden_state
+        )
+        return logprobs.clone(), self._add_state(state)
+
+    async def _initial_scored(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        num_scored: int,
+    ) -> Tuple[List[float], Optional[int]]:
+        token_logprobs, state = await self.model.initial_scored(
+            encoder_tokens, decoder_tokens, num_scored
+        )
+        return token_logprobs, self._add_state(state)
+
+    async def _extend_next_logprobs(
+        self,
+        tokens: Sequence[int],
+        state_id: int,
+        allowed_token_ids: Optional[torch.Tensor],
+        exact_normalizer: bool,
+    ) -> Tuple[torch.Tensor, Optional[int]]:
+        logprobs, state = await self.model.extend_next_logprobs(
+            tokens, self.states[state_id], allowed_token_ids, exact_normalizer
+        )
+        return logprobs.clone(), self._add_state(state)
+
+    async def _next_logprobs(self, state_id: int) -> torch.Tensor:
+        return (await self.model.next_logprobs(self.states[state_id])).clone()
+
+
+def _serve(
+    model_factory: Callable[[], Seq2SeqModel],
+    requests: Any,
+    responses: List[Any],
+    server_exited: Any,
+) -> None:
+    try:
+        torch.set_grad_enabled(False)
+        model = model_factory()
+        asyncio.run(_Server(model, requests, responses).run())
+    finally:
+        server_exited.set()
+
+
+@dataclass
+class InferenceServer:
+    """A process serving the model created by `model_factory`.
+
+    Use as a context manager, which stops the server on exit."""
+
+    process: Any
+    # One for each client.
+    connections: List[ServerConnection]
+
+    @staticmethod
+    def start(
+        model_factory: Callable[[], Seq2SeqModel], num_clients: int
+    ) -> "InferenceServer":
+        """`model_factory` must be picklable, e.g. a functools.partial of a module-level function."""
+        # Forking a process after torch has started its thread pools can deadlock.
+        context = torch.multiprocessing.get_context("spawn")
+        requests = context.Queue()
+        responses = [context.Queue() for _ in range(num_clients)]
+        server_exited = context.Event()
+        process = context.Process(
+            target=_serve,
+            args=(model_factory, requests, responses, server_exited),
+            daemon=True,
+        )
+        process.start()
+        return InferenceServer(
+            process,
+            [
+                ServerConnection(i, requests, responses[i], server_exited)
+                for i in range(num_clients)
+            ],
+        )
+
+    def check(self) -> None:
+        """Lets the clients know if the server has exited, even if it was killed."""
+        if not self.process.is_alive():
+            self.connections[0].server_exited.set()
+
+    def stop(self) -> None:
+        """Stops the server once it has received the requests sent so far."""
+        if self.process.is_alive():
+            self.connections[0].requests.put(None)
+        self.process.join()
+
+    def __enter__(self) -> "InferenceServer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+@dataclass
+class RemoteSeq2SeqModel(Seq2SeqModel[RemoteState]):
+    """A Seq2SeqModel running in the server of `connection`.
+
+    Tokenization happens locally, with the same settings as Seq2SeqBart."""
+
+    pretrained_model_dir: str
+    clamp_tokenizer: ClampTokenizer
+    connection: ServerConnection
+
+    seq2seq_helper: Seq2SeqHelper = field(init=False)
+    _futures: Dict[int, "asyncio.Future[Any]"] = field(init=False, default_factory=dict)
+    _next_request_id: Any = field(init=False, default_factory=itertools.count)
+    _reader: Optional[threading.Thread] = field(init=False, default=None)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _closed: bool = field(init=False, default=False)
+
+    def __post_init__(self):
+        with open(
+            os.path.join(self.pretrained_model_dir, "seq2seq_settings.json")
+        ) as settings_f:
+            self.seq2seq_helper = Seq2SeqHelper.from_settings_json(
+                settings_f.read(), self.clamp_tokenizer
+            )
+
+    @property
+    def vocab_size(self) -> int:
+        return self.clamp_tokenizer.vocab_size
+
+    @property
+    def tokenizer(self) -> ClampTokenizer:
+        return self.clamp_tokenizer
+
+    @property
+    def decoder_bos_ids(self) -> List[int]:
+        return self.seq2seq_helper.decoder_start_token_ids
+
+    @property
+    def decoder_eos_id(self) -> int:
+        return self.seq2seq_helper.decoder_eos_token_id
+
+    def encode_for_encoder(self, s: str) -> List[int]:
+        return self.seq2seq_helper.encode_for_encoder(s)
+
+    def encode_prefix_for_decoder(
+        self, s: str, include_bos_ids: bool = True
+    ) -> List[int]:
+        return self.seq2seq_helper.encode_prefix_for_decoder(s, include_bos_ids)
+
+    def decode_output(self, ids: Sequence[int]) -> str:
+        return self.seq2seq_helper.decode_output(ids)
+
+    async def initial(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        drop_next_hidden_state: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[RemoteState]]:
+        logprobs, state_id = await self._call(
+            "initial",
+            list(encoder_tokens),
+            list(decoder_tokens),
+            drop_next_hidden_state,
+        )
+        return logprobs, self._state(state_id)
+
+    async def extend(
+        self,
+        tokens: Sequence[int],
+        hidden_state: RemoteState,
+        drop_next_hidden_state: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[RemoteState]]:
+        logprobs, state_id = await self._call(
+            "extend", list(tokens), hidden_state.state_id, drop_next_hidden_state
+        )
+        return logprobs, self._state(state_id)
+
+    async def initial_scored(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        num_scored: int,
+    ) -> Tuple[List[float], RemoteState]:
+        token_logprobs, state_id = await self._call(
+            "initial_scored", list(encoder_tokens), list(decoder_tokens), num_scored
+        )
+        state = self._state(state_id)
+        assert state is not None
+        return token_logprobs, state
+
+    async def extend_next_logprobs(
+        self,
+        tokens: Sequence[int],
+        hidden_state: RemoteState,
+        allowed_token_ids: Optional[torch.Tensor] = None,
+        exact_normalizer: bool = True,
+    ) -> Tuple[torch.Tensor, RemoteState]:
+        logprobs, state_id = await self._call(
+            "extend_next_logprobs",
+            list(tokens),
+            hidden_state.state_id,
+            allowed_token_ids,
+            exact_normalizer,
+        )
+        state = self._state(state_id)
+        assert state is not None
+        return logprobs, state
+
+    async def next_logprobs(self, hidden_state: RemoteState) -> torch.Tensor:
+        return await self._call("next_logprobs", hidden_state.state_id)
+
+    @property
+    def server_exited(self) -> bool:
+        return self.connection.server_exited.is_set()
+
+    def close(self) -> None:
+        """Stops reading responses. The hidden states from this client are no longer released."""
+        self._closed = True
+        if self._reader is not None:
+            self.connection.responses.put(None)
+            self._reader.join()
+            self._reader = None
+
+    def _state(self, state_id: Optional[int]) -> Optional[RemoteState]:
+        if state_id is None:
+            return None
+        state = RemoteState(state_id)
+        weakref.finalize(state, self._release, state_id)
+        return state
+
+    def _release(self, state_id: int) -> None:
+        if not self._closed and not self.server_exited:
+            self.connection.requests.put(
+                (self.connection.client_id, -1, "release", (state_id,))
+            )
+
+    async def _call(self, method: str, *args: Any) -> Any:
+        assert not self._closed
+        if self.server_exited:
+            raise InferenceServerExited("The inference server has exited")
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read_responses, daemon=True)
+            self._reader.start()
+        future = asyncio.get_event_loop().create_future()
+        # Register the future before sending, so that the response can't arrive first.
+        with self._lock:
+            request_id = next(self._next_request_id)
+            self._futures[request_id] = future
+        self.connection.requests.put(
+            (self.connection.client_id, request_id, method, args)
+        )
+        # The server batches the requests of all clients.
+        mark_submitted()
+        return await future
+
+    def _read_responses(self) -> None:
+        while True:
+            # Responses may still be in flight just after the server has exited, so
+            # only give up after a full poll once it has.
+            server_exited = self.server_exited
+            try:
+                response: Optional[Response] = self.connection.responses.get(
+                    timeout=_POLL_SECONDS
+                )
+            except queue.Empty:
+                if server_exited:
+                    self._fail_pending()
+                    return
+                continue
+            if response is None:
+                return
+            request_id, result, error = response
+            with self._lock:
+                future = self._futures.pop(request_id)
+            future.get_loop().call_soon_threadsafe(_set_future, future, result, error)
+
+    def _fail_pending(self) -> None:
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(
+                _fail_future,
+                future,
+                InferenceServerExited("The inference server exited"),
+            )
+
+
+def _set_future(future: "asyncio.Future[Any]", result: Any, error: Optional[str]):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(RuntimeError(f"Inference server error:\n{error}"))
+    else:
+        future.set_result(result)
+
+
+def _fail_future(future: "asyncio.Future[Any]", error: Exception):
+    if not future.cancelled():
+        future.set_exception(error)
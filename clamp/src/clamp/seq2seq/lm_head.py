@@ -0,0 +1,145 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Runs the output projection of seq2seq models separately from the decoder.
+
+This lets us skip projecting positions whose logits aren't needed, and project
+the rest onto only the tokens that a grammar allows."""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import torch
+from torch.nn import functional as F
+from transformers import (
+    BartForConditionalGeneration,
+    PreTrainedModel,
+    T5ForConditionalGeneration,
+)
+
+from clamp.seq2seq.seq2seq_model import restrict_logprobs
+
+
+@dataclass
+class LMHead:
+    model: PreTrainedModel
+    weight: torch.Tensor
+    bias: Optional[torch.Tensor] = None
+    # Applied to the decoder outputs before the projection.
+    scale: float = 1.0
+
+    @staticmethod
+    def from_model(model: PreTrainedModel) -> "Optional[LMHead]":
+        """Returns None if `model` isn't an architecture that we know how to split."""
+        lm_head = getattr(model, "lm_head", None)
+        if not isinstance(getattr(lm_head, "weight", None), torch.Tensor):
+            # e.g. the LM head was quantized.
+            return None
+        if isinstance(model, T5ForConditionalGeneration):
+            if model.model_parallel:
+                return None
+            return LMHead(
+                model,
+                model.lm_head.weight,
+                scale=model.model_dim ** -0.5
+                if model.config.tie_word_embeddings
+                else 1.0,
+            )
+        if isinstance(model, BartForConditionalGeneration):
+            return LMHead(model, model.lm_head.weight, bias=model.final_logits_bias[0])
+        return None
+
+    @property
+    def vocab_size(self) -> int:
+        return self.weight.shape[0]
+
+    def run_decoder(
+        self,
+        input_ids: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        decoder_input_ids: Optional[torch.Tensor] = None,
+        decoder_attention_mask: Optional[torch.Tensor] = None,
+        encoder_outputs: Optional[Any] = None,
+        past_key_values: Optional[Any] = None,
+    ) -> Dict[str, Any]:
+        """Like calling `model`, but returns `decoder_outputs` instead of `logits`."""
+        if isinstance(self.model, T5ForConditionalGeneration):
+            if encoder_outputs is None:
+                encoder_outputs = self.model.encoder(
+                    input_ids=input_ids, attention_mask=attention_mask
+                )
+            encoder_last_hidden_state = encoder_outputs[0]
+            outputs = self.model.decoder(
+                input_ids=decoder_input_ids,
+                attention_mask=decoder_attention_mask,
+                past_key_values=past_key_values,
+                encoder_hidden_states=encoder_last_hidden_state,
+                encoder_attention_mask=attention_mask,
+                use_cache=True,
+            )
+        else:
+            outputs = self.model.model(  # type: ignore[operator]
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                decoder_attention_mask=decoder_attention_mask,
+                encoder_outputs=encoder_outputs,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            encoder_last_hidden_state = outputs["encoder_last_hidden_state"]
+        return {
+            "decoder_outputs": outputs["last_hidden_state"],
+            "encoder_last_hidden_state": encoder_last_hidden_state,
+            "past_key_values": outputs["past_key_values"],
+        }
+
+    def logits(
+        self, decoder_outputs: torch.Tensor, token_ids: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Projects `decoder_outputs` onto `token_ids`, or the whole vocabulary if None."""
+        weight = self.weight if token_ids is None else self.weight[token_ids]
+        bias = self.bias
+        if bias is not None and token_ids is not None:
+            bias = bias[token_ids]
+        return F.linear(decoder_outputs * self.scale, weight, bias).float()
+
+    def logprobs(
+        self,
+        decoder_outputs: torch.Tensor,
+        allowed_token_ids: Optional[torch.Tensor] = None,
+        exact_normalizer: bool = True,
+    ) -> torch.Tensor:
+        """Log probabilities over the whole vocabulary; see `restrict_logprobs`.
+
+        Without `exact_normalizer`, only the rows of `allowed_token_ids` are projected."""
+        if allowed_token_ids is None or exact_normalizer:
+            return restrict_logprobs(
+                F.log_softmax(self.logits(decoder_outputs), dim=-1),
+                allowed_token_ids,
+            )
+        result = decoder_outputs.new_full(
+            decoder_outputs.shape[:-1] + (self.vocab_size,),
+            float("-inf"),
+            dtype=torch.float32,
+        )
+        result[..., allowed_token_ids] = F.log_softmax(
+            self.logits(decoder_outputs, allowed_token_ids), dim=-1
+        )
+        return result
@@ -0,0 +1,268 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A radix tree of decoder prefixes, for resuming decoding without rerunning the whole prefix.
+
+For each sequence of encoder tokens, the tree holds the decoder token sequences
+which have been run through the model, the log probability of each of their
+tokens, and the hidden states computed at the end of them. Since decoder
+key/value states for a prefix are a prefix of those for any continuation, any
+hidden state below a point in the tree can be truncated to resume from there.
+
+The cached hidden states stay alive while they are cached, on top of the ones
+that the search holds, so the cache can add up to `max_bytes` to the memory used
+by hidden states (and to HiddenStateTracker's live bytes). See `stats`.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Generic, List, Optional, Sequence, Tuple
+
+from clamp.seq2seq.seq2seq_model import HS
+
+
+class _RadixNode(Generic[HS]):
+    __slots__ = (
+        "parent",
+        "edge",
+        "logprobs",
+        "children",
+        "state",
+        "nbytes",
+        "encoder_tokens",
+    )
+
+    def __init__(
+        self,
+        parent: "Optional[_RadixNode[HS]]",
+        edge: Tuple[int, ...],
+        logprobs: Tuple[float, ...],
+    ):
+        self.parent = parent
+        # Tokens between `parent` and this node, and the log probability of each of them.
+        self.edge = edge
+        self.logprobs = logprobs
+        # Keyed by the first token of the child's edge.
+        self.children: Dict[int, _RadixNode[HS]] = {}
+        # Hidden state after all tokens up to the end of `edge`, if cached.
+        self.state: Optional[HS] = None
+        self.nbytes = 0
+        # Only set for the root.
+        self.encoder_tokens: Optional[Tuple[int, ...]] = None
+
+
+@dataclass
+class PrefixMatch(Generic[HS]):
+    # Number of leading decoder tokens found in the cache.
+    length: int
+    # Log probabilities of the first `length` decoder tokens.
+    # The first decoder token is given rather than predicted, so its log probability is 0.
+    token_logprobs: List[float]
+    # A hidden state for a sequence which begins with the first `length` decoder tokens.
+    # It may cover more tokens than that, in which case it needs to be truncated.
+    state: HS
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+@dataclass(frozen=True)
+class PrefixCacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    num_entries: int
+    # Bytes pinned by the cached hidden states, as measured by `PrefixCache.nbytes`.
+    nbytes: int
+
+
+class PrefixCache(Generic[HS]):
+    """Radix tree of decoder prefixes per encoder input, with LRU eviction of hidden states.
+
+    The total size of the cached hidden states, as measured by `nbytes`, is kept below `max_bytes`."""
+
+    def __init__(self, max_bytes: int, nbytes: Callable[[HS], int]):
+        self.max_bytes = max_bytes
+        self.nbytes = nbytes
+        self._roots: Dict[Tuple[int, ...], _RadixNode[HS]] = {}
+        # Nodes with a cached state, least recently used first.
+        self._lru: "OrderedDict[_RadixNode[HS], None]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def stats(self) -> PrefixCacheStats:
+        return PrefixCacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            num_entries=len(self._lru),
+            nbytes=self._total_bytes,
+        )
+
+    @staticmethod
+    def _walk(
+        root: _RadixNode[HS], tokens: Sequence[int]
+    ) -> Tuple[List[_RadixNode[HS]], int, int]:
+        """Follows `tokens` from `root` as far as possible.
+
+        Returns the nodes visited, the number of tokens matched, and how many
+        tokens of the last node's edge were matched."""
+        path = [root]
+        matched = 0
+        offset = 0
+        node = root
+        while matched < len(tokens):
+            child = node.children.get(tokens[matched])
+            if child is None:
+                break
+            offset = _common_prefix_length(child.edge, tokens[matched:])
+            matched += offset
+            path.append(child)
+            if offset < len(child.edge):
+                break
+            node = child
+        return path, matched, offset
+
+    def lookup(
+        self, encoder_tokens: Sequence[int], decoder_tokens: Sequence[int]
+    ) -> Optional[PrefixMatch[HS]]:
+        root = self._roots.get(tuple(encoder_tokens))
+        if root is None:
+            self.misses += 1
+            return None
+        path, matched, offset = self._walk(root, decoder_tokens)
+        if matched == 0:
+            self.misses += 1
+            return None
+
+        # Every leaf has a state, so some node at or below the end of the path does too.
+        node = path[-1]
+        while node.state is None:
+            node = next(iter(node.children.values()))
+        self._lru.move_to_end(node)
+        self.hits += 1
+
+        token_logprobs: List[float] = []
+        for n in path[1:-1]:
+            token_logprobs.extend(n.logprobs)
+        token_logprobs.extend(path[-1].logprobs[:offset])
+        return PrefixMatch(matched, token_logprobs, node.state)  # type: ignore
+
+    def insert(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        state: HS,
+        suffix_logprobs: Sequence[float],
+    ) -> bool:
+        """Caches `state`, the hidden state after `decoder_tokens`.
+
+        `suffix_logprobs` are the log probabilities of the last tokens of `decoder_tokens`.
+        The log probabilities of any earlier tokens must already be in the cache;
+        if they aren't, nothing is inserted and this returns False."""
+        if not decoder_tokens:
+            return False
+        root = self._roots.get(tuple(encoder_tokens))
+        if root is None:
+            root = self._roots[tuple(encoder_tokens)] = _RadixNode(None, (), ())
+            root.encoder_tokens = tuple(encoder_tokens)
+        path, matched, offset = self._walk(root, decoder_tokens)
+        num_missing = len(decoder_tokens) - matched
+        if num_missing > len(suffix_logprobs):
+            if not root.children:
+                del self._roots[tuple(encoder_tokens)]
+            return False
+
+        node = path[-1]
+        if offset < len(node.edge):
+            node = self._split(node, offset)
+        if num_missing:
+            leaf = _RadixNode(
+                node,
+                tuple(decoder_tokens[matched:]),
+                tuple(suffix_logprobs[len(suffix_logprobs) - num_missing :]),
+            )
+            node.children[leaf.edge[0]] = leaf
+            node = leaf
+
+        if node.state is not None:
+            self._total_bytes -= node.nbytes
+        node.state = state
+        node.nbytes = self.nbytes(state)
+        self._total_bytes += node.nbytes
+        self._lru[node] = None
+        self._lru.move_to_end(node)
+        self._evict()
+        return True
+
+    @staticmethod
+    def _split(node: _RadixNode[HS], offset: int) -> _RadixNode[HS]:
+        """Splits `node`'s edge after `offset` tokens, returning the new node in between."""
+        parent = node.parent
+        assert parent is not None
+        middle = _RadixNode(parent, node.edge[:offset], node.logprobs[:offset])
+        parent.children[middle.edge[0]] = middle
+        node.edge = node.edge[offset:]
+        node.logprobs = node.logprobs[offset:]
+        node.parent = middle
+        middle.children[node.edge[0]] = node
+        return middle
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._lru:
+            node, _ = self._lru.popitem(last=False)
+            self._total_bytes -= node.nbytes
+            node.state = None
+            node.nbytes = 0
+            self.evictions += 1
+            self._prune(node)
+
+    def _prune(self, node: _RadixNode[HS]) -> None:
+        """Removes nodes which no longer lead to a state, and merges unnecessary branch points."""
+        while node.parent is not None and node.state is None and not node.children:
+            parent = node.parent
+            del parent.children[node.edge[0]]
+            node = parent
+
+        if node.parent is None:
+            if not node.children:
+                assert node.encoder_tokens is not None
+                del self._roots[node.encoder_tokens]
+            return
+
+        if node.state is None and len(node.children) == 1:
+            (child,) = node.children.values()
+            child.edge = node.edge + child.edge
+            child.logprobs = node.logprobs + child.logprobs
+            child.parent = node.parent
+            node.parent.children[child.edge[0]] = child
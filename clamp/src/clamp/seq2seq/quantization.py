@@ -0,0 +1,62 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Reduced-precision variants of seq2seq models, for decoding on CPUs."""
+
+from enum import Enum
+
+import torch
+from transformers import PreTrainedModel
+
+
+class Precision(Enum):
+    FP32 = "fp32"
+    # Linear layers use int8 weights, with activations quantized on the fly.
+    INT8 = "int8"
+    # All weights and activations in bfloat16, if the CPU supports it.
+    BF16 = "bf16"
+
+
+def bf16_supported() -> bool:
+    """Whether this build of torch can run bfloat16 matrix multiplications on the CPU."""
+    try:
+        x = torch.ones(2, 2, dtype=torch.bfloat16)
+        return bool(torch.isfinite(torch.matmul(x, x).float()).all())
+    except RuntimeError:
+        return False
+
+
+def convert_model(model: PreTrainedModel, precision: Precision) -> PreTrainedModel:
+    """Returns `model` with its weights converted to `precision`.
+
+    Only supported on the CPU. The model may be modified in place."""
+    if precision == Precision.FP32:
+        return model
+    if model.device.type != "cpu":  # type: ignore[attr-defined]
+        raise ValueError(f"{precision.value} is only supported on the CPU")
+
+    if precision == Precision.BF16:
+        if not bf16_supported():
+            raise ValueError("bfloat16 is not supported by this build of torch")
+        model = model.to(torch.bfloat16)  # type: ignore[attr-defined]
+    else:
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    model.eval()  # type: ignore[attr-defined]
+    return model
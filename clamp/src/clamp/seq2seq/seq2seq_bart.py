@@ -17,24 +17,46 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
 import dataclasses
 import os
+from concurrent.futures import Executor
 from dataclasses import dataclass
-from typing import Any, List, Optional, Sequence, Tuple, cast
+from typing import Any, Iterator, List, Optional, Sequence, Tuple, cast
 
 import torch
 from cached_property import cached_property
 from torch.nn import functional as F
 from transformers import PreTrainedModel
 
-from clamp.async_tools.batch_helper import BatchingHelper, BatchMaker
+from clamp.async_tools.batch_helper import (
+    AdaptiveBatchingPolicy,
+    BatchingHelper,
+    BatchMaker,
+)
+from clamp.seq2seq.encoder_cache import EncoderCache
+from clamp.seq2seq.hidden_state_tracker import (
+    HiddenStateStats,
+    HiddenStateTracker,
+    storage_nbytes,
+)
+from clamp.seq2seq.lm_head import LMHead
+from clamp.seq2seq.prefix_cache import PrefixCache
 from clamp.seq2seq.seq2seq_helper import Seq2SeqHelper
 from clamp.seq2seq.seq2seq_model import Seq2SeqModel
+from clamp.seq2seq.traced_t5 import TracedT5
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.util.stage_timer import StageTimer, maybe_stage
 
 
 @dataclass
 class BartState:
+    """Hidden state of Seq2SeqBart after running the decoder on `decoder_tokens`.
+
+    Not referenced by Seq2SeqBart after it is returned, so it is freed as soon as
+    the search nodes which use it are dropped; `Seq2SeqBart.hidden_state_tracker`
+    counts the ones that are alive."""
+
     encoder_tokens: Tuple[int, ...]
     decoder_tokens: Tuple[int, ...]
     # Shape: (sequence_length, embed_size)
@@ -48,21 +70,85 @@ class BartState:
         Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor], ...
     ] = dataclasses.field(repr=False)
 
-    last_logprobs: torch.Tensor = dataclasses.field(repr=False)
+    # None if only `last_decoder_output` was computed; see Seq2SeqBart.split_lm_head.
+    last_logprobs: Optional[torch.Tensor] = dataclasses.field(repr=False)
+    # Output of the decoder for the last token, before the LM head.
+    # Only set if Seq2SeqBart.split_lm_head is enabled.
+    last_decoder_output: Optional[torch.Tensor] = dataclasses.field(
+        default=None, repr=False
+    )
+
+    def tensors(self) -> Iterator[torch.Tensor]:
+        yield self.encoder_outputs
+        for layer in self.past_key_values:
+            yield from layer
+        if self.last_logprobs is not None:
+            yield self.last_logprobs
+        if self.last_decoder_output is not None:
+            yield self.last_decoder_output
+
+    def truncated(self, num_decoder_tokens: int) -> "BartState":
+        """The state after only the first `num_decoder_tokens` decoder tokens.
+
+        Its `last_logprobs` is unknown, and filled with NaN (or None), so it should be
+        extended with at least one token before it is used."""
+        return BartState(
+            self.encoder_tokens,
+            self.decoder_tokens[:num_decoder_tokens],
+            self.encoder_outputs,
+            tuple(
+                (
+                    self_k[:, :num_decoder_tokens],
+                    self_v[:, :num_decoder_tokens],
+                    cross_k,
+                    cross_v,
+                )
+                for self_k, self_v, cross_k, cross_v in self.past_key_values
+            ),
+            None
+            if self.last_logprobs is None
+            else torch.full_like(self.last_logprobs, float("nan")),
+        )
+
+
+# Encoder tokens, decoder tokens, the hidden state to extend, and whether to compute the
+# log probabilities for all decoder tokens.
+BartArgs = Tuple[Sequence[int], Sequence[int], Optional[BartState], bool]
 
 
 @dataclass(eq=True, frozen=True)
 class BartBatchMaker(BatchMaker):
+    """Batches model calls whose lengths match after rounding up to a length bucket.
+
+    Shorter inputs are padded and masked: encoder inputs and decoder inputs on the
+    right, and the decoder states in `past_key_values` on the left. Left padding only
+    preserves the distances between decoder positions, so the decoder states are only
+    padded for models with relative position embeddings, like T5. The hidden states
+    returned don't include any padding."""
+
     input_length: int
     output_length: int
     uses_hidden_state: bool
 
     model: PreTrainedModel = dataclasses.field(compare=False)
+    batch_size_limit: int = dataclasses.field(default=1, compare=False)
+    # Number of decoder tokens run after the hidden state, which is never padded.
+    num_new_decoder_tokens: int = 0
+    # If not set, only the decoder outputs of the last token are returned (with `lm_head`).
+    compute_logprobs: bool = True
+    lm_head: Optional[LMHead] = dataclasses.field(default=None, compare=False)
+    # If set, the model runs on this executor instead of blocking the event loop.
+    executor: Optional[Executor] = dataclasses.field(default=None, compare=False)
+    stage_timer: Optional[StageTimer] = dataclasses.field(default=None, compare=False)
+    # If set, the encoder and one-token decoder steps run through its traced graphs.
+    traced: Optional[TracedT5] = dataclasses.field(default=None, compare=False)
+    encoder_cache: Optional[EncoderCache] = dataclasses.field(
+        default=None, compare=False
+    )
 
     @property
     def max_batch_size(self) -> int:
-        # TODO: Revisit this entirely arbitrary number
-        return 1
+        return self.batch_size_limit
 
     @property
     def timeout(self) -> float:
@@ -72,100 +158,280 @@ class BartBatchMaker(BatchMaker):
     def from_args(
         cls,
         model: PreTrainedModel,
-        args: Tuple[Sequence[int], Sequence[int], Optional[BartState]],
+        args: BartArgs,
+        batch_size_limit: int = 1,
+        length_bucket_size: int = 1,
+        lm_head: Optional[LMHead] = None,
+        executor: Optional[Executor] = None,
+        stage_timer: Optional[StageTimer] = None,
+        traced: Optional[TracedT5] = None,
+        encoder_cache: Optional[EncoderCache] = None,
     ):
-        encoder_tokens, decoder_tokens, hidden_state = args
+        encoder_tokens, decoder_tokens, hidden_state, compute_logprobs = args
         if hidden_state is None:
+            assert compute_logprobs
             return cls(
-                len(encoder_tokens),
-                len(decoder_tokens),
+                _round_up(len(encoder_tokens), length_bucket_size),
+                _round_up(len(decoder_tokens), length_bucket_size),
                 uses_hidden_state=False,
                 model=model,
+                batch_size_limit=batch_size_limit,
+                lm_head=lm_head,
+                executor=executor,
+                stage_timer=stage_timer,
+                traced=traced,
+                encoder_cache=encoder_cache,
             )
         else:
             assert len(encoder_tokens) == 0
+            past_length = len(hidden_state.decoder_tokens)
+            if _uses_relative_positions(model):
+                past_length = _round_up(past_length, length_bucket_size)
             return cls(
-                len(hidden_state.encoder_tokens),
-                len(hidden_state.decoder_tokens) + len(decoder_tokens),
+                _round_up(len(hidden_state.encoder_tokens), length_bucket_size),
+                past_length + len(decoder_tokens),
                 uses_hidden_state=True,
                 model=model,
+                batch_size_limit=batch_size_limit,
+                num_new_decoder_tokens=len(decoder_tokens),
+                compute_logprobs=compute_logprobs or lm_head is None,
+                lm_head=lm_head,
+                executor=executor,
+                stage_timer=stage_timer,
+                traced=traced,
+                encoder_cache=encoder_cache,
             )
 
     async def execute(
-        self, args: List[Tuple[Sequence[int], Sequence[int], Optional[BartState]]]
-    ) -> Tuple[torch.Tensor, List[BartState]]:
-        if self.uses_hidden_state:
-            return await self._execute_with_hidden_state(args)
-        else:
-            return await self._execute_without_hidden_state(args)
-
-    async def _execute_without_hidden_state(
-        self, args: List[Tuple[Sequence[int], Sequence[int], Optional[BartState]]]
-    ) -> Tuple[torch.Tensor, List[BartState]]:
-        encoder_tokens, decoder_tokens, _ = cast(
-            Tuple[
-                Sequence[Sequence[int]],
-                Sequence[Sequence[int]],
-                Sequence[Optional[BartState]],
-            ],
-            zip(*args),
+        self, args: List[BartArgs]
+    ) -> Tuple[Optional[torch.Tensor], List[BartState]]:
+        if self.executor is None:
+            return self._execute_sync(args)
+        # Grad mode is thread-local, so carry it over to the executor.
+        grad_enabled = torch.is_grad_enabled()
+
+        def run() -> Tuple[Optional[torch.Tensor], List[BartState]]:
+            with torch.set_grad_enabled(grad_enabled):
+                return self._execute_sync(args)
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, run)
+
+    def _execute_sync(
+        self, args: List[BartArgs]
+    ) -> Tuple[Optional[torch.Tensor], List[BartState]]:
+        with maybe_stage(self.stage_timer, "model"):
+            if self.uses_hidden_state:
+                return self._execute_with_hidden_state(args)
+            else:
+                return self._execute_without_hidden_state(args)
+
+    @property
+    def _pad_token_id(self) -> int:
+        pad_token_id = self.model.config.pad_token_id  # type: ignore[union-attr]
+        return 0 if pad_token_id is None else pad_token_id
+
+    def _run_model(
+        self, **kwargs: Any
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor], Any]:
+        """Returns the log probabilities (if `compute_logprobs`), the decoder outputs
+        (if `lm_head` is set), and the other outputs of the model."""
+        if self.lm_head is None:
+            model_outputs = self.model(**kwargs)  # type: ignore[operator]
+            # Reduced-precision models still produce float32 log probabilities.
+            logprobs = F.log_softmax(model_outputs["logits"].float(), dim=-1)
+            return logprobs, None, model_outputs
+        model_outputs = self.lm_head.run_decoder(**kwargs)
+        decoder_outputs = model_outputs["decoder_outputs"]
+        logprobs = (
+            self.lm_head.logprobs(decoder_outputs) if self.compute_logprobs else None
         )
-        # pylint: disable=not-callable
-        input_ids = torch.tensor(
-            list(encoder_tokens), dtype=torch.long, device=self.model.device  # type: ignore
+        return logprobs, decoder_outputs, model_outputs
+
+    def _run_traced_step(
+        self,
+        decoder_input_ids: torch.Tensor,
+        decoder_attention_mask: torch.Tensor,
+        encoder_outputs: torch.Tensor,
+        attention_mask: torch.Tensor,
+        past_key_values: Any,
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor], Any]:
+        """Like `_run_model`, but with `traced`."""
+        assert self.traced is not None
+        decoder_outputs, self_key_values = self.traced.decoder_step(
+            decoder_input_ids,
+            decoder_attention_mask,
+            encoder_outputs,
+            attention_mask,
+            past_key_values,
         )
-        # pylint: disable=not-callable
-        decoder_input_ids = torch.tensor(
-            list(decoder_tokens), dtype=torch.long, device=self.model.device  # type: ignore
+        logprobs = (
+            self.traced.lm_head.logprobs(decoder_outputs)
+            if self.compute_logprobs
+            else None
+        )
+        model_outputs = {
+            "past_key_values": tuple(
+                (self_k, self_v, cross_k, cross_v)
+                for (self_k, self_v), (_, _, cross_k, cross_v) in zip(
+                    self_key_values, past_key_values
+                )
+            )
+        }
+        return (
+            logprobs,
+            decoder_outputs if self.lm_head is not None else None,
+            model_outputs,
         )
-        model_outputs = self.model(  # type: ignore[operator]
-            input_ids=input_ids, decoder_input_ids=decoder_input_ids
+
+    def _execute_without_hidden_state(
+        self, args: List[BartArgs]
+    ) -> Tuple[Optional[torch.Tensor], List[BartState]]:
+        encoder_tokens, decoder_tokens, _, _ = cast(
+            Tuple[Sequence[Sequence[int]], Sequence[Sequence[int]], Any, Any],
+            zip(*args),
         )
-        logprobs = F.log_softmax(model_outputs["logits"], dim=-1)
+        device = self.model.device  # type: ignore[attr-defined]
+        # The causal mask already hides the padding after each decoder input.
+        decoder_input_ids, _ = _pad_right(decoder_tokens, self._pad_token_id, device)
+        if self.traced is None and self.encoder_cache is None:
+            input_ids, attention_mask = _pad_right(
+                encoder_tokens, self._pad_token_id, device
+            )
+            logprobs, decoder_outputs, model_outputs = self._run_model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+            )
+            encoder_outputs = [
+                _unpad(
+                    model_outputs["encoder_last_hidden_state"][i],
+                    0,
+                    0,
+                    len(encoder_tokens[i]),
+                )
+                for i in range(len(args))
+            ]
+        else:
+            encoder_outputs = self._encode(encoder_tokens)
+            encoder_lengths = [len(tokens) for tokens in encoder_tokens]
+            encoder_length = max(encoder_lengths)
+            logprobs, decoder_outputs, model_outputs = self._run_model(
+                input_ids=None,
+                attention_mask=_padding_mask(
+                    encoder_lengths, encoder_length, left=False, device=device
+                ),
+                decoder_input_ids=decoder_input_ids,
+                encoder_outputs=(
+                    torch.stack(
+                        [
+                            _pad(outputs, 0, encoder_length, left=False)
+                            for outputs in encoder_outputs
+                        ]
+                    ),
+                ),
+            )
 
         next_hidden_states = [
-            BartState(
+            _unpadded_state(
+                model_outputs,
+                logprobs,
+                decoder_outputs,
+                i,
                 tuple(encoder_tokens[i]),
                 tuple(decoder_tokens[i]),
-                model_outputs["encoder_last_hidden_state"][i],
-                tuple(
-                    cast(
-                        Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
-                        tuple(
-                            past_key_values_internal[i]
-                            for past_key_values_internal in past_key_values_for_layer
-                        ),
-                    )
-                    for past_key_values_for_layer in model_outputs["past_key_values"]
-                ),
-                logprobs[i, -1],
+                encoder_outputs=encoder_outputs[i],
+                past_padding=0,
+                num_new_decoder_tokens=len(decoder_tokens[i]),
             )
             for i in range(len(args))
         ]
         return logprobs, next_hidden_states
 
-    async def _execute_with_hidden_state(
-        self, args: List[Tuple[Sequence[int], Sequence[int], Optional[BartState]]]
-    ):
-        _, decoder_tokens, hidden_states = cast(
-            Tuple[Any, Sequence[Sequence[int]], Sequence[Optional[BartState]]],
+    def _encode(self, encoder_tokens: Sequence[Sequence[int]]) -> List[torch.Tensor]:
+        """Returns the encoder outputs for each input, from `encoder_cache` where possible."""
+        device = self.model.device  # type: ignore[attr-defined]
+        dtype = self.model.dtype  # type: ignore[attr-defined]
+        encoder_outputs: List[Optional[torch.Tensor]] = [
+            None
+            if self.encoder_cache is None
+            else self.encoder_cache.get(tokens, dtype, device)
+            for tokens in encoder_tokens
+        ]
+        missing = [i for i, outputs in enumerate(encoder_outputs) if outputs is None]
+        if missing:
+            missing_tokens = [encoder_tokens[i] for i in missing]
+            # Part of the "model" stage, which also covers the decoder.
+            with maybe_stage(self.stage_timer, "model.encoder"):
+                if self.traced is None:
+                    input_ids, attention_mask = _pad_right(
+                        missing_tokens, self._pad_token_id, device
+                    )
+                    encoder = self.model.get_encoder()
+                    batched_outputs = encoder(  # type: ignore[operator]
+                        input_ids=input_ids, attention_mask=attention_mask
+                    )[0]
+                else:
+                    input_ids, attention_mask = _pad_right(
+                        missing_tokens,
+                        self._pad_token_id,
+                        device,
+                        length=self.traced.padded_length(max(map(len, missing_tokens))),
+                    )
+                    batched_outputs = self.traced.encode(
+                        input_ids, _ones_if_none(attention_mask, input_ids)
+                    )
+            for j, i in enumerate(missing):
+                outputs = _unpad(batched_outputs[j], 0, 0, len(encoder_tokens[i]))
+                encoder_outputs[i] = outputs
+                if self.encoder_cache is not None:
+                    self.encoder_cache.put(encoder_tokens[i], outputs)
+        return cast(List[torch.Tensor], encoder_outputs)
+
+    def _execute_with_hidden_state(
+        self, args: List[BartArgs]
+    ) -> Tuple[Optional[torch.Tensor], List[BartState]]:
+        _, decoder_tokens, hidden_states, _ = cast(
+            Tuple[Any, Sequence[Sequence[int]], Sequence[Optional[BartState]], Any],
             zip(*args),
         )
         assert not any(hs is None for hs in hidden_states)
         hidden_states = cast(Sequence[BartState], hidden_states)
+        device = self.model.device  # type: ignore[attr-defined]
 
         # pylint: disable=not-callable
         decoder_input_ids = torch.tensor(  # type: ignore
-            list(decoder_tokens), dtype=torch.long, device=self.model.device  # type: ignore[attr-defined]
+            list(decoder_tokens), dtype=torch.long, device=device
         )
+        encoder_lengths = [len(hs.encoder_tokens) for hs in hidden_states]
+        past_lengths = [len(hs.decoder_tokens) for hs in hidden_states]
+        encoder_length = max(encoder_lengths)
+        past_length = max(past_lengths)
+        num_new_decoder_tokens = self.num_new_decoder_tokens
+        # The traced decoder step keeps the capacity of the decoder states fixed, by
+        # dropping their oldest position, which is padding.
+        traced = self.traced if num_new_decoder_tokens == 1 else None
+        if traced is not None:
+            encoder_length = traced.padded_length(encoder_length)
+            past_length = traced.padded_length(past_length + 1)
+
         encoder_outputs = torch.stack(
-            [hidden_state.encoder_outputs for hidden_state in hidden_states]
+            [
+                _pad(hidden_state.encoder_outputs, 0, encoder_length, left=False)
+                for hidden_state in hidden_states
+            ]
         )
+        # The first two tensors of each layer are for self-attention, and the other two
+        # for cross-attention.
         past_key_values = tuple(
             tuple(
                 torch.stack(
                     [
-                        hidden_state.past_key_values[layer_i][kv_i]
+                        _pad(
+                            hidden_state.past_key_values[layer_i][kv_i],
+                            1,
+                            past_length if kv_i < 2 else encoder_length,
+                            left=kv_i < 2,
+                        )
                         for hidden_state in hidden_states
                     ]
                 )
@@ -173,37 +439,166 @@ class BartBatchMaker(BatchMaker):
             )
             for layer_i in range(len(hidden_states[0].past_key_values))
         )
+        decoder_attention_mask = _padding_mask(
+            [length + num_new_decoder_tokens for length in past_lengths],
+            past_length + num_new_decoder_tokens,
+            left=True,
+            device=device,
+        )
 
-        model_outputs = self.model(  # type: ignore[operator]
-            input_ids=None,
-            decoder_input_ids=decoder_input_ids,
-            encoder_outputs=(encoder_outputs,),
-            past_key_values=past_key_values,
+        attention_mask = _padding_mask(
+            encoder_lengths, encoder_length, left=False, device=device
         )
-        logprobs = F.log_softmax(model_outputs["logits"], dim=-1)
+        if traced is not None:
+            assert decoder_attention_mask is not None
+            logprobs, decoder_outputs, model_outputs = self._run_traced_step(
+                decoder_input_ids,
+                decoder_attention_mask,
+                encoder_outputs,
+                _ones_if_none(attention_mask, encoder_outputs[..., 0]),
+                past_key_values,
+            )
+            # The oldest position was dropped.
+            past_length -= 1
+        else:
+            logprobs, decoder_outputs, model_outputs = self._run_model(
+                input_ids=None,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                decoder_attention_mask=decoder_attention_mask,
+                encoder_outputs=(encoder_outputs,),
+                past_key_values=past_key_values,
+            )
 
         next_hidden_states = [
-            BartState(
+            _unpadded_state(
+                model_outputs,
+                logprobs,
+                decoder_outputs,
+                i,
                 past_hidden_state.encoder_tokens,
                 past_hidden_state.decoder_tokens + tuple(decoder_tokens[i]),
-                model_outputs["encoder_last_hidden_state"][i],
-                tuple(
-                    cast(
-                        Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
-                        tuple(
-                            past_key_values_internal[i]
-                            for past_key_values_internal in past_key_values_for_layer
-                        ),
-                    )
-                    for past_key_values_for_layer in model_outputs["past_key_values"]
-                ),
-                logprobs[i, -1],
+                # Shared with the past hidden state rather than copied.
+                encoder_outputs=past_hidden_state.encoder_outputs,
+                past_padding=past_length - past_lengths[i],
+                num_new_decoder_tokens=num_new_decoder_tokens,
             )
             for i, past_hidden_state in enumerate(hidden_states)
         ]
         return logprobs, next_hidden_states
 
 
+def _round_up(length: int, bucket_size: int) -> int:
+    if bucket_size <= 1:
+        return length
+    return -(-length // bucket_size) * bucket_size
+
+
+def _uses_relative_positions(model: PreTrainedModel) -> bool:
+    return getattr(model.config, "relative_attention_num_buckets", None) is not None
+
+
+def _pad(tensor: torch.Tensor, dim: int, length: int, left: bool) -> torch.Tensor:
+    """Pads `tensor` with zeros along `dim` up to `length`."""
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    padding = tensor.new_zeros(shape)
+    return torch.cat([padding, tensor] if left else [tensor, padding], dim=dim)
+
+
+def _pad_right(
+    token_lists: Sequence[Sequence[int]],
+    pad_token_id: int,
+    device: torch.device,
+    length: Optional[int] = None,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """Returns the token IDs padded up to `length` (by default, the longest),
+    and an attention mask if any padding was needed."""
+    lengths = [len(tokens) for tokens in token_lists]
+    if length is None:
+        length = max(lengths)
+    # pylint: disable=not-callable
+    ids = torch.tensor(
+        [
+            list(tokens) + [pad_token_id] * (length - len(tokens))
+            for tokens in token_lists
+        ],
+        dtype=torch.long,
+        device=device,
+    )
+    return ids, _padding_mask(lengths, length, left=False, device=device)
+
+
+def _padding_mask(
+    lengths: Sequence[int], length: int, left: bool, device: torch.device
+) -> Optional[torch.Tensor]:
+    """Attention mask for sequences of `lengths` padded up to `length`, or None if none are padded."""
+    if all(l == length for l in lengths):
+        return None
+    positions = torch.arange(length, device=device)
+    # pylint: disable=not-callable
+    lengths_tensor = torch.tensor(lengths, device=device)[:, None]
+    if left:
+        mask = positions >= length - lengths_tensor
+    else:
+        mask = positions < lengths_tensor
+    return mask.long()
+
+
+def _ones_if_none(mask: Optional[torch.Tensor], like: torch.Tensor) -> torch.Tensor:
+    """An attention mask which masks nothing if `mask` is None.
+
+    Traced graphs always need one."""
+    if mask is not None:
+        return mask
+    return torch.ones(like.shape, dtype=torch.long, device=like.device)
+
+
+def _unpad(tensor: torch.Tensor, dim: int, start: int, length: int) -> torch.Tensor:
+    """Takes `length` entries from `start` along `dim`.
+
+    Copies if that drops any padding, so that the padding isn't kept alive."""
+    if start == 0 and length == tensor.shape[dim]:
+        return tensor
+    return tensor.narrow(dim, start, length).clone()
+
+
+def _unpadded_state(
+    model_outputs: Any,
+    logprobs: Optional[torch.Tensor],
+    decoder_outputs: Optional[torch.Tensor],
+    i: int,
+    encoder_tokens: Tuple[int, ...],
+    decoder_tokens: Tuple[int, ...],
+    encoder_outputs: torch.Tensor,
+    past_padding: int,
+    num_new_decoder_tokens: int,
+) -> BartState:
+    """The hidden state for row `i` of a batched model call."""
+    return BartState(
+        encoder_tokens,
+        decoder_tokens,
+        encoder_outputs,
+        tuple(
+            (
+                _unpad(self_k[i], 1, past_padding, len(decoder_tokens)),
+                _unpad(self_v[i], 1, past_padding, len(decoder_tokens)),
+                _unpad(cross_k[i], 1, 0, len(encoder_tokens)),
+                _unpad(cross_v[i], 1, 0, len(encoder_tokens)),
+            )
+            for self_k, self_v, cross_k, cross_v in model_outputs["past_key_values"]
+        ),
+        # Copy so that we don't keep all of `logprobs` alive.
+        None if logprobs is None else logprobs[i, num_new_decoder_tokens - 1].clone(),
+        None
+        if decoder_outputs is None
+        else decoder_outputs[i, num_new_decoder_tokens - 1].clone(),
+    )
+
+
 @dataclass
 class Seq2SeqBart(Seq2SeqModel[BartState]):
     pretrained_model_dir: str
@@ -211,16 +606,57 @@ class Seq2SeqBart(Seq2SeqModel[BartState]):
     # But its possible some model won't work out of the box.
     model: PreTrainedModel
     clamp_tokenizer: ClampTokenizer
+    # If set, `initial_scored` only runs the decoder on tokens that aren't in the cache.
+    # Only the states computed by `initial` and `initial_scored` are cached, since
+    # those are the ones which are resumed when packed nodes are unpacked again;
+    # the search holds on to the states of its beam itself.
+    prefix_cache: Optional[PrefixCache[BartState]] = None
+    # Model calls with the same input and output lengths are batched together, up to this many.
+    max_batch_size: int = 1
+    # If set, the batch size (up to `max_batch_size`) and wait window adapt to the observed latency.
+    batching_policy: Optional[AdaptiveBatchingPolicy] = None
+    # If above 1, calls with different lengths are batched together by padding the
+    # lengths up to a multiple of this.
+    length_bucket_size: int = 1
+    # If set and `model` is T5 or BART, the LM head is run separately from the decoder,
+    # so that `extend_next_logprobs` only projects the last position, and only onto the
+    # allowed tokens if the normalizer doesn't need to be exact.
+    split_lm_head: bool = False
+    # If set, model calls run on this executor so that the event loop can do other work,
+    # like parsing, in the meantime. torch releases the GIL during most operations.
+    executor: Optional[Executor] = None
+    # Records the time spent in the model as the "model" stage.
+    stage_timer: Optional[StageTimer] = None
+    # If set and `model` is T5, the encoder and one-token decoder steps run through
+    # TorchScript graphs traced for each shape, padded up to multiples of
+    # `traced_length_bucket_size`. See TracedT5.
+    trace_model: bool = False
+    traced_length_bucket_size: int = 16
+    # If set, `initial` only runs the encoder on inputs that aren't in the cache.
+    encoder_cache: Optional[EncoderCache] = None
 
     batch_helper: BatchingHelper[
-        Tuple[Sequence[int], Sequence[int], Optional[BartState]],
-        Tuple[torch.Tensor, List[BartState]],
+        BartArgs, Tuple[Optional[torch.Tensor], List[BartState]]
     ] = dataclasses.field(init=False)
     seq2seq_helper: Seq2SeqHelper = dataclasses.field(init=False)
+    hidden_state_tracker: HiddenStateTracker = dataclasses.field(
+        init=False, default_factory=HiddenStateTracker
+    )
 
     def __post_init__(self):
         self.batch_helper = BatchingHelper(
-            lambda args: BartBatchMaker.from_args(self.model, args)
+            lambda args: BartBatchMaker.from_args(
+                self.model,
+                args,
+                self.max_batch_size,
+                self.length_bucket_size,
+                self.lm_head,
+                self.executor,
+                self.stage_timer,
+                self.traced,
+                self.encoder_cache,
+            ),
+            policy=self.batching_policy,
         )
 
         with open(
@@ -232,6 +668,16 @@ class Seq2SeqBart(Seq2SeqModel[BartState]):
             # print("[Seq2SeqBart] decoder_output_begins_with_space", self.seq2seq_helper.decoder_output_begins_with_space)
             # print("[Seq2SeqBart] seq2seq_helper", self.seq2seq_helper)
 
+    @cached_property
+    def lm_head(self) -> Optional[LMHead]:
+        return LMHead.from_model(self.model) if self.split_lm_head else None
+
+    @cached_property
+    def traced(self) -> Optional[TracedT5]:
+        if not self.trace_model:
+            return None
+        return TracedT5.from_model(self.model, self.traced_length_bucket_size)
+
     @cached_property
     def vocab_size(self) -> int:  # pylint: disable=invalid-overridden-method
         return self.tokenizer.vocab_size
@@ -266,11 +712,21 @@ class Seq2SeqBart(Seq2SeqModel[BartState]):
         drop_next_hidden_state: bool = False,
     ) -> Tuple[torch.Tensor, Optional[BartState]]:
         (batched_logprobs, next_hidden_states), i = await self.batch_helper.execute(
-            (encoder_tokens, decoder_tokens, None)
+            (encoder_tokens, decoder_tokens, None, True)
         )
+        assert batched_logprobs is not None
+        logprobs = batched_logprobs[i, : len(decoder_tokens)]
+        if self.prefix_cache is not None and not drop_next_hidden_state:
+            self.prefix_cache.insert(
+                encoder_tokens,
+                decoder_tokens,
+                next_hidden_states[i],
+                # The first decoder token is given, not predicted.
+                [0.0] + _token_logprobs(logprobs[:-1], decoder_tokens[1:]),
+            )
         return (
-            batched_logprobs[i, : len(decoder_tokens)],
-            None if drop_next_hidden_state else next_hidden_states[i],
+            logprobs,
+            self._maybe_track(next_hidden_states[i], drop_next_hidden_state),
         )
 
     async def extend(
@@ -280,12 +736,94 @@ class Seq2SeqBart(Seq2SeqModel[BartState]):
         drop_next_hidden_state: bool = False,
     ) -> Tuple[torch.Tensor, Optional[BartState]]:
         (batched_logprobs, next_hidden_states), i = await self.batch_helper.execute(
-            ([], tokens, hidden_state)
+            ([], tokens, hidden_state, True)
         )
+        assert batched_logprobs is not None
+        logprobs = batched_logprobs[i, : len(tokens)]
         return (
-            batched_logprobs[i, : len(tokens)],
-            None if drop_next_hidden_state else next_hidden_states[i],
+            logprobs,
+            self._maybe_track(next_hidden_states[i], drop_next_hidden_state),
         )
 
+    async def initial_scored(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        num_scored: int,
+    ) -> Tuple[List[float], BartState]:
+        if self.prefix_cache is None:
+            return await super().initial_scored(
+                encoder_tokens, decoder_tokens, num_scored
+            )
+        assert num_scored < len(decoder_tokens)
+
+        match = self.prefix_cache.lookup(encoder_tokens, decoder_tokens)
+        # Resume before the last matched token, so that we have its log probability
+        # and so that there is at least one token to run to get `last_logprobs`.
+        resume_at = 0 if match is None else min(match.length, len(decoder_tokens)) - 1
+        if match is None or resume_at < 1:
+            return await super().initial_scored(
+                encoder_tokens, decoder_tokens, num_scored
+            )
+
+        logprobs, hidden_state = await self.extend(
+            decoder_tokens[resume_at:], match.state.truncated(resume_at)
+        )
+        assert hidden_state is not None
+        token_logprobs = match.token_logprobs[: resume_at + 1] + _token_logprobs(
+            logprobs[:-1], decoder_tokens[resume_at + 1 :]
+        )
+        self.prefix_cache.insert(
+            encoder_tokens, decoder_tokens, hidden_state, token_logprobs
+        )
+        return token_logprobs[len(decoder_tokens) - num_scored :], hidden_state
+
+    async def extend_next_logprobs(
+        self,
+        tokens: Sequence[int],
+        hidden_state: BartState,
+        allowed_token_ids: Optional[torch.Tensor] = None,
+        exact_normalizer: bool = True,
+    ) -> Tuple[torch.Tensor, BartState]:
+        if self.lm_head is None:
+            return await super().extend_next_logprobs(
+                tokens, hidden_state, allowed_token_ids, exact_normalizer
+            )
+        (_, next_hidden_states), i = await self.batch_helper.execute(
+            ([], tokens, hidden_state, False)
+        )
+        next_hidden_state = next_hidden_states[i]
+        assert next_hidden_state.last_decoder_output is not None
+        logprobs = self.lm_head.logprobs(
+            next_hidden_state.last_decoder_output, allowed_token_ids, exact_normalizer
+        )
+        self.hidden_state_tracker.track(next_hidden_state, next_hidden_state.tensors())
+        return logprobs, next_hidden_state
+
     async def next_logprobs(self, hidden_state: BartState) -> torch.Tensor:
-        return hidden_state.last_logprobs
+        return self._next_logprobs(hidden_state)
+
+    def _next_logprobs(self, hidden_state: BartState) -> torch.Tensor:
+        if hidden_state.last_logprobs is not None:
+            return hidden_state.last_logprobs
+        assert self.lm_head is not None and hidden_state.last_decoder_output is not None
+        return self.lm_head.logprobs(hidden_state.last_decoder_output)
+
+    def hidden_state_nbytes(self, hidden_state: BartState) -> int:
+        return storage_nbytes(hidden_state.tensors())
+
+    def hidden_state_stats(self) -> HiddenStateStats:
+        return self.hidden_state_tracker.stats()
+
+    def _maybe_track(
+        self, hidden_state: BartState, drop_next_hidden_state: bool
+    ) -> Optional[BartState]:
+        if drop_next_hidden_state:
+            return None
+        self.hidden_state_tracker.track(hidden_state, hidden_state.tensors())
+        return hidden_state
+
+
+def _token_logprobs(logprobs: torch.Tensor, tokens: Sequence[int]) -> List[float]:
+    """Picks out logprobs[i, tokens[i]] for each i."""
+    return logprobs[range(len(tokens)), list(tokens)].tolist()
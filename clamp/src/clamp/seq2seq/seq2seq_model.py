@@ -23,6 +23,7 @@ from typing import Generic, List, Optional, Sequence, Tuple, TypeVar
 
 import torch
 
+from clamp.seq2seq.hidden_state_tracker import HiddenStateStats
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
 
 HS = TypeVar("HS")
@@ -54,6 +55,28 @@ class AutoregressiveModel(Generic[HS], ABC):
     async def next_logprobs(self, hidden_state: HS) -> torch.Tensor:
         """Returns the distribution over the next token given the tokens in the hidden state."""
 
+    async def extend_next_logprobs(
+        self,
+        tokens: Sequence[int],
+        hidden_state: HS,
+        allowed_token_ids: Optional[torch.Tensor] = None,
+        exact_normalizer: bool = True,
+    ) -> Tuple[torch.Tensor, HS]:
+        """Like `extend`, but only returns the distribution over the token after `tokens`.
+
+        If `allowed_token_ids` is given, the log probabilities of all other tokens are -inf.
+        Unless `exact_normalizer` is set, the allowed ones are normalized among themselves,
+        which lets implementations avoid scoring the rest of the vocabulary."""
+        logprobs, next_hidden_state = await self.extend(tokens, hidden_state)
+        return (
+            restrict_logprobs(logprobs[-1], allowed_token_ids, exact_normalizer),
+            next_hidden_state,
+        )
+
+    def hidden_state_stats(self) -> Optional[HiddenStateStats]:
+        """Reports the hidden states produced by this model which are still alive, if supported."""
+        return None
+
     async def __aenter__(self):
         pass
 
@@ -150,3 +173,44 @@ class Seq2SeqModel(AutoregressiveModel[HS], ABC):
             a float32 tensor of size [decoder_tokens len, vocab size] containing log probabilities.
             optionally, a hidden state that can be used in a future call to this function.
         """
+
+    async def initial_scored(
+        self,
+        encoder_tokens: Sequence[int],
+        decoder_tokens: Sequence[int],
+        num_scored: int,
+    ) -> Tuple[List[float], HS]:
+        """Like `initial`, but returns the log probabilities of the last `num_scored` decoder tokens.
+
+        Each is conditioned on the decoder tokens which precede it.
+        Implementations may avoid recomputing prefixes of `decoder_tokens` that they have seen before.
+        """
+        assert num_scored < len(decoder_tokens)
+        logprobs, hidden_state = await self.initial(encoder_tokens, decoder_tokens)
+        assert hidden_state is not None
+        # Row i of `logprobs` is the distribution over decoder_tokens[i + 1].
+        positions = range(len(decoder_tokens) - num_scored, len(decoder_tokens))
+        return (
+            logprobs[
+                [p - 1 for p in positions], [decoder_tokens[p] for p in positions]
+            ].tolist(),
+            hidden_state,
+        )
+
+
+def restrict_logprobs(
+    logprobs: torch.Tensor,
+    allowed_token_ids: Optional[torch.Tensor],
+    exact_normalizer: bool = True,
+) -> torch.Tensor:
+    """Sets the log probabilities of tokens other than `allowed_token_ids` to -inf.
+
+    Unless `exact_normalizer` is set, the allowed ones are renormalized to sum to 1."""
+    if allowed_token_ids is None:
+        return logprobs
+    result = torch.full_like(logprobs, float("-inf"))
+    allowed_logprobs = logprobs[..., allowed_token_ids]
+    if not exact_normalizer:
+        allowed_logprobs = torch.log_softmax(allowed_logprobs, dim=-1)
+    result[..., allowed_token_ids] = allowed_logprobs
+    return result
@@ -0,0 +1,213 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Runs T5 through TorchScript graphs traced for fixed input shapes.
+
+An eager HuggingFace model spends much of a one-token decoder step in Python,
+dispatching the operations of each layer. Here the encoder and the decoder step
+are traced once per batch size, encoder length and decoder state capacity, with
+the lengths rounded up to `length_bucket_size` to limit the number of graphs.
+
+The decoder states are left-padded up to the capacity and masked. That only
+preserves the distances between positions, so only models with relative
+position embeddings, like T5, are supported."""
+
+import collections
+import logging
+import warnings
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Tuple
+
+import torch
+from transformers import PreTrainedModel, T5ForConditionalGeneration
+
+from clamp.seq2seq.lm_head import LMHead
+
+# For each layer, the keys and values of self-attention and of cross-attention.
+PastKeyValues = Tuple[
+    Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor], ...
+]
+
+
+class _Encoder(torch.nn.Module):
+    def __init__(self, model: T5ForConditionalGeneration):
+        super().__init__()
+        self.encoder = model.encoder
+
+    def forward(  # pylint: disable=arguments-differ
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        return self.encoder(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=False
+        )[0]
+
+
+class _DecoderStep(torch.nn.Module):
+    """Runs the decoder on one token per row, given self-attention states of a fixed capacity.
+
+    Returns the decoder outputs and the new self-attention states, without the oldest
+    position so that the capacity stays the same. That position must be padding."""
+
+    def __init__(self, model: T5ForConditionalGeneration):
+        super().__init__()
+        self.decoder = model.decoder
+
+    def forward(  # pylint: disable=arguments-differ
+        self,
+        decoder_input_ids: torch.Tensor,
+        decoder_attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+        past_key_values: PastKeyValues,
+    ) -> Tuple[torch.Tensor, Tuple[Tuple[torch.Tensor, torch.Tensor], ...]]:
+        decoder_outputs, present_key_values = self.decoder(
+            input_ids=decoder_input_ids,
+            attention_mask=decoder_attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False,
+        )[:2]
+        return (
+            decoder_outputs,
+            tuple(
+                (self_k[:, :, 1:], self_v[:, :, 1:])
+                for self_k, self_v, _, _ in present_key_values
+            ),
+        )
+
+
+@dataclass
+class TracedT5:
+    model: T5ForConditionalGeneration
+    # Computes the log probabilities from the decoder outputs.
+    lm_head: LMHead
+    length_bucket_size: int = 16
+    # Largest absolute difference from the eager model allowed when a graph is traced.
+    # Graphs which differ by more are discarded, and the eager model is used instead.
+    tolerance: float = 1e-3
+    # Least recently used graphs are dropped beyond this many.
+    max_graphs: int = 128
+
+    num_traced: int = field(init=False, default=0)
+    num_rejected: int = field(init=False, default=0)
+    _encoder: _Encoder = field(init=False, repr=False)
+    _decoder_step: _DecoderStep = field(init=False, repr=False)
+    _graphs: "collections.OrderedDict[Tuple[Any, ...], Callable[..., Any]]" = field(
+        init=False, repr=False, default_factory=collections.OrderedDict
+    )
+
+    def __post_init__(self):
+        self._encoder = _Encoder(self.model).eval()
+        self._decoder_step = _DecoderStep(self.model).eval()
+
+    @staticmethod
+    def from_model(
+        model: PreTrainedModel, length_bucket_size: int = 16
+    ) -> "Optional[TracedT5]":
+        """Returns None if `model` isn't a T5 model that we can trace."""
+        if not isinstance(model, T5ForConditionalGeneration):
+            return None
+        lm_head = LMHead.from_model(model)
+        if lm_head is None:
+            return None
+        return TracedT5(model, lm_head, length_bucket_size)
+
+    def padded_length(self, length: int) -> int:
+        """Length of the traced inputs for `length` positions."""
+        return -(-length // self.length_bucket_size) * self.length_bucket_size
+
+    def encode(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """Returns the last hidden state of the encoder."""
+        return self._run("encoder", self._encoder, (input_ids, attention_mask))
+
+    def decoder_step(
+        self,
+        decoder_input_ids: torch.Tensor,
+        decoder_attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+        past_key_values: PastKeyValues,
+    ) -> Tuple[torch.Tensor, Tuple[Tuple[torch.Tensor, torch.Tensor], ...]]:
+        """Runs `_DecoderStep`.
+
+        `decoder_input_ids` has shape (batch_size, 1) and `decoder_attention_mask`
+        (batch_size, capacity + 1), where the capacity is the length of the
+        self-attention states in `past_key_values`. The first position of every
+        row must be masked."""
+        return self._run(
+            "decoder_step",
+            self._decoder_step,
+            (
+                decoder_input_ids,
+                decoder_attention_mask,
+                encoder_hidden_states,
+                encoder_attention_mask,
+                past_key_values,
+            ),
+        )
+
+    def _run(self, name: str, module: torch.nn.Module, inputs: Tuple[Any, ...]) -> Any:
+        # The graphs depend on the shapes, which are fixed during tracing.
+        key = (name,) + tuple(tuple(t.shape) for t in _flatten(inputs))
+        graph = self._graphs.get(key)
+        if graph is None:
+            graph = self._trace(name, module, inputs)
+            self._graphs[key] = graph
+            if len(self._graphs) > self.max_graphs:
+                self._graphs.popitem(last=False)
+        else:
+            self._graphs.move_to_end(key)
+        return graph(*inputs)
+
+    def _trace(
+        self, name: str, module: torch.nn.Module, inputs: Tuple[Any, ...]
+    ) -> Callable[..., Any]:
+        """Traces `module` on `inputs`, and checks that the graph gives the same outputs."""
+        with torch.no_grad():
+            with warnings.catch_warnings():
+                # The traced shapes are expected to be fixed.
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                graph = torch.jit.trace(module, inputs, check_trace=False)
+            expected = _flatten(module(*inputs))
+            actual = _flatten(graph(*inputs))
+        max_diff = max(
+            (e.float() - a.float()).abs().max().item() for e, a in zip(expected, actual)
+        )
+        if len(expected) != len(actual) or not max_diff <= self.tolerance:
+            logging.warning(
+                "Traced %s for shapes %s differs from the eager model by %s; not using it",
+                name,
+                [tuple(t.shape) for t in _flatten(inputs)],
+                max_diff,
+            )
+            self.num_rejected += 1
+            return module
+        self.num_traced += 1
+        return graph
+
+
+def _flatten(value: Any) -> Tuple[torch.Tensor, ...]:
+    """The tensors in nested tuples."""
+    if isinstance(value, torch.Tensor):
+        return (value,)
+    return tuple(t for v in value for t in _flatten(v))
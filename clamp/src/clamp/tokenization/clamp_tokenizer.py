@@ -19,10 +19,12 @@
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, List, Sequence
 
 from cached_property import cached_property
 
+from clamp.tokenization.token_table import TokenTable
+
 
 @dataclass  # type: ignore
 class ClampTokenizer(ABC):
@@ -87,6 +89,10 @@ class ClampTokenizer(ABC):
         tokens = self.tokenize(text)
         return [self.utf8_token_to_id_map[token] for token in tokens]
 
+    @cached_property
+    def token_table(self) -> TokenTable:
+        return TokenTable.from_tokens(self.id_to_utf8_token_map)
+
     def decode(self, token_ids: List[int]) -> str:
         tokens = [
             self.id_to_utf8_token_map[token_id]
@@ -94,3 +100,10 @@ class ClampTokenizer(ABC):
             if token_id in self.id_to_utf8_token_map
         ]
         return self.detokenize(tokens)
+
+    def batch_decode(self, token_id_sequences: Sequence[Sequence[int]]) -> List[str]:
+        """Like `decode` on each sequence, but gathers the bytes of all the tokens at once."""
+        return [
+            self.detokenize([token_bytes])
+            for token_bytes in self.token_table.batch_decode_bytes(token_id_sequences)
+        ]
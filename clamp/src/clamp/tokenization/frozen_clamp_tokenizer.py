@@ -0,0 +1,141 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A ClampTokenizer whose token table is read from compact binary files.
+
+Building `utf8_token_to_id_map` from a Hugging Face tokenizer decodes every
+token in the vocabulary on each startup. `FrozenClampTokenizer.freeze` writes
+the decoded tokens once, as the arrays of a TokenTable, which later startups
+map instead. Tokenizing text still needs the original tokenizer, which is only
+loaded the first time it is used."""
+import importlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from cached_property import cached_property
+
+from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.tokenization.token_table import TokenTable
+
+_INFO_FILE = "clamp_tokenizer.json"
+_TOKEN_DATA_FILE = "token_data.npy"
+_TOKEN_OFFSETS_FILE = "token_offsets.npy"
+# Subdirectory with the files of the original tokenizer.
+_BASE_TOKENIZER_DIR = "base"
+
+
+@dataclass
+class FrozenClampTokenizer(ClampTokenizer):
+    directory: Path
+    table: TokenTable
+    info: Dict[str, object]
+
+    @staticmethod
+    def freeze(tokenizer: ClampTokenizer, directory: Path) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        tokenizer.save_pretrained(str(directory / _BASE_TOKENIZER_DIR))
+        np.save(directory / _TOKEN_DATA_FILE, tokenizer.token_table.data)
+        np.save(directory / _TOKEN_OFFSETS_FILE, tokenizer.token_table.offsets)
+        base_class = type(tokenizer)
+        with open(directory / _INFO_FILE, "w") as f:
+            json.dump(
+                {
+                    "base_class": f"{base_class.__module__}.{base_class.__qualname__}",
+                    "vocab_size": tokenizer.vocab_size,
+                    "pad_token_id": tokenizer.pad_token_id,
+                    "unk_token_id": tokenizer.unk_token_id,
+                    "eos_token_id": tokenizer.eos_token_id,
+                },
+                f,
+            )
+
+    @staticmethod
+    def exists(directory: Path) -> bool:
+        return (directory / _INFO_FILE).exists()
+
+    @cached_property
+    def base_tokenizer(self) -> ClampTokenizer:
+        module_name, _, class_name = str(self.info["base_class"]).rpartition(".")
+        base_class = getattr(importlib.import_module(module_name), class_name)
+        return base_class.from_pretrained(str(self.directory / _BASE_TOKENIZER_DIR))
+
+    @property
+    def vocab_size(self) -> int:
+        return int(self.info["vocab_size"])  # type: ignore
+
+    @property
+    def pad_token_id(self) -> int:
+        return int(self.info["pad_token_id"])  # type: ignore
+
+    @property
+    def unk_token_id(self) -> int:
+        return int(self.info["unk_token_id"])  # type: ignore
+
+    @property
+    def eos_token_id(self) -> int:
+        return int(self.info["eos_token_id"])  # type: ignore
+
+    @property
+    def token_table(self) -> TokenTable:  # pylint:disable=invalid-overridden-method
+        return self.table
+
+    @cached_property
+    def id_to_utf8_token_map(self) -> Dict[int, bytes]:
+        data = self.table.data.tobytes()
+        offsets = self.table.offsets.tolist()
+        # IDs without a token have no bytes.
+        return {
+            token_id: data[start:end]
+            for token_id, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]))
+            if end > start
+        }
+
+    @cached_property
+    def utf8_token_to_id_map(  # pylint:disable=invalid-overridden-method
+        self,
+    ) -> Dict[bytes, int]:
+        return {
+            token: token_id for token_id, token in self.id_to_utf8_token_map.items()
+        }
+
+    def tokenize(self, text: str) -> List[bytes]:
+        return self.base_tokenizer.tokenize(text)
+
+    def encode(self, text: str) -> List[int]:
+        return self.base_tokenizer.encode(text)
+
+    def save_pretrained(self, tokenizer_loc: str) -> None:
+        FrozenClampTokenizer.freeze(self.base_tokenizer, Path(tokenizer_loc))
+
+    @classmethod
+    def from_pretrained(cls, tokenizer_loc: str) -> "FrozenClampTokenizer":
+        directory = Path(tokenizer_loc)
+        with open(directory / _INFO_FILE) as f:
+            info = json.load(f)
+        return FrozenClampTokenizer(
+            directory=directory,
+            table=TokenTable(
+                np.load(directory / _TOKEN_DATA_FILE, mmap_mode="r"),
+                np.load(directory / _TOKEN_OFFSETS_FILE, mmap_mode="r"),
+            ),
+            info=info,
+        )
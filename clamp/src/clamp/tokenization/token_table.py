@@ -0,0 +1,119 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""The UTF-8 bytes of every token in a vocabulary, stored in one array."""
+import dataclasses
+import itertools
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Sequence
+
+import numpy as np
+from cached_property import cached_property
+
+
+def _concatenated_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Returns the indices in range(starts[i], starts[i] + lengths[i]) for each i, in order."""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(
+        ends[-1] if len(ends) else 0
+    )
+
+
+@dataclass
+class VocabTrieNode:
+    """Trie over the bytes of the tokens in a vocabulary."""
+
+    children: Dict[np.uint8, "VocabTrieNode"] = dataclasses.field(default_factory=dict)
+    # Tokens which end at this node.
+    token_ids: List[int] = dataclasses.field(default_factory=list)
+
+    @staticmethod
+    def build(tokens: Sequence[Sequence[np.uint8]]) -> "VocabTrieNode":
+        root = VocabTrieNode()
+        for i, token in enumerate(tokens):
+            node = root
+            for byte in token:
+                node = node.children.setdefault(byte, VocabTrieNode())
+            node.token_ids.append(i)
+        return root
+
+
+@dataclass(frozen=True)
+class TokenTable:
+    """Token i is `data[offsets[i]:offsets[i + 1]]`.
+
+    IDs which have no token in the vocabulary have no bytes. Slices of `data` are
+    views, so the grammar layer can use the tokens without copying them."""
+
+    # dtype uint8
+    data: np.ndarray
+    # dtype int64, with one more element than there are token IDs.
+    offsets: np.ndarray
+
+    @staticmethod
+    def from_tokens(id_to_token: Mapping[int, bytes]) -> "TokenTable":
+        size = max(id_to_token, default=-1) + 1
+        tokens = [id_to_token.get(i, b"") for i in range(size)]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in tokens], out=offsets[1:])
+        return TokenTable(np.frombuffer(b"".join(tokens), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def token(self, token_id: int) -> np.ndarray:
+        return self.data[self.offsets[token_id] : self.offsets[token_id + 1]]
+
+    @cached_property
+    def token_arrays(self) -> List[np.ndarray]:
+        """The bytes of every token, as views of `data`."""
+        offsets = self.offsets.tolist()
+        return [self.data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    @cached_property
+    def vocab_trie(self) -> VocabTrieNode:
+        """Trie of every token, shared by all grammars decoded with this vocabulary."""
+        return VocabTrieNode.build(self.token_arrays)
+
+    def lengths(self, token_ids: Iterable[int]) -> np.ndarray:
+        """The number of bytes in each token. IDs outside the table have 0."""
+        ids = np.fromiter(token_ids, dtype=np.int64)
+        if len(self) == 0:
+            return np.zeros(len(ids), dtype=np.int64)
+        valid = (ids >= 0) & (ids < len(self))
+        ids = np.where(valid, ids, 0)
+        return np.where(valid, self.offsets[ids + 1] - self.offsets[ids], 0)
+
+    def decode_bytes(self, token_ids: Sequence[int]) -> bytes:
+        return self.batch_decode_bytes([token_ids])[0]
+
+    def batch_decode_bytes(self, sequences: Sequence[Sequence[int]]) -> List[bytes]:
+        """Concatenates the bytes of the tokens in each sequence, with one gather
+        over all of them. IDs outside the table are skipped."""
+        ids = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64)
+        lengths = self.lengths(ids)
+        starts = self.offsets[np.clip(ids, 0, len(self))]
+        data = self.data[_concatenated_ranges(starts, lengths)].tobytes()
+
+        token_ends = np.concatenate([[0], np.cumsum(lengths)])
+        sequence_ends = np.cumsum([0] + [len(sequence) for sequence in sequences])
+        byte_bounds = token_ends[sequence_ends].tolist()
+        return [
+            data[start:end] for start, end in zip(byte_bounds[:-1], byte_bounds[1:])
+        ]
@@ -0,0 +1,120 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import dataclasses
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import ContextManager, Dict, Iterator, Optional
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    # Total seconds spent in the stage. Concurrent calls are all counted.
+    busy: float = 0.0
+
+
+@dataclass
+class StageTimer:
+    """Accumulates the time spent in named stages, possibly from several threads.
+
+    Stages can overlap, e.g. a model forward pass on an executor thread with parsing
+    on the event loop, so the busy times can add up to more than `wall_time`.
+    A stage named "parent.child" runs within the stage "parent", so its time is
+    not added again to the total busy time.
+
+    It also keeps plain counters of events, like search steps or cache hits.
+
+    >>> timer = StageTimer()
+    >>> with timer.stage("model"):
+    ...     pass
+    >>> timer.stats()["model"].count
+    1
+    """
+
+    _stats: Dict[str, StageStats] = dataclasses.field(default_factory=dict)
+    _counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+    _start: float = dataclasses.field(default_factory=time.perf_counter)
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False
+    )
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats.setdefault(name, StageStats())
+                stats.count += 1
+                stats.busy += elapsed
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def stats(self) -> Dict[str, StageStats]:
+        with self._lock:
+            return {name: dataclasses.replace(s) for name, s in self._stats.items()}
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    @property
+    def wall_time(self) -> float:
+        return time.perf_counter() - self._start
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = {}
+            self._counts = {}
+            self._start = time.perf_counter()
+
+    def report(self) -> str:
+        wall_time = self.wall_time
+        stats = self.stats()
+        lines = [f"Wall time: {wall_time:.3f}s"]
+        for name, s in sorted(stats.items()):
+            lines.append(
+                f"- {name}: {s.busy:.3f}s busy in {s.count} calls "
+                f"({s.busy / wall_time:.1%} of wall time)"
+            )
+        for name, n in sorted(self.counts().items()):
+            lines.append(f"- {name}: {n}")
+        total_busy = sum(s.busy for name, s in stats.items() if "." not in name)
+        # Above 1 only if stages overlapped.
+        lines.append(f"Busy time / wall time: {total_busy / wall_time:.2f}")
+        return "\n".join(lines)
+
+
+def maybe_stage(timer: Optional[StageTimer], name: str) -> ContextManager[None]:
+    """`timer.stage(name)`, or a no-op if `timer` is None."""
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+
+def maybe_count(timer: Optional[StageTimer], name: str, n: int = 1) -> None:
+    """`timer.count(name, n)`, or a no-op if `timer` is None."""
+    if timer is not None:
+        timer.count(name, n)
@@ -17,9 +17,23 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, TypeVar
+import collections
+import itertools
+from concurrent.futures import Executor, Future
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 _A = TypeVar("_A")
+_B = TypeVar("_B")
 _N = TypeVar("_N", int, float)
 _T1 = TypeVar("_T1")
 
@@ -51,6 +65,46 @@ class IteratorGenerator(Iterable[_T1]):
         yield from self.f()
 
 
+def prefetch_map(
+    f: Callable[[_A], _B],
+    items: Iterable[_A],
+    executor: Optional[Executor],
+    num_ahead: int,
+) -> Iterator[Tuple[_A, _B]]:
+    """Lazily yields each item with `f(item)`, in order.
+
+    While the caller uses one result, `f` runs on up to `num_ahead` of the following
+    items in `executor`. Without an executor, or if `num_ahead` is 0, `f` runs in the
+    calling thread when the next item is requested.
+
+    With a thread pool, `f` only overlaps with the caller where one of them releases
+    the GIL (I/O, torch kernels); pure-Python work in `f` competes with the caller."""
+    if executor is None or num_ahead <= 0:
+        for item in items:
+            yield item, f(item)
+        return
+
+    iterator = iter(items)
+    pending: Deque[Tuple[_A, "Future[_B]"]] = collections.deque()
+
+    def submit_next() -> None:
+        assert executor is not None
+        for item in itertools.islice(iterator, 1):
+            pending.append((item, executor.submit(f, item)))
+
+    try:
+        for _ in range(num_ahead + 1):
+            submit_next()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+            submit_next()
+    finally:
+        # If the caller stops early, don't start the rest.
+        for _, future in pending:
+            future.cancel()
+
+
 def bisect_right(
     lst: Sequence[_A],
     elem: _A,
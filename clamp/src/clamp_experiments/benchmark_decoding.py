@@ -0,0 +1,686 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks constrained decoding end to end, without network access or data downloads.
+
+By default, it builds a tiny randomly initialized T5 (or BART) model, with a
+byte-level BPE vocabulary learned from the benchmark data, and for each of a
+fixed set of data a synthetic grammar in the style of the ones that
+dataflow2text_domains.calflow.experiments.create_cfg_productions writes, where
+the reference response is reachable. Pass --grammar_base_dir and
+--eval_data_jsonl to benchmark the grammars and data from the CalFlow
+worksheets instead, and --model_loc for a real model.
+
+It measures:
+- the time to load and compile each grammar;
+- the latency of each `allowed_next` call during beam search;
+- the latency of the model's first step and of each step after that;
+- the throughput, time breakdown and memory of beam search on each datum.
+
+The results are written to a JSON report. With --baseline_file, the summary
+statistics are compared with those of an earlier report, and the exit status
+is 1 if any of them regressed by more than --regression_threshold."""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Counter, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from transformers import (
+    BartConfig,
+    BartForConditionalGeneration,
+    T5Config,
+    T5ForConditionalGeneration,
+)
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from clamp.decoding.partial_parse import PartialParse
+from clamp.decoding.uint8_earley_partial_parse import (
+    UInt8EarleyPartialParse,
+    UInt8GrammarTokenizerInfo,
+)
+from clamp.earley.cfg import load_grammar_from_directory
+from clamp.earley.earley import EarleyStats
+from clamp.search.beam_search_event_listener import BeamSearchEventListener
+from clamp.search.datum import FullDatum
+from clamp.seq2seq.seq2seq_bart import Seq2SeqBart
+from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.tokenization.gpt2_clamp_tokenizer import GPT2ClampTokenizer
+from clamp.util.stage_timer import StageTimer
+from clamp_experiments.codet5_model_config import CodeT5ModelConfig
+from clamp_experiments.datum_resources import ResourceTracker, summarize
+from clamp_experiments.io_utils import load_data_from_json_file
+from clamp_experiments.run_constrained_decoding import (
+    build_seq2seq_bart,
+    make_semantic_parser,
+)
+
+# Inputs and reference responses in the format of
+# dataflow2text_domains.calflow.experiments.process_data.
+BENCHMARK_DATA: Sequence[Tuple[str, str]] = (
+    (
+        'Plan: (Yield (FindEventWrapperWithDefaults (Event.subject_? (?~= "lunch")))) '
+        'Result: [{"subject": "Lunch with Alice", "start": "2023-05-02T12:00"}]',
+        "I found one event matching lunch: Lunch with Alice tomorrow at noon.",
+    ),
+    (
+        "Plan: (Yield (CreateCommitEventWrapper (CreatePreflightEventWrapper "
+        '(Event.subject_? (?= "team sync"))))) '
+        'Result: {"subject": "team sync", "start": "2023-05-03T15:00"}',
+        "I've put team sync on your calendar for Wednesday from 3:00 to 3:30 PM.",
+    ),
+    (
+        "Plan: (Yield (> (size (FindEventWrapperWithDefaults (EventOnDate (Tomorrow) "
+        "(^(Event) EmptyStructConstraint)))) 0L)) Result: true",
+        "Yes, you have 3 events tomorrow.",
+    ),
+    (
+        "Plan: (Yield (Event.start (singleton (FindEventWrapperWithDefaults "
+        '(Event.subject_? (?~= "dentist")))))) Result: "2023-05-05T09:30"',
+        "Your dentist appointment is on Friday at 9:30 AM.",
+    ),
+    (
+        "Plan: (Yield (FindManager (toRecipient (CurrentUser)))) "
+        'Result: {"name": "Bob Smith"}',
+        "Your manager is Bob Smith.",
+    ),
+    (
+        "Plan: (Yield (WeatherQueryApi (AtPlace (Here)) (DateTime.date_? (?= (Today))))) "
+        'Result: {"temperature": 68, "summary": "sunny"}',
+        "It will be sunny today, with a high of 68 degrees.",
+    ),
+)
+_FILLER_WORDS = (
+    "I", "found", "event", "events", "your", "calendar", "on", "at", "with",
+    "tomorrow", "today", "Friday", "meeting", "team", "the", "a", "is", "are",
+    "no", "one", "2", "3", "PM", "AM", "from", "to", "and", "there", "You",
+    "have", "scheduled", "Alice", "Bob", "It", "will", "be", "degrees", ".", ",",
+)  # fmt: skip
+
+
+@dataclass
+class _TimedPartialParse(PartialParse):
+    """Records the latency of each `allowed_next` call of `inner` and its successors."""
+
+    inner: PartialParse
+    latencies: List[float]
+
+    def allowed_next(
+        self, ordered_ids: Optional[torch.Tensor] = None, top_k: Optional[int] = None
+    ) -> Tuple[Optional[torch.Tensor], bool]:
+        start = time.perf_counter()
+        result = self.inner.allowed_next(ordered_ids, top_k)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def append(self, token: int) -> "_TimedPartialParse":
+        return _TimedPartialParse(self.inner.append(token), self.latencies)
+
+    def prefetch(self) -> None:
+        self.inner.prefetch()
+
+
+def _pretokenize(text: str) -> List[str]:
+    """Approximates the GPT-2 pretokenizer, whose pieces are never merged together."""
+    return re.findall(r" ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]+|\s+", text)
+
+
+def learn_bpe_merges(texts: Iterable[str], num_merges: int) -> List[Tuple[str, str]]:
+    """Learns byte-level BPE merges, in the form of GPT-2's merges.txt."""
+    byte_encoder = bytes_to_unicode()
+    word_counts: Counter[str] = collections.Counter(
+        "".join(byte_encoder[b] for b in word.encode("utf-8"))
+        for text in texts
+        for word in _pretokenize(text)
+    )
+    splits = {word: list(word) for word in word_counts}
+    merges: List[Tuple[str, str]] = []
+    for _ in range(num_merges):
+        pair_counts: Counter[Tuple[str, str]] = collections.Counter()
+        for word, count in word_counts.items():
+            parts = splits[word]
+            for pair in zip(parts, parts[1:]):
+                pair_counts[pair] += count
+        if not pair_counts:
+            break
+        # Ties are broken by the pair itself, so that the merges are reproducible.
+        (a, b), _ = max(pair_counts.items(), key=lambda kv: (kv[1], kv[0]))
+        merges.append((a, b))
+        for word, parts in splits.items():
+            merged: List[str] = []
+            i = 0
+            while i < len(parts):
+                if i + 1 < len(parts) and parts[i] == a and parts[i + 1] == b:
+                    merged.append(a + b)
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            splits[word] = merged
+    return merges
+
+
+def write_tiny_model(
+    directory: Path, arch: str, texts: Iterable[str], num_merges: int, seed: int
+) -> None:
+    """Writes a randomly initialized `arch` ("t5" or "bart") model to `directory`,
+    with a GPT-2 tokenizer whose merges are learned from `texts`."""
+    directory.mkdir(parents=True, exist_ok=True)
+    byte_encoder = bytes_to_unicode()
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3}
+    for b in range(256):
+        vocab[byte_encoder[b]] = len(vocab)
+    merges = learn_bpe_merges(texts, num_merges)
+    for a, b in merges:
+        vocab.setdefault(a + b, len(vocab))
+    with open(directory / "vocab.json", "w") as f:
+        json.dump(vocab, f)
+    with open(directory / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+        for a, b in merges:
+            f.write(f"{a} {b}\n")
+    with open(directory / "special_tokens_map.json", "w") as f:
+        json.dump(
+            {
+                "bos_token": "<s>",
+                "eos_token": "</s>",
+                "pad_token": "<pad>",
+                "unk_token": "<unk>",
+            },
+            f,
+        )
+    with open(directory / "seq2seq_settings.json", "w") as f:
+        json.dump(
+            {
+                "input_surround": {"bos": [1], "eos": [2], "starts_with_space": True},
+                "output_surround": {"bos": [1], "eos": [2], "starts_with_space": True},
+                "decoder_start_token_id": 0,
+            },
+            f,
+        )
+
+    torch.manual_seed(seed)
+    if arch == "t5":
+        T5ForConditionalGeneration(
+            T5Config(
+                vocab_size=len(vocab),
+                d_model=64,
+                d_ff=128,
+                num_layers=2,
+                num_heads=4,
+                d_kv=16,
+                decoder_start_token_id=0,
+                pad_token_id=0,
+                eos_token_id=2,
+            )
+        ).save_pretrained(directory)
+    else:
+        BartForConditionalGeneration(
+            BartConfig(
+                vocab_size=len(vocab),
+                d_model=64,
+                encoder_layers=2,
+                decoder_layers=2,
+                encoder_attention_heads=4,
+                decoder_attention_heads=4,
+                encoder_ffn_dim=128,
+                decoder_ffn_dim=128,
+                max_position_embeddings=1024,
+                decoder_start_token_id=0,
+                pad_token_id=0,
+                bos_token_id=1,
+                eos_token_id=2,
+            )
+        ).save_pretrained(directory)
+
+
+def synthetic_grammar(reference: str, num_alternatives: int, rng: random.Random) -> str:
+    """Returns a grammar in the style of create_cfg_productions, which can produce
+    `reference` as well as `num_alternatives` other expansions of each nonterminal.
+
+    The nonterminals form a tree over the words of `reference`, like the
+    nonterminals for the subcomputations of a plan."""
+    productions: List[str] = []
+
+    def terminal(word: str) -> str:
+        return '" "? ' + json.dumps(word)
+
+    def expand(words: List[str]) -> str:
+        name = f"S_{rng.getrandbits(48):012x}"
+        if len(words) <= 2:
+            rhs = [" ".join(terminal(word) for word in words)]
+        else:
+            mid = rng.randint(1, len(words) - 1)
+            rhs = [f"{expand(words[:mid])} {expand(words[mid:])}"]
+        for _ in range(num_alternatives):
+            rhs.append(
+                " ".join(
+                    terminal(rng.choice(_FILLER_WORDS))
+                    for _ in range(rng.randint(1, 4))
+                )
+            )
+        productions.extend(f"{name} -> {alt}" for alt in rhs)
+        return name
+
+    root = expand(_pretokenize_words(reference))
+    return "\n".join([f"start -> {root}"] + sorted(productions)) + "\n"
+
+
+def _pretokenize_words(text: str) -> List[str]:
+    return [piece.strip() for piece in _pretokenize(text) if piece.strip()]
+
+
+def write_synthetic_data(
+    directory: Path, num_alternatives: int, seed: int
+) -> Tuple[str, str]:
+    """Writes BENCHMARK_DATA and a synthetic grammar for each datum to `directory`,
+    in the layout of the CalFlow worksheets, and returns the paths of the data
+    jsonl file and the grammar base directory."""
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    data_jsonl = directory / "data.jsonl"
+    grammar_base_dir = directory / "grammars"
+    with open(data_jsonl, "w") as f:
+        for i, (natural, reference) in enumerate(BENCHMARK_DATA):
+            dialogue_id = f"benchmark-{i:02d}"
+            f.write(
+                json.dumps(
+                    {
+                        "dialogueId": dialogue_id,
+                        "turnIndex": 0,
+                        "input": natural,
+                        "agentUtterance": reference,
+                    }
+                )
+                + "\n"
+            )
+            grammar_dir = grammar_base_dir / f"{dialogue_id}_0"
+            grammar_dir.mkdir(parents=True, exist_ok=True)
+            (grammar_dir / "grammar.cfg").write_text(
+                synthetic_grammar(reference, num_alternatives, rng)
+            )
+    return str(data_jsonl), str(grammar_base_dir)
+
+
+def distribution(values: Sequence[float]) -> Dict[str, float]:
+    """Returns the count, mean, median, 90th and 99th percentiles and maximum of `values`."""
+    if not values:
+        return {"count": 0}
+    array = np.array(values, dtype=float)
+    return {
+        "count": len(array),
+        "mean": float(array.mean()),
+        "p50": float(np.percentile(array, 50)),
+        "p90": float(np.percentile(array, 90)),
+        "p99": float(np.percentile(array, 99)),
+        "max": float(array.max()),
+    }
+
+
+def benchmark_grammars(
+    tokenizer: ClampTokenizer, data: Sequence[FullDatum], grammar_base_dir: str
+) -> Tuple[Dict[str, Any], Dict[str, Tuple[UInt8EarleyPartialParse, EarleyStats]]]:
+    """Loads and compiles the grammar of each datum, and returns the timings
+    and the initial partial parse of each grammar."""
+    timings: Dict[str, Dict[str, float]] = {}
+    partial_parses = {}
+    for datum in data:
+        datum_id = f"{datum.dialogue_id}_{datum.turn_index}"
+        timer = StageTimer()
+        with timer.stage("load"):
+            grammar = load_grammar_from_directory(
+                os.path.join(grammar_base_dir, datum_id)
+            )
+        with timer.stage("tokenizer_info"):
+            info = UInt8GrammarTokenizerInfo.from_clamp_tokenizer(grammar, tokenizer)
+        earley_stats = EarleyStats()
+        with timer.stage("initial"):
+            partial_parse = UInt8EarleyPartialParse.initial(info, earley_stats)
+        timings[datum_id] = {
+            f"{name}_seconds": stats.busy for name, stats in timer.stats().items()
+        }
+        timings[datum_id]["num_nonterms"] = len(grammar.expansions)
+        partial_parses[datum_id] = (partial_parse, earley_stats)
+    summary = {
+        name: distribution([t[name] for t in timings.values()])
+        for name in ["load_seconds", "tokenizer_info_seconds", "initial_seconds"]
+    }
+    return {"per_grammar": timings, "summary": summary}, partial_parses
+
+
+async def benchmark_model_steps(
+    lm: Seq2SeqBart, data: Sequence[FullDatum], num_steps: int
+) -> Dict[str, Any]:
+    """Times the first step (with the encoder) and `num_steps` greedy steps after it
+    for each datum, one datum at a time."""
+    initial_latencies = []
+    extend_latencies = []
+    for datum in data:
+        encoder_tokens = lm.encode_for_encoder(datum.natural)
+        start = time.perf_counter()
+        logprobs, hidden_state = await lm.initial(encoder_tokens, lm.decoder_bos_ids)
+        initial_latencies.append(time.perf_counter() - start)
+        for _ in range(num_steps):
+            assert hidden_state is not None
+            token = int(logprobs[-1].argmax())
+            start = time.perf_counter()
+            logprobs, hidden_state = await lm.extend([token], hidden_state)
+            extend_latencies.append(time.perf_counter() - start)
+    return {
+        "initial_seconds": distribution(initial_latencies),
+        "extend_seconds": distribution(extend_latencies),
+    }
+
+
+async def benchmark_beam_search(
+    lm: Seq2SeqBart,
+    data: Sequence[FullDatum],
+    partial_parses: Dict[str, Tuple[UInt8EarleyPartialParse, EarleyStats]],
+    beam_size: int,
+    max_steps: int,
+    stage_timer: StageTimer,
+) -> Dict[str, Any]:
+    """Decodes each datum with beam search, one at a time."""
+    allowed_next_latencies: List[float] = []
+    resources_by_datum: Dict[str, Dict[str, float]] = {}
+    num_tokens = 0
+    stage_timer.reset()
+    start = time.perf_counter()
+    for datum in data:
+        datum_id = f"{datum.dialogue_id}_{datum.turn_index}"
+        partial_parse, earley_stats = partial_parses[datum_id]
+        timed_partial_parse = _TimedPartialParse(partial_parse, allowed_next_latencies)
+        parser = make_semantic_parser(
+            lm=lm,
+            beam_size=beam_size,
+            partial_parse_builder=lambda _datum: timed_partial_parse,
+            max_steps_fn=lambda _datum: max_steps,
+            keep_finished_nodes=True,
+            event_listener_factory=lambda _datum: BeamSearchEventListener(),
+            stage_timer=stage_timer,
+        )
+        with ResourceTracker(stage_timer, earley_stats).track() as resources:
+            results = await parser.predict(datum)
+        if results:
+            num_tokens += len(results[0].token_costs)
+        resources_by_datum[datum_id] = resources
+    elapsed = time.perf_counter() - start
+    return {
+        "elapsed_seconds": elapsed,
+        "data_per_second": len(data) / elapsed,
+        "tokens_per_second": num_tokens / elapsed,
+        "search_steps_per_second": stage_timer.counts().get("search_steps", 0)
+        / elapsed,
+        "allowed_next_call_seconds": distribution(allowed_next_latencies),
+        "per_datum": resources_by_datum,
+        "summary": {
+            row["resource"]: {k: v for k, v in row.items() if k != "resource"}
+            for row in summarize(resources_by_datum)
+        },
+    }
+
+
+def compare_reports(
+    report: Dict[str, Any], baseline: Dict[str, Any], threshold: float
+) -> List[str]:
+    """Returns a line for each summary statistic in `report` that is worse than in
+    `baseline` by more than the fraction `threshold`. Throughputs ("per_second")
+    are better when higher; everything else is better when lower."""
+    regressions = []
+    current = _flatten_summary(report)
+    for key, old in sorted(_flatten_summary(baseline).items()):
+        new = current.get(key)
+        if new is None or old == 0:
+            continue
+        change = (new - old) / abs(old)
+        if "per_second" in key:
+            change = -change
+        if change > threshold:
+            regressions.append(f"{key}: {old:.4g} -> {new:.4g} ({change:+.1%} worse)")
+    return regressions
+
+
+def _flatten_summary(value: Any, prefix: str = "") -> Dict[str, float]:
+    """Flattens the numbers in a report, except for the configuration and the
+    measurements of individual grammars and data."""
+    if isinstance(value, dict):
+        flat: Dict[str, float] = {}
+        for key, child in value.items():
+            # A single maximum is too noisy to compare.
+            if key in ("config", "per_grammar", "per_datum", "count", "max"):
+                continue
+            flat.update(_flatten_summary(child, f"{prefix}{key}/"))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix.rstrip("/"): float(value)}
+    return {}
+
+
+def main(
+    output_file: str,
+    model_loc: Optional[str] = None,
+    tiny_model_arch: str = "t5",
+    tiny_model_merges: int = 500,
+    eval_data_jsonl: Optional[str] = None,
+    grammar_base_dir: Optional[str] = None,
+    max_num_data: int = 0,
+    synthetic_alternatives: int = 3,
+    beam_size: int = 5,
+    max_steps: int = 64,
+    num_model_steps: int = 32,
+    seed: int = 0,
+    baseline_file: Optional[str] = None,
+    regression_threshold: float = 0.1,
+) -> List[str]:
+    """Returns the regressions found relative to `baseline_file`, if given."""
+    if (eval_data_jsonl is None) != (grammar_base_dir is None):
+        raise ValueError("Give both eval_data_jsonl and grammar_base_dir, or neither")
+    config = dict(locals())
+    config.update(
+        python=platform.python_version(),
+        torch=torch.__version__,
+        platform=platform.platform(),
+        num_threads=torch.get_num_threads(),
+        cuda=torch.cuda.is_available(),
+    )
+    torch.manual_seed(seed)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if eval_data_jsonl is None or grammar_base_dir is None:
+            eval_data_jsonl, grammar_base_dir = write_synthetic_data(
+                Path(work_dir) / "data", synthetic_alternatives, seed
+            )
+        data = load_data_from_json_file(eval_data_jsonl)
+        if max_num_data > 0:
+            data = data[:max_num_data]
+
+        stage_timer = StageTimer()
+        tiny_bart = model_loc is None and tiny_model_arch == "bart"
+        if model_loc is None:
+            model_loc = str(Path(work_dir) / "model")
+            write_tiny_model(
+                Path(model_loc),
+                tiny_model_arch,
+                [text for datum in data for text in (datum.natural, datum.canonical)],
+                tiny_model_merges,
+                seed,
+            )
+        if tiny_bart:
+            # CodeT5ModelConfig only loads T5 models.
+            lm = Seq2SeqBart(
+                pretrained_model_dir=model_loc,
+                model=BartForConditionalGeneration.from_pretrained(model_loc).eval(),
+                clamp_tokenizer=GPT2ClampTokenizer.from_pretrained(model_loc),
+                stage_timer=stage_timer,
+            )
+        else:
+            lm = build_seq2seq_bart(
+                CodeT5ModelConfig(model_loc=Path(model_loc)), stage_timer=stage_timer
+            )
+
+        grammar_report, partial_parses = benchmark_grammars(
+            lm.tokenizer, data, grammar_base_dir
+        )
+
+        async def inner() -> Tuple[Dict[str, Any], Dict[str, Any]]:
+            # Warm up the model, so that one-time costs aren't counted.
+            await benchmark_model_steps(lm, data[:1], 2)
+            model_report = await benchmark_model_steps(lm, data, num_model_steps)
+            decoding_report = await benchmark_beam_search(
+                lm, data, partial_parses, beam_size, max_steps, stage_timer
+            )
+            return model_report, decoding_report
+
+        with torch.no_grad():
+            model_report, decoding_report = asyncio.run(inner())
+
+    report = {
+        "config": config,
+        "grammar_compile": grammar_report,
+        "model_step": model_report,
+        "decoding": decoding_report,
+    }
+    with open(output_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output_file}")
+    for key, value in sorted(_flatten_summary(report).items()):
+        print(f"{key}: {value:.4g}")
+
+    regressions: List[str] = []
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, regression_threshold)
+        print(
+            f"{len(regressions)} regressions of more than {regression_threshold:.0%} "
+            f"relative to {baseline_file}"
+        )
+        for regression in regressions:
+            print(f"- {regression}")
+    return regressions
+
+
+def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
+    argument_parser.add_argument(
+        "--output_file", required=True, help="The JSON report to write."
+    )
+    argument_parser.add_argument(
+        "--model_loc",
+        help="The path to the model files. By default, a tiny random model is used.",
+    )
+    argument_parser.add_argument(
+        "--tiny_model_arch",
+        choices=["t5", "bart"],
+        default="t5",
+        help="The architecture of the tiny random model.",
+    )
+    argument_parser.add_argument(
+        "--tiny_model_merges",
+        type=int,
+        default=500,
+        help="The number of BPE merges in the vocabulary of the tiny random model.",
+    )
+    argument_parser.add_argument(
+        "--eval_data_jsonl",
+        help="The data to decode, e.g. from step02 of the CalFlow worksheets. "
+        "By default, a fixed set of synthetic data is used.",
+    )
+    argument_parser.add_argument(
+        "--grammar_base_dir",
+        help="The grammars of the data in --eval_data_jsonl, e.g. from step01 "
+        "of the CalFlow worksheets.",
+    )
+    argument_parser.add_argument(
+        "--max_num_data",
+        type=int,
+        default=0,
+        help="If positive, only benchmark the first few data.",
+    )
+    argument_parser.add_argument(
+        "--synthetic_alternatives",
+        type=int,
+        default=3,
+        help="The number of alternative expansions of each nonterminal in the "
+        "synthetic grammars, besides the one towards the reference.",
+    )
+    argument_parser.add_argument(
+        "--beam_size", type=int, default=5, help="The beam size."
+    )
+    argument_parser.add_argument(
+        "--max_steps",
+        type=int,
+        default=64,
+        help="The maximum number of beam search steps for each datum.",
+    )
+    argument_parser.add_argument(
+        "--num_model_steps",
+        type=int,
+        default=32,
+        help="The number of model steps to time for each datum, after the first.",
+    )
+    argument_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The seed for the tiny model and the synthetic grammars.",
+    )
+    argument_parser.add_argument(
+        "--baseline_file", help="An earlier report to compare this one with."
+    )
+    argument_parser.add_argument(
+        "--regression_threshold",
+        type=float,
+        default=0.1,
+        help="With --baseline_file, the relative change that counts as a regression.",
+    )
+
+
+if __name__ == "__main__":
+    cmdline_parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(cmdline_parser)
+    args = cmdline_parser.parse_args()
+
+    found_regressions = main(
+        output_file=args.output_file,
+        model_loc=args.model_loc,
+        tiny_model_arch=args.tiny_model_arch,
+        tiny_model_merges=args.tiny_model_merges,
+        eval_data_jsonl=args.eval_data_jsonl,
+        grammar_base_dir=args.grammar_base_dir,
+        max_num_data=args.max_num_data,
+        synthetic_alternatives=args.synthetic_alternatives,
+        beam_size=args.beam_size,
+        max_steps=args.max_steps,
+        num_model_steps=args.num_model_steps,
+        seed=args.seed,
+        baseline_file=args.baseline_file,
+        regression_threshold=args.regression_threshold,
+    )
+    sys.exit(1 if found_regressions else 0)
@@ -24,31 +24,84 @@ from typing import Dict, List, Optional, Tuple
 import torch
 from transformers import PreTrainedModel, T5ForConditionalGeneration
 
+from clamp.seq2seq.frozen_model import (
+    load_frozen_model,
+    read_frozen_index,
+    source_signature,
+)
+from clamp.seq2seq.quantization import Precision, convert_model
 from clamp.seq2seq.seq2seq_helper import Seq2SeqSettings, Surround
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.tokenization.frozen_clamp_tokenizer import FrozenClampTokenizer
 from clamp.tokenization.gpt2_clamp_tokenizer import GPT2ClampTokenizer
+from clamp.util.stage_timer import StageTimer
+
+# Subdirectory of `model_loc` written by clamp_experiments.freeze_model.
+FROZEN_DIR = "frozen"
 
 
 @dataclass
 class CodeT5ModelConfig:
     model_loc: Path
     device_map: Optional[Dict[int, List[int]]] = None
+    # Anything other than FP32 requires running on the CPU.
+    precision: Precision = Precision.FP32
+
+    @property
+    def frozen_loc(self) -> Path:
+        return self.model_loc / FROZEN_DIR
+
+    def has_frozen_model(self) -> bool:
+        """Whether `frozen_loc` has a frozen copy of the current model files."""
+        if not FrozenClampTokenizer.exists(self.frozen_loc):
+            return False
+        if read_frozen_index(self.frozen_loc)["source"] != source_signature(
+            self.model_loc
+        ):
+            print(f"Ignoring {self.frozen_loc}, which is older than {self.model_loc}")
+            return False
+        return True
 
     def setup_model(self) -> Tuple[PreTrainedModel, ClampTokenizer, Seq2SeqSettings]:
         if not self.model_loc.exists():
             raise ValueError(f"Model files not found in {self.model_loc}")
-        model = T5ForConditionalGeneration.from_pretrained(self.model_loc)
+        timer = StageTimer()
+        frozen = self.has_frozen_model()
+        with timer.stage("load_model"):
+            if frozen:
+                model = load_frozen_model(T5ForConditionalGeneration, self.frozen_loc)
+            else:
+                model = T5ForConditionalGeneration.from_pretrained(self.model_loc)
         assert isinstance(model, T5ForConditionalGeneration)
-        tokenizer = GPT2ClampTokenizer.from_pretrained(str(self.model_loc))
+        with timer.stage("load_tokenizer"):
+            tokenizer = self.setup_tokenizer(frozen)
+            # Built here rather than on first use, so that it is counted.
+            _ = tokenizer.utf8_token_to_id_map
         seq2seq_settings = Seq2SeqSettings(
             input_surround=Surround(bos=[1], eos=[2], starts_with_space=True),
             output_surround=Surround(bos=[1], eos=[2], starts_with_space=True),
             decoder_start_token_id=0,
         )
-        self.maybe_parallelize(model)  # type: ignore
-        model.eval()  # type: ignore
+        with timer.stage("place_model"):
+            if self.precision == Precision.FP32:
+                self.maybe_parallelize(model)  # type: ignore
+            else:
+                print(f"Converting model to {self.precision.value} on the CPU")
+                model = convert_model(model, self.precision)  # type: ignore
+            model.eval()  # type: ignore
+        print(
+            f"Model startup ({'frozen' if frozen else 'from_pretrained'}): "
+            + ", ".join(f"{name} {s.busy:.2f}s" for name, s in timer.stats().items())
+        )
         return model, tokenizer, seq2seq_settings  # type: ignore
 
+    def setup_tokenizer(self, frozen: Optional[bool] = None) -> ClampTokenizer:
+        if frozen is None:
+            frozen = self.has_frozen_model()
+        if frozen:
+            return FrozenClampTokenizer.from_pretrained(str(self.frozen_loc))
+        return GPT2ClampTokenizer.from_pretrained(str(self.model_loc))
+
     def maybe_parallelize(self, model: PreTrainedModel) -> None:
         if torch.cuda.is_available():
             if self.device_map is not None and model.is_parallelizable:  # type: ignore
@@ -21,15 +21,19 @@ import argparse
 import csv
 import json
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-import evaluate
-import gem_metrics
-import numpy as np
 import pandas as pd
 
 from clamp.search.datum import FullDatum
 from clamp_experiments.eval_metrics import TopKExactMatch
+from clamp_experiments.metrics_engine import (
+    BertScore,
+    Bleu,
+    MetricsCache,
+    MetricsEngine,
+    Rouge,
+)
 
 
 def _process_string(
@@ -62,16 +66,16 @@ def _load_references(data_tsv: str) -> pd.DataFrame:
         keep_default_na=False,
     )
     datum_ids = [
-        f"{row.get('dialogueId')}_{row.get('turnIndex')}"
-        for _, row in data_df.iterrows()
+        f"{dialogue_id}_{turn_index}"
+        for dialogue_id, turn_index in zip(data_df["dialogueId"], data_df["turnIndex"])
     ]
     normalized_references = [
         _process_string(
-            row.get("agentUtterance"),
+            agent_utterance,
             ignore_case=True,
             strip_spaces=True,
         )
-        for _, row in data_df.iterrows()
+        for agent_utterance in data_df["agentUtterance"]
     ]
     data_df.loc[:, "datumId"] = datum_ids
     data_df.loc[:, "normalizedReference"] = normalized_references
@@ -102,66 +106,56 @@ def main(
     data_tsv: str,
     predictions_json: str,
     output_dir: Path,
+    metrics_cache: Optional[Path] = None,
+    num_workers: int = 1,
+    bertscore_batch_size: int = 64,
 ):
     references_df = _load_references(data_tsv)
     print(f"len(references_df) = {len(references_df)}")
 
     predictions_lookup = _load_predictions(predictions_json)
 
-    gem_preds = gem_metrics.texts.Predictions(
-        {
-            "values": [
-                predictions_lookup.get(datum_id, [""])[0]  # type: ignore
-                for datum_id, row in references_df.iterrows()
-            ]
-        }
-    )
-    gem_refs = gem_metrics.texts.References(
-        {
-            "values": [
-                {"target": [row.get("normalizedReference")]}
-                for _, row in references_df.iterrows()
-            ]
-        }
-    )
-    gem_scores = gem_metrics.compute(
-        outs=gem_preds,
-        refs=gem_refs,
-        metrics_dict=gem_metrics.metric_list_to_metric_dict(["bleu", "rouge"]),
+    datum_ids: List[str] = references_df.index.tolist()
+    references: List[str] = references_df["normalizedReference"].tolist()
+    top_predictions = [
+        predictions_lookup.get(datum_id, [""])[0] for datum_id in datum_ids
+    ]
+
+    engine = MetricsEngine(
+        metrics=[Bleu(), Rouge(), BertScore(bertscore_batch_size)],
+        cache=None if metrics_cache is None else MetricsCache(metrics_cache),
+        num_workers=num_workers,
     )
+    results = engine.compute(top_predictions, references)
+    if engine.cache is not None:
+        engine.cache.close()
+
+    gem_scores = {**results["bleu"].aggregate, **results["rouge"].aggregate}
     print("======= gem_scores = ", json.dumps(gem_scores, indent=2))
 
-    hf_predictions = [
-        predictions_lookup.get(datum_id, [""])[0] for datum_id, row in references_df.iterrows()  # type: ignore
-    ]
-    hf_refs = [row.get("normalizedReference") for _, row in references_df.iterrows()]
-    bertscore = evaluate.load("bertscore")
-    raw_bert_scores = bertscore.compute(
-        predictions=hf_predictions,
-        references=hf_refs,
-        lang="en",
-        rescale_with_baseline=True,
-    )
-    bert_scores = {
-        "precision": np.mean(raw_bert_scores["precision"]),
-        "recall": np.mean(raw_bert_scores["recall"]),
-        "f1": np.mean(raw_bert_scores["f1"]),
-        "hashcode": raw_bert_scores["hashcode"],
+    bert_scores = results["bertscore"].aggregate
+    precision, recall, f1 = zip(*results["bertscore"].scores)
+    raw_bert_scores = {
+        "precision": list(precision),
+        "recall": list(recall),
+        "f1": list(f1),
+        "hashcode": bert_scores["hashcode"],
     }
     print("======= bert_scores = ", json.dumps(bert_scores, indent=2))
 
     exact_match: TopKExactMatch = TopKExactMatch(10)
-    datum_id: str
-    for datum_id, row in references_df.iterrows():
+    for datum_id, reference in zip(datum_ids, references):
         predictions = predictions_lookup.get(datum_id, [""])
-        reference = FullDatum(
-            dialogue_id=None,
-            turn_index=None,
-            agent_context=None,
-            natural="",
-            canonical=row.get("normalizedReference"),
+        exact_match.update(
+            predictions,
+            FullDatum(
+                dialogue_id=None,
+                turn_index=None,
+                agent_context=None,
+                natural="",
+                canonical=reference,
+            ),
         )
-        exact_match.update(predictions, reference)
     recall_scores = exact_match.compute()
     print("======= recall_scores = ", json.dumps(recall_scores, indent=2))
 
@@ -182,6 +176,23 @@ def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
         "--predictions_json", help="The predictions json file."
     )
     argument_parser.add_argument("--output_dir", help="The output directory.")
+    argument_parser.add_argument(
+        "--metrics_cache",
+        help="A SQLite file with the metric scores of (prediction, reference) pairs, "
+        "which is created if needed. Evaluations that share it only score new pairs.",
+    )
+    argument_parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="The number of processes that compute BLEU and ROUGE.",
+    )
+    argument_parser.add_argument(
+        "--bertscore_batch_size",
+        type=int,
+        default=64,
+        help="The number of pairs in each BERTScore batch.",
+    )
 
 
 if __name__ == "__main__":
@@ -193,4 +204,7 @@ if __name__ == "__main__":
         data_tsv=args.data_tsv,
         predictions_json=args.predictions_json,
         output_dir=Path(args.output_dir),
+        metrics_cache=None if args.metrics_cache is None else Path(args.metrics_cache),
+        num_workers=args.num_workers,
+        bertscore_batch_size=args.bertscore_batch_size,
     )
@@ -0,0 +1,185 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Measures the time and resources spent decoding each datum.
+
+`run_experiment` records these in the `resources` of each DatumResult, and
+`gather_decoding_results` summarizes them, so that slow data can be told apart
+by whether they spent their time in the grammar or in the model."""
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+from clamp.earley.earley import EarleyStats
+from clamp.util.stage_timer import StageTimer
+
+
+@dataclass
+class ResourceTracker:
+    """Attributes the stages and counters of `stage_timer` to the datum being decoded,
+    so the data must be decoded one at a time.
+
+    If the model runs in an InferenceServer, its stages are recorded in the server
+    and are missing here. The encoder is only timed separately from the rest of the
+    model when it runs on its own, i.e. with an encoder cache or a traced model."""
+
+    stage_timer: Optional[StageTimer] = None
+    # Counts the work done in the datum's Earley chart.
+    earley_stats: Optional[EarleyStats] = None
+    # Resources measured before decoding started, like the time to load the grammar.
+    initial: Dict[str, float] = field(default_factory=dict)
+    # How often the resident set size is sampled for "peak_rss_mb".
+    rss_sample_seconds: float = 0.05
+
+    @contextmanager
+    def track(self) -> Iterator[Dict[str, float]]:
+        """Yields a dictionary that is filled in with the resources used in the block."""
+        resources = dict(self.initial)
+        stats_before = {} if self.stage_timer is None else self.stage_timer.stats()
+        counts_before = {} if self.stage_timer is None else self.stage_timer.counts()
+        earley_before = _earley_counts(self.earley_stats)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        rss_sampler = _RSSSampler.start(self.rss_sample_seconds)
+        start = time.perf_counter()
+
+        try:
+            yield resources
+        finally:
+            peak_rss = None if rss_sampler is None else rss_sampler.stop()
+
+        resources["elapsed_seconds"] = time.perf_counter() - start
+        if self.stage_timer is not None:
+            for name, stats in self.stage_timer.stats().items():
+                before = stats_before.get(name)
+                busy = stats.busy - (0.0 if before is None else before.busy)
+                # "model.encoder" becomes "encoder_seconds".
+                resources[f"{name.split('.')[-1]}_seconds"] = busy
+            for name, count in self.stage_timer.counts().items():
+                resources[name] = count - counts_before.get(name, 0)
+        if "model_seconds" in resources:
+            resources["decoder_seconds"] = resources["model_seconds"] - resources.get(
+                "encoder_seconds", 0.0
+            )
+        for name, count in _earley_counts(self.earley_stats).items():
+            resources[name] = count - earley_before[name]
+
+        if peak_rss is not None:
+            resources["peak_rss_mb"] = peak_rss / 2 ** 20
+        # The peak of the whole process so far, which never decreases from one datum
+        # to the next. In KiB on Linux but bytes on macOS.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        resources["process_peak_rss_mb"] = max_rss / (
+            2 ** 20 if sys.platform == "darwin" else 2 ** 10
+        )
+        if torch.cuda.is_available():
+            resources["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+
+
+class _RSSSampler:
+    """Samples the resident set size of the process on a thread, to find its peak
+    while a datum is decoded. Spikes shorter than the sampling interval are missed."""
+
+    def __init__(self, interval: float, statm: IO[str]):
+        self.interval = interval
+        self.statm = statm
+        self.peak = self._current()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="rss-sampler", daemon=True
+        )
+        self._thread.start()
+
+    @staticmethod
+    def start(interval: float) -> "Optional[_RSSSampler]":
+        """Returns None where the current RSS can't be read, i.e. outside of Linux."""
+        try:
+            # pylint: disable=consider-using-with
+            statm = open("/proc/self/statm")
+        except OSError:
+            return None
+        return _RSSSampler(interval, statm)
+
+    def stop(self) -> int:
+        """Stops sampling, and returns the peak RSS in bytes."""
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._current())
+        self.statm.close()
+        return self.peak
+
+    def _current(self) -> int:
+        self.statm.seek(0)
+        # The second field is the number of resident pages.
+        return int(self.statm.read().split()[1]) * resource.getpagesize()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, self._current())
+
+
+def _earley_counts(earley_stats: Optional[EarleyStats]) -> Dict[str, int]:
+    if earley_stats is None:
+        return {}
+    return {
+        "earley_predicted": earley_stats.predicted,
+        "earley_scanned": earley_stats.scanned,
+        "earley_attached": earley_stats.attached,
+    }
+
+
+def bound(resources: Dict[str, float]) -> Optional[str]:
+    """Returns whether decoding the datum spent more time in the "grammar" or in
+    the "model", or None if the model wasn't timed.
+
+    Loading the grammar is not counted, since it overlaps with decoding other data."""
+    if "model_seconds" not in resources:
+        return None
+    grammar_seconds = resources.get("allowed_next_seconds", 0.0) + resources.get(
+        "grammar_seconds", 0.0
+    )
+    return "grammar" if grammar_seconds > resources["model_seconds"] else "model"
+
+
+def summarize(resources_by_datum: Dict[str, Dict[str, float]]) -> List[Dict[str, Any]]:
+    """Returns the count, mean, median, 90th percentile and maximum of each resource."""
+    names = sorted({name for r in resources_by_datum.values() for name in r})
+    rows = []
+    for name in names:
+        values = np.array(
+            [r[name] for r in resources_by_datum.values() if name in r], dtype=float
+        )
+        rows.append(
+            {
+                "resource": name,
+                "count": len(values),
+                "mean": values.mean(),
+                "p50": np.percentile(values, 50),
+                "p90": np.percentile(values, 90),
+                "max": values.max(),
+            }
+        )
+    return rows
@@ -50,3 +50,6 @@ class DatumResult:
     # Token-level log probabilities for each sequence in the final beam
     # (Not yet implemented)
     token_logprobs: Optional[List[List[Tuple[str, float]]]] = None
+
+    # Time and resources spent decoding the datum (see ResourceTracker)
+    resources: Optional[Dict[str, float]] = None
@@ -35,6 +35,7 @@ from typing import (
     Mapping,
     Optional,
     Sequence,
+    TextIO,
     Tuple,
 )
 
@@ -44,8 +45,13 @@ from clamp.async_tools import limits
 from clamp.search.datum import FullDatum, FullDatumSub
 from clamp.search.model import Model, ModelResult
 from clamp.util import logger
+from clamp_experiments.datum_resources import ResourceTracker
 from clamp_experiments.datum_result import DatumResult
 from clamp_experiments.eval_metrics import Metric
+from clamp_experiments.results_store import ResultsStore
+
+# The name of the results in an experiment's log directory.
+RESULTS_FILE = "results.json"
 
 
 @dataclass
@@ -55,6 +61,8 @@ class Experiment(Generic[FullDatumSub]):
     test_data: List[FullDatumSub]
     metrics: Mapping[str, Metric[Sequence[str], FullDatumSub]]
     log_dir: Optional[Path] = None
+    # If set, the resources used for each datum are recorded with its results.
+    resource_tracker: Optional[ResourceTracker] = None
 
 
 async def run_experiment(
@@ -67,22 +75,31 @@ async def run_experiment(
     num_eval_examples: Optional[int] = None,
     rank: int = 0,
     world_size: int = 1,
-) -> None:
-    if log_dir is None:
+    results_store: Optional[ResultsStore] = None,
+) -> bool:
+    """If `results_store` is given, the results are written there instead of to a
+    directory under `log_dir`, and output is not logged to files.
+
+    Returns whether the experiment is finished, now or by an earlier run, rather
+    than having failed or had nothing to run."""
+    if log_dir is None and results_store is None:
         if exp.log_dir is None:
             print("At least one of log_dir and exp.log_dir needs to be provided")
-            return
+            return False
         log_dir = exp.log_dir
 
     if world_size == 1:
-        exp_log_dir = log_dir / exp_name
+        exp_key = exp_name
     else:
-        exp_log_dir = log_dir / f"{exp_name}_rank-{rank:02d}-of-{world_size:02d}"
-    exp_log_dir.mkdir(exist_ok=True, parents=True)
-    results_path = exp_log_dir / "results.json"
-    if results_path.exists() and not rerun:
+        exp_key = f"{exp_name}_rank-{rank:02d}-of-{world_size:02d}"
+    if results_store is None:
+        assert log_dir is not None
+        exp_log_dir = log_dir / exp_key
+        exp_log_dir.mkdir(exist_ok=True, parents=True)
+        results_path = exp_log_dir / RESULTS_FILE
+    if is_finished(exp_key, log_dir, results_store) and not rerun:
         print(f"Skipping {exp_name}, already finished")
-        return
+        return True
     print("********************")
     print(f"Running {exp_name} rank {rank} world size {world_size}")
     print("********************")
@@ -96,7 +113,7 @@ async def run_experiment(
     )
     if not test_data:
         print(f"No test data! ids: {ids}")
-        return
+        return False
 
     print(f"Total test examples: {len(test_data)}")
     test_data = test_data[
@@ -111,30 +128,44 @@ async def run_experiment(
     current_test_index = 0
 
     # Find past model outputs
-    candidate_past_model_outputs: List[Tuple[pathlib.Path, List[Dict]]] = []
-    for past_model_outputs_path in exp_log_dir.glob("model_outputs.*.jsonl"):
-        candidate_past_model_outputs.append(
-            (
-                past_model_outputs_path,
-                [json.loads(line) for line in open(past_model_outputs_path, "r")],
-            )
-        )
-    if candidate_past_model_outputs:
-        past_model_outputs_path, past_model_outputs_to_copy = max(
-            candidate_past_model_outputs, key=lambda t: len(t[1])
-        )
-        if len(past_model_outputs_to_copy) > 0:
+    past_model_outputs_to_copy: List[Dict]
+    if results_store is not None:
+        past_model_outputs_to_copy = results_store.model_outputs(exp_key)
+        if past_model_outputs_to_copy:
             print(
-                f"*** Copying {len(past_model_outputs_to_copy)} past results from {past_model_outputs_path} ***"
+                f"*** Reusing {len(past_model_outputs_to_copy)} past results from {results_store.path} ***"
             )
     else:
-        past_model_outputs_to_copy = []
+        candidate_past_model_outputs: List[Tuple[pathlib.Path, List[Dict]]] = []
+        for past_model_outputs_path in exp_log_dir.glob("model_outputs.*.jsonl"):
+            candidate_past_model_outputs.append(
+                (
+                    past_model_outputs_path,
+                    [json.loads(line) for line in open(past_model_outputs_path, "r")],
+                )
+            )
+        if candidate_past_model_outputs:
+            past_model_outputs_path, past_model_outputs_to_copy = max(
+                candidate_past_model_outputs, key=lambda t: len(t[1])
+            )
+            if len(past_model_outputs_to_copy) > 0:
+                print(
+                    f"*** Copying {len(past_model_outputs_to_copy)} past results from {past_model_outputs_path} ***"
+                )
+        else:
+            past_model_outputs_to_copy = []
 
-    with logger.intercept_output(
-        exp_log_dir / f"stdout.{now}", exp_log_dir / f"stderr.{now}"
-    ), open(
-        exp_log_dir / f"model_outputs.{now}.jsonl", "w"
-    ) as model_outputs_f, ExitStack() as _logger_cm:
+    with ExitStack() as stack:
+        model_outputs_f: Optional[TextIO] = None
+        if results_store is None:
+            stack.enter_context(
+                logger.intercept_output(
+                    exp_log_dir / f"stdout.{now}", exp_log_dir / f"stderr.{now}"
+                )
+            )
+            model_outputs_f = stack.enter_context(
+                open(exp_log_dir / f"model_outputs.{now}.jsonl", "w")
+            )
 
         try:
             for metric in exp.metrics.values():
@@ -150,15 +181,26 @@ async def run_experiment(
                 )
                 for metric in exp.metrics.values():
                     metric.update(past_model_output["outputs"], test_datum)
-                model_outputs_f.write(json.dumps(past_model_output) + "\n")
-            model_outputs_f.flush()
+                if model_outputs_f is not None:
+                    model_outputs_f.write(json.dumps(past_model_output) + "\n")
+            if model_outputs_f is not None:
+                model_outputs_f.flush()
 
             start_time = time.time()
             first_unprocessed_test_index = current_test_index
 
+            async def predict(
+                datum: FullDatum,
+            ) -> Tuple[List[ModelResult], Optional[Dict[str, float]]]:
+                if exp.resource_tracker is None:
+                    return await exp.model.predict(datum), None
+                with exp.resource_tracker.track() as resources:
+                    kbest = await exp.model.predict(datum)
+                return kbest, resources
+
             async with exp.client:
-                async for kbest, test_datum in limits.map_async_limited(
-                    exp.model.predict,
+                async for (kbest, resources), test_datum in limits.map_async_limited(
+                    predict,
                     test_data[len(past_model_outputs_to_copy) :],
                     max_concurrency=1,
                     wrap_exception=not debug,
@@ -173,9 +215,7 @@ async def run_experiment(
                             all_metric_results_for_datum[
                                 f"{metric_name}/{key}"
                             ] = value_str
-                    print(
-                        exp_log_dir, json.dumps(all_metric_results_for_datum, indent=4)
-                    )
+                    print(exp_key, json.dumps(all_metric_results_for_datum, indent=4))
                     results = DatumResult(
                         test_datum.natural,
                         kbest,
@@ -186,9 +226,19 @@ async def run_experiment(
                         test_datum.agent_context,
                         test_datum.canonical,
                         beam_token_costs,
+                        resources,
                     )
-                    model_outputs_f.write(jsons.dumps(results) + "\n")
-                    model_outputs_f.flush()
+                    if results_store is not None:
+                        results_store.add_model_output(
+                            exp_key,
+                            current_test_index,
+                            f"{test_datum.dialogue_id}_{test_datum.turn_index}",
+                            jsons.dumps(results),
+                        )
+                    else:
+                        assert model_outputs_f is not None
+                        model_outputs_f.write(jsons.dumps(results) + "\n")
+                        model_outputs_f.flush()
 
                     # TODO: Delete this call and replace it with more flexible logging?
                     _exact_match_with_logging(test_datum, kbest)
@@ -202,25 +252,30 @@ async def run_experiment(
             print(f"- Items processed: {num_processed}")
             print(f"- Elapsed: {elapsed}")
             print(f"- Per item: {per_item}")
-            with open(f"{exp_log_dir}/timings.json", "w") as f:
-                json.dump(
-                    {
-                        "num_processed": num_processed,
-                        "elapsed": elapsed,
-                        "per_item": per_item,
-                    },
-                    f,
-                )
+            timings = {
+                "num_processed": num_processed,
+                "elapsed": elapsed,
+                "per_item": per_item,
+            }
+            if results_store is None:
+                with open(f"{exp_log_dir}/timings.json", "w") as f:
+                    json.dump(timings, f)
 
             for metric_name, metric in exp.metrics.items():
                 for key, value in metric.compute().items():
                     all_metric_results[f"{metric_name}/{key}"] = value
 
-            print(results_path, json.dumps(all_metric_results, indent=4))
+            print(exp_key, json.dumps(all_metric_results, indent=4))
 
             if not ids:
-                with open(results_path, "w") as results_f:
-                    json.dump(all_metric_results, results_f)
+                if results_store is not None:
+                    results_store.finish_experiment(
+                        exp_key, all_metric_results, timings
+                    )
+                else:
+                    with open(results_path, "w") as results_f:
+                        json.dump(all_metric_results, results_f)
+            return True
         except (KeyboardInterrupt, bdb.BdbQuit):  # pylint: disable=try-except-raise
             # If we get Ctrl-C then we want to stop the entire program,
             # instead of just skipping this one experiment.
@@ -243,6 +298,19 @@ async def run_experiment(
                 raise
             # Log the exception, and move onto the next item in `exps`.
             traceback.print_exc()
+            return False
+
+
+def is_finished(
+    exp_key: str,
+    log_dir: Optional[pathlib.Path],
+    results_store: Optional[ResultsStore] = None,
+) -> bool:
+    """Whether `run_experiment` has written the results of the experiment `exp_key`."""
+    if results_store is not None:
+        return results_store.metrics(exp_key) is not None
+    assert log_dir is not None
+    return (log_dir / exp_key / RESULTS_FILE).exists()
 
 
 def _exact_match_with_logging(
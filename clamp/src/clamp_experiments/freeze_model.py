@@ -0,0 +1,64 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Writes a frozen copy of a CodeT5 model for faster startups.
+
+The copy goes into the `frozen` subdirectory of the model directory, where
+CodeT5ModelConfig finds it: the weights are memory-mapped instead of unpickled,
+and the tokenizer's token table is read from compact binary files instead of
+being rebuilt from the vocabulary. Run this again after changing the model files;
+until then, the stale copy is ignored."""
+import argparse
+from pathlib import Path
+
+from transformers import T5ForConditionalGeneration
+
+from clamp.seq2seq.frozen_model import save_frozen_model, source_signature
+from clamp.tokenization.frozen_clamp_tokenizer import FrozenClampTokenizer
+from clamp_experiments.codet5_model_config import CodeT5ModelConfig
+
+
+def main(model_loc: str) -> None:
+    model_config = CodeT5ModelConfig(model_loc=Path(model_loc))
+    # Read before loading anything, so that a concurrent change to the model files
+    # makes the frozen copy stale rather than silently mismatched.
+    source = source_signature(model_config.model_loc)
+    model = T5ForConditionalGeneration.from_pretrained(model_config.model_loc)
+    tokenizer = model_config.setup_tokenizer(frozen=False)
+
+    print(f"Writing {model_config.frozen_loc}")
+    save_frozen_model(model, model_config.frozen_loc, source)  # type: ignore
+    FrozenClampTokenizer.freeze(tokenizer, model_config.frozen_loc)
+
+    # Reports the startup time with the frozen copy.
+    model_config.setup_model()
+
+
+def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
+    argument_parser.add_argument(
+        "--model_loc", required=True, help="The path to the model files."
+    )
+
+
+if __name__ == "__main__":
+    cmdline_parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(cmdline_parser)
+    args = cmdline_parser.parse_args()
+
+    main(model_loc=args.model_loc)
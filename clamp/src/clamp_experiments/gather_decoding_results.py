@@ -19,11 +19,18 @@
 
 """Gathers results from clamp_experiments.run_{unconstrained,constrained}_decoding."""
 import argparse
+import csv
 import json
 import os
 from pathlib import Path
+from typing import Dict
 
-from clamp_experiments.ranked_predictions import RankedPredictions, load_clamp_outputs
+from clamp_experiments.datum_resources import bound, summarize
+from clamp_experiments.ranked_predictions import (
+    RankedPredictions,
+    load_clamp_outputs,
+    model_outputs_by_experiment,
+)
 
 
 def main(experiments_base_dir: str, output_dir: str):
@@ -52,6 +59,54 @@ def main(experiments_base_dir: str, output_dir: str):
         for datum_id in empty_prediction_datum_ids:
             fp.write(f"{datum_id}\n")
 
+    resources_by_datum = _load_resources(Path(experiments_base_dir))
+    if resources_by_datum:
+        _write_resources(resources_by_datum, output_dir)
+
+
+def _load_resources(experiments_base_dir: Path) -> Dict[str, Dict[str, float]]:
+    """Returns the resources recorded for each datum, if any (see ResourceTracker)."""
+    resources_by_datum = {}
+    for _, model_outputs in model_outputs_by_experiment(experiments_base_dir):
+        for model_output in model_outputs:
+            resources = model_output.get("resources")
+            if resources is not None:
+                datum_id = f"{model_output['test_datum_id']}_{model_output['test_datum_turn_part_index']}"
+                resources_by_datum[datum_id] = resources
+    return resources_by_datum
+
+
+def _write_resources(
+    resources_by_datum: Dict[str, Dict[str, float]], output_dir: str
+) -> None:
+    """Writes the resources of each datum to resources.tsv, and their distribution
+    over the data to resources_summary.tsv."""
+    names = sorted({name for r in resources_by_datum.values() for name in r})
+    with open(os.path.join(output_dir, "resources.tsv"), "w", newline="") as fp:
+        writer = csv.writer(fp, delimiter="\t")
+        writer.writerow(["datum_id", "bound"] + names)
+        for datum_id, resources in sorted(resources_by_datum.items()):
+            writer.writerow(
+                [datum_id, bound(resources) or ""]
+                + [resources.get(name, "") for name in names]
+            )
+
+    summary = summarize(resources_by_datum)
+    with open(os.path.join(output_dir, "resources_summary.tsv"), "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=list(summary[0]), delimiter="\t")
+        writer.writeheader()
+        writer.writerows(summary)
+
+    print(f"Resources of {len(resources_by_datum)} data:")
+    for row in summary:
+        print(
+            f"- {row['resource']}: mean {row['mean']:.4g}, p50 {row['p50']:.4g}, "
+            f"p90 {row['p90']:.4g}, max {row['max']:.4g}"
+        )
+    bounds = [bound(resources) for resources in resources_by_datum.values()]
+    for b in ["grammar", "model"]:
+        print(f"{b.capitalize()}-bound data: {bounds.count(b)}")
+
 
 def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
     argument_parser.add_argument(
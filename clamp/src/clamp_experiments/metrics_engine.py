@@ -0,0 +1,310 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Computes text generation metrics over many (prediction, reference) pairs,
+caching the score of each pair on disk.
+
+Each metric scores every pair on its own and then aggregates the scores, so a
+pair scored in an earlier evaluation, e.g. of another run on the same data, is
+looked up in the cache rather than scored again:
+- BLEU caches the n-gram statistics of each pair and sums them into corpus
+  BLEU, which is the same as scoring the whole corpus at once;
+- ROUGE caches the scores of each pair and bootstraps them, with the same
+  settings and aggregation as gem-metrics;
+- BERTScore caches the scores of each pair, which are computed in batches. Its
+  model is only loaded if some pairs aren't in the cache.
+
+BLEU and ROUGE are computed in a pool of processes, BERTScore in this one."""
+import functools
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import bert_score
+import numpy as np
+import sacrebleu
+import torch
+from bert_score.utils import get_hash, lang2model, model2layers
+from rouge_score import rouge_scorer, scoring
+from sacrebleu.metrics import BLEU
+
+Pair = Tuple[str, str]
+
+ROUGE_TYPES = ("rouge1", "rouge2", "rougeL", "rougeLsum")
+
+
+class MetricsCache:
+    """Stores the score of each (prediction, reference) pair under each metric in a SQLite file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Wait for other processes to finish writing, instead of failing.
+        self._conn = sqlite3.connect(str(path), timeout=600)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            # `score` is JSON-encoded.
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "metric TEXT, prediction TEXT, reference TEXT, score TEXT, "
+                "PRIMARY KEY (metric, prediction, reference))"
+            )
+
+    def get(self, metric: str, pairs: Sequence[Pair]) -> Dict[Pair, Any]:
+        """Returns the scores of the pairs in `pairs` that are in the cache."""
+        found = {}
+        for pair in set(pairs):
+            row = self._conn.execute(
+                "SELECT score FROM scores "
+                "WHERE metric = ? AND prediction = ? AND reference = ?",
+                (metric, pair[0], pair[1]),
+            ).fetchone()
+            if row is not None:
+                found[pair] = json.loads(row[0])
+        return found
+
+    def put(self, metric: str, scores: Dict[Pair, Any]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                [
+                    (metric, prediction, reference, json.dumps(score))
+                    for (prediction, reference), score in scores.items()
+                ],
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class PairMetric(ABC):
+    """A metric that scores each (prediction, reference) pair on its own."""
+
+    # The name of the metric in the results.
+    name: str
+
+    @property
+    @abstractmethod
+    def cache_key(self) -> str:
+        """Identifies the metric and its settings in the cache."""
+
+    @abstractmethod
+    def score(self, pairs: Sequence[Pair], executor: Optional[Executor]) -> List[Any]:
+        """Returns the JSON-serializable score of each pair in `pairs`."""
+
+    @abstractmethod
+    def aggregate(self, scores: Sequence[Any]) -> Dict[str, Any]:
+        """Combines the scores of all pairs into the metric's results."""
+
+
+def _map(
+    executor: Optional[Executor], fn: Callable[[str, str], Any], pairs: Sequence[Pair]
+) -> List[Any]:
+    predictions = [prediction for prediction, _ in pairs]
+    references = [reference for _, reference in pairs]
+    if executor is None:
+        return list(map(fn, predictions, references))
+    # Chunks amortize sending the work to the processes.
+    return list(executor.map(fn, predictions, references, chunksize=64))
+
+
+@functools.lru_cache(maxsize=None)
+def _bleu() -> BLEU:
+    return BLEU()
+
+
+def _bleu_statistics(prediction: str, reference: str) -> List[int]:
+    score = _bleu().corpus_score([prediction], [[reference]])
+    return [*score.counts, *score.totals, score.sys_len, score.ref_len]
+
+
+class Bleu(PairMetric):
+    name = "bleu"
+
+    @property
+    def cache_key(self) -> str:
+        # The tokenization can change between versions.
+        return f"bleu/sacrebleu-{sacrebleu.__version__}"
+
+    def score(self, pairs: Sequence[Pair], executor: Optional[Executor]) -> List[Any]:
+        return _map(executor, _bleu_statistics, pairs)
+
+    def aggregate(self, scores: Sequence[Any]) -> Dict[str, Any]:
+        order = _bleu().max_ngram_order
+        totals = np.array(scores, dtype=np.int64).reshape(-1, 2 * order + 2).sum(0)
+        result = BLEU.compute_bleu(
+            correct=totals[:order].tolist(),
+            total=totals[order : 2 * order].tolist(),
+            sys_len=int(totals[-2]),
+            ref_len=int(totals[-1]),
+            smooth_method=_bleu().smooth_method,
+        )
+        return {"bleu": result.score}
+
+
+@functools.lru_cache(maxsize=None)
+def _rouge_scorer() -> rouge_scorer.RougeScorer:
+    return rouge_scorer.RougeScorer(list(ROUGE_TYPES), use_stemmer=True)
+
+
+def _rouge_scores(prediction: str, reference: str) -> Dict[str, List[float]]:
+    # Like gem-metrics, the texts are scored as they are, without splitting
+    # them into sentences for rougeLsum.
+    scores = _rouge_scorer().score(reference, prediction)
+    return {
+        rouge_type: [score.precision, score.recall, score.fmeasure]
+        for rouge_type, score in scores.items()
+    }
+
+
+class Rouge(PairMetric):
+    """ROUGE as gem-metrics computes it for single references: the middle of the
+    bootstrapped confidence interval of the mean, in percent."""
+
+    name = "rouge"
+
+    @property
+    def cache_key(self) -> str:
+        return "rouge/stemmed/unsplit"
+
+    def score(self, pairs: Sequence[Pair], executor: Optional[Executor]) -> List[Any]:
+        return _map(executor, _rouge_scores, pairs)
+
+    def aggregate(self, scores: Sequence[Any]) -> Dict[str, Any]:
+        aggregator = scoring.BootstrapAggregator()
+        for pair_scores in scores:
+            aggregator.add_scores(
+                {
+                    rouge_type: scoring.Score(*pair_scores[rouge_type])
+                    for rouge_type in ROUGE_TYPES
+                }
+            )
+        return {
+            rouge_type: {
+                "precision": 100 * float(aggregate.mid.precision),
+                "recall": 100 * float(aggregate.mid.recall),
+                "fmeasure": 100 * float(aggregate.mid.fmeasure),
+            }
+            for rouge_type, aggregate in aggregator.aggregate().items()
+        }
+
+
+@dataclass
+class BertScore(PairMetric):
+    """BERTScore with the default English model, rescaled with its baseline."""
+
+    batch_size: int = 64
+    name = "bertscore"
+    # Loaded by `score`, so that nothing is loaded if every pair is in the cache.
+    scorer: Optional[bert_score.BERTScorer] = field(init=False, default=None)
+
+    @property
+    def hashcode(self) -> str:
+        """Identifies the model, its settings and the library versions, like
+        `BERTScorer.hash`, without loading the model."""
+        model_type = lang2model["en"]
+        return get_hash(
+            model_type,
+            model2layers[model_type],
+            idf=False,
+            rescale_with_baseline=True,
+            use_custom_baseline=False,
+            use_fast_tokenizer=False,
+        )
+
+    @property
+    def cache_key(self) -> str:
+        return f"bertscore/{self.hashcode}"
+
+    def score(self, pairs: Sequence[Pair], executor: Optional[Executor]) -> List[Any]:
+        if self.scorer is None:
+            self.scorer = bert_score.BERTScorer(lang="en", rescale_with_baseline=True)
+            assert self.scorer.hash == self.hashcode
+        # The model runs in this process; BERTScorer sorts the pairs by length
+        # so that each batch needs little padding.
+        precision, recall, f1 = self.scorer.score(
+            [prediction for prediction, _ in pairs],
+            [reference for _, reference in pairs],
+            batch_size=self.batch_size,
+        )
+        return torch.stack([precision, recall, f1], dim=1).tolist()
+
+    def aggregate(self, scores: Sequence[Any]) -> Dict[str, Any]:
+        precision, recall, f1 = np.array(scores, dtype=float).reshape(-1, 3).mean(0)
+        return {
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "hashcode": self.hashcode,
+        }
+
+
+@dataclass
+class MetricScores:
+    # The results of `PairMetric.aggregate`.
+    aggregate: Dict[str, Any]
+    # The score of each pair, in order.
+    scores: List[Any]
+
+
+@dataclass
+class MetricsEngine:
+    metrics: Sequence[PairMetric]
+    cache: Optional[MetricsCache] = None
+    # With more than 1, BLEU and ROUGE are computed in a pool of this many processes.
+    num_workers: int = 1
+
+    def compute(
+        self, predictions: Sequence[str], references: Sequence[str]
+    ) -> Dict[str, MetricScores]:
+        """Scores each prediction against the reference at the same position, and
+        returns the results of each metric by name."""
+        assert len(predictions) == len(references)
+        pairs = list(zip(predictions, references))
+        results = {}
+        with (
+            ProcessPoolExecutor(self.num_workers)
+            if self.num_workers > 1
+            else nullcontext()
+        ) as executor:
+            for metric in self.metrics:
+                scores = (
+                    {}
+                    if self.cache is None
+                    else self.cache.get(metric.cache_key, pairs)
+                )
+                # Each distinct pair is only scored once.
+                missing = sorted(set(pairs) - scores.keys())
+                print(
+                    f"{metric.name}: {len(scores)} cached, scoring {len(missing)} pairs"
+                )
+                if missing:
+                    new_scores = dict(zip(missing, metric.score(missing, executor)))
+                    if self.cache is not None:
+                        self.cache.put(metric.cache_key, new_scores)
+                    scores.update(new_scores)
+                pair_scores = [scores[pair] for pair in pairs]
+                results[metric.name] = MetricScores(
+                    metric.aggregate(pair_scores), pair_scores
+                )
+        return results
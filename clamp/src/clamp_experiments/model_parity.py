@@ -0,0 +1,306 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Compares a reduced-precision or traced model with the eager fp32 model on held-out data.
+
+For each datum, the reference output is teacher-forced through both models to
+compare their next-token distributions, and then both models decode the datum to
+compare the exact match of their top predictions."""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from tqdm import tqdm
+
+from clamp.decoding.null_partial_parse import NullPartialParse
+from clamp.decoding.partial_parse import PartialParse
+from clamp.search.beam_search_event_listener import BeamSearchEventListener
+from clamp.search.beam_search_semantic_parser import BeamSearchSemanticParser
+from clamp.search.datum import FullDatum
+from clamp.seq2seq.quantization import Precision
+from clamp.seq2seq.seq2seq_bart import Seq2SeqBart
+from clamp_experiments.codet5_model_config import CodeT5ModelConfig
+from clamp_experiments.io_utils import load_data_from_json_file
+from clamp_experiments.run_constrained_decoding import (
+    build_lm_and_tokenizer,
+    create_partial_parse_builder,
+    make_semantic_parser,
+)
+
+
+@dataclass
+class ParityStats:
+    k: int
+
+    num_positions: int = 0
+    # Positions where both models rank the same token first.
+    top1_agreements: int = 0
+    # Sum over positions of the fraction of the top k tokens that both models share.
+    topk_overlap: float = 0.0
+    # Largest difference in the log probability of a reference token.
+    max_reference_logprob_diff: float = 0.0
+
+    num_data: int = 0
+    reference_exact_match: int = 0
+    other_exact_match: int = 0
+    # Data where both models produced the same top prediction.
+    same_prediction: int = 0
+
+    def add_positions(
+        self,
+        reference_logprobs: torch.Tensor,
+        other_logprobs: torch.Tensor,
+        next_tokens: Sequence[int],
+    ) -> None:
+        """Compares the distributions in each row, where row i is the distribution over `next_tokens[i]`."""
+        k = min(self.k, reference_logprobs.shape[-1])
+        reference_topk = torch.topk(reference_logprobs, k, dim=-1).indices.tolist()
+        other_topk = torch.topk(other_logprobs, k, dim=-1).indices.tolist()
+        for reference_row, other_row in zip(reference_topk, other_topk):
+            self.num_positions += 1
+            self.top1_agreements += reference_row[0] == other_row[0]
+            self.topk_overlap += len(set(reference_row) & set(other_row)) / k
+
+        rows = range(len(next_tokens))
+        diffs = (
+            reference_logprobs[rows, list(next_tokens)]
+            - other_logprobs[rows, list(next_tokens)]
+        ).abs()
+        if len(diffs):
+            self.max_reference_logprob_diff = max(
+                self.max_reference_logprob_diff, diffs.max().item()
+            )
+
+    def add_predictions(
+        self, reference: Optional[str], other: Optional[str], target: str
+    ) -> None:
+        self.num_data += 1
+        self.reference_exact_match += reference == target
+        self.other_exact_match += other == target
+        self.same_prediction += reference == other
+
+    def summary(self) -> Dict[str, float]:
+        positions = max(self.num_positions, 1)
+        data = max(self.num_data, 1)
+        return {
+            "num_positions": self.num_positions,
+            "top1_agreement": self.top1_agreements / positions,
+            f"top{self.k}_overlap": self.topk_overlap / positions,
+            "max_reference_logprob_diff": self.max_reference_logprob_diff,
+            "num_data": self.num_data,
+            "reference_exact_match": self.reference_exact_match / data,
+            "other_exact_match": self.other_exact_match / data,
+            "same_prediction": self.same_prediction / data,
+        }
+
+
+async def teacher_forced_logprobs(
+    lm: Seq2SeqBart, datum: FullDatum, incremental: bool = False
+) -> Tuple[torch.Tensor, List[int]]:
+    """Returns the reference output tokens after the BOS tokens, including EOS,
+    and the distribution over each of them.
+
+    If `incremental`, the decoder runs on one token at a time, like during decoding."""
+    decoder_tokens = lm.encode_prefix_for_decoder(datum.canonical) + [lm.decoder_eos_id]
+    encoder_tokens = lm.encode_for_encoder(datum.natural)
+    num_bos = len(lm.decoder_bos_ids)
+    if not incremental:
+        logprobs, _ = await lm.initial(
+            encoder_tokens, decoder_tokens, drop_next_hidden_state=True
+        )
+        # Row i is the distribution over decoder_tokens[i + 1].
+        return logprobs[num_bos - 1 : -1].cpu(), decoder_tokens[num_bos:]
+
+    logprobs, hidden_state = await lm.initial(encoder_tokens, decoder_tokens[:num_bos])
+    rows = [logprobs[-1]]
+    for token in decoder_tokens[num_bos:-1]:
+        assert hidden_state is not None
+        logprobs, hidden_state = await lm.extend([token], hidden_state)
+        rows.append(logprobs[-1])
+    return torch.stack(rows).cpu(), decoder_tokens[num_bos:]
+
+
+async def top_prediction(
+    parser: BeamSearchSemanticParser, datum: FullDatum
+) -> Optional[str]:
+    results = await parser.predict(datum)
+    return results[0].text if results else None
+
+
+def main(
+    model_loc: str,
+    train_data_jsonl: str,
+    eval_data_jsonl: str,
+    precision: str,
+    model_backend: str = "eager",
+    max_num_data: int = 0,
+    grammar_base_dir: Optional[str] = None,
+    beam_size: int = 5,
+    k: int = 5,
+    output_file: Optional[str] = None,
+) -> Dict[str, float]:
+    if precision == Precision.FP32.value and model_backend == "eager":
+        raise ValueError("Nothing to compare: choose another precision or backend")
+    eval_data = load_data_from_json_file(eval_data_jsonl)
+    if max_num_data > 0:
+        eval_data = eval_data[:max_num_data]
+
+    reference_lm, tokenizer, max_steps_fn = build_lm_and_tokenizer(
+        CodeT5ModelConfig(model_loc=Path(model_loc)), train_data_jsonl
+    )
+    other_lm, _, _ = build_lm_and_tokenizer(
+        CodeT5ModelConfig(model_loc=Path(model_loc), precision=Precision(precision)),
+        train_data_jsonl,
+        trace_model=model_backend == "traced",
+    )
+    # The traced backend only runs the decoder on one token at a time.
+    incremental = model_backend == "traced"
+
+    def make_parser(
+        lm: Seq2SeqBart, partial_parse_builder: Callable[[FullDatum], PartialParse]
+    ) -> BeamSearchSemanticParser:
+        return make_semantic_parser(
+            lm=lm,
+            beam_size=beam_size,
+            partial_parse_builder=partial_parse_builder,
+            max_steps_fn=max_steps_fn,
+            keep_finished_nodes=True,
+            event_listener_factory=lambda _datum: BeamSearchEventListener(),
+        )
+
+    stats = ParityStats(k)
+
+    async def inner():
+        for datum in tqdm(eval_data):
+            reference_logprobs, next_tokens = await teacher_forced_logprobs(
+                reference_lm, datum, incremental
+            )
+            other_logprobs, _ = await teacher_forced_logprobs(
+                other_lm, datum, incremental
+            )
+            stats.add_positions(reference_logprobs, other_logprobs, next_tokens)
+
+            if grammar_base_dir is None:
+                partial_parse_builder: Callable[
+                    [FullDatum], PartialParse
+                ] = lambda _datum: NullPartialParse()
+            else:
+                partial_parse_builder = create_partial_parse_builder(
+                    tokenizer,
+                    os.path.join(
+                        grammar_base_dir, f"{datum.dialogue_id}_{datum.turn_index}"
+                    ),
+                )
+            stats.add_predictions(
+                await top_prediction(
+                    make_parser(reference_lm, partial_parse_builder), datum
+                ),
+                await top_prediction(
+                    make_parser(other_lm, partial_parse_builder), datum
+                ),
+                datum.canonical,
+            )
+
+    with torch.no_grad():
+        asyncio.run(inner())
+
+    summary = stats.summary()
+    print(json.dumps(summary, indent=2))
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(
+                {
+                    "precision": precision,
+                    "model_backend": model_backend,
+                    **summary,
+                    "stats": dataclasses.asdict(stats),
+                },
+                f,
+                indent=2,
+            )
+    return summary
+
+
+def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
+    argument_parser.add_argument(
+        "--model_loc", required=True, help="The path to the model files."
+    )
+    argument_parser.add_argument(
+        "--train_data_jsonl",
+        required=True,
+        help="The training data jsonl file, used to fit the maximum number of decoding steps.",
+    )
+    argument_parser.add_argument(
+        "--eval_data_jsonl", required=True, help="The held-out data jsonl file."
+    )
+    argument_parser.add_argument(
+        "--precision",
+        choices=[p.value for p in Precision],
+        default=Precision.INT8.value,
+        help="The precision to compare with fp32.",
+    )
+    argument_parser.add_argument(
+        "--model_backend",
+        choices=["eager", "traced"],
+        default="eager",
+        help="The backend to compare with the eager model; see run_constrained_decoding.",
+    )
+    argument_parser.add_argument(
+        "--max_num_data",
+        type=int,
+        default=0,
+        help="If positive, only compare on the first few data.",
+    )
+    argument_parser.add_argument(
+        "--grammar_base_dir",
+        help="If given, decode with the grammars in this directory instead of unconstrained.",
+    )
+    argument_parser.add_argument(
+        "--beam_size", type=int, default=5, help="The beam size."
+    )
+    argument_parser.add_argument(
+        "--k", type=int, default=5, help="Compare the top k next tokens."
+    )
+    argument_parser.add_argument(
+        "--output_file", help="If given, write the results to this JSON file."
+    )
+
+
+if __name__ == "__main__":
+    cmdline_parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(cmdline_parser)
+    args = cmdline_parser.parse_args()
+
+    main(
+        model_loc=args.model_loc,
+        train_data_jsonl=args.train_data_jsonl,
+        eval_data_jsonl=args.eval_data_jsonl,
+        precision=args.precision,
+        model_backend=args.model_backend,
+        max_num_data=args.max_num_data,
+        grammar_base_dir=args.grammar_base_dir,
+        beam_size=args.beam_size,
+        k=args.k,
+        output_file=args.output_file,
+    )
@@ -0,0 +1,114 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Pretty-prints beam search telemetry recorded with `--search_log=jsonl/npy`.
+
+The output mirrors what LoggingEventListener prints during decoding."""
+import argparse
+import itertools
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from clamp.search.beam_search_telemetry import (
+    TelemetryFormat,
+    TelemetryRecord,
+    read_telemetry,
+)
+from clamp.tokenization.gpt2_clamp_tokenizer import GPT2ClampTokenizer
+
+
+def format_telemetry(
+    records: Iterable[TelemetryRecord],
+    decode: Callable[[List[int]], str],
+    max_expansions_per_node: int,
+) -> Iterator[str]:
+    for (datum_id, step), step_records in itertools.groupby(
+        records, key=lambda r: (r.datum_id, r.step)
+    ):
+        header = f"===== {datum_id} DEPTH {step} ====="
+        yield header
+        for (parent_tokens, parent_cost), node_records in itertools.groupby(
+            step_records, key=lambda r: (r.parent_tokens, r.parent_cost)
+        ):
+            node_cost_str = "" if parent_cost is None else f" [{parent_cost:.3f}]"
+            yield f"Completions for {decode(list(parent_tokens))!r}{node_cost_str}:"
+            expansions = sorted(node_records, key=lambda r: r.cost)
+            for r in expansions[:max_expansions_per_node]:
+                if r.token is None:
+                    yield f"- Finished: {decode(list(r.tokens))!r} -> [{r.cost:.3f}]"
+                else:
+                    yield f"- {decode([r.token])!r} -> [{r.cost:.3f}]"
+            if len(expansions) > max_expansions_per_node:
+                yield f"... and {len(expansions) - max_expansions_per_node} more"
+        yield "=" * len(header)
+
+
+def main(
+    telemetry_path: str,
+    tokenizer_dir: Optional[str],
+    datum_id: Optional[str],
+    max_expansions_per_node: int,
+):
+    path = Path(telemetry_path)
+    fmt = TelemetryFormat(path.suffix.lstrip("."))
+    if tokenizer_dir is not None:
+        tokenizer = GPT2ClampTokenizer.from_pretrained(tokenizer_dir)
+        decode: Callable[[List[int]], str] = tokenizer.decode
+    else:
+        decode = lambda token_ids: " ".join(str(t) for t in token_ids)
+
+    records: Iterable[TelemetryRecord] = read_telemetry(path, fmt)
+    if datum_id is not None:
+        records = (r for r in records if r.datum_id == datum_id)
+    for line in format_telemetry(records, decode, max_expansions_per_node):
+        print(line)
+
+
+def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
+    argument_parser.add_argument(
+        "--telemetry_path",
+        required=True,
+        help="The search_telemetry.jsonl or search_telemetry.npy file.",
+    )
+    argument_parser.add_argument(
+        "--tokenizer_dir",
+        help="The model directory to load the tokenizer from. If not given, token ids are printed.",
+    )
+    argument_parser.add_argument(
+        "--datum_id", help="If given, only print steps for this datum."
+    )
+    argument_parser.add_argument(
+        "--max_expansions_per_node",
+        type=int,
+        default=10,
+        help="How many of the cheapest expansions of each node to print.",
+    )
+
+
+if __name__ == "__main__":
+    cmdline_parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(cmdline_parser)
+    args = cmdline_parser.parse_args()
+
+    main(
+        telemetry_path=args.telemetry_path,
+        tokenizer_dir=args.tokenizer_dir,
+        datum_id=args.datum_id,
+        max_expansions_per_node=args.max_expansions_per_node,
+    )
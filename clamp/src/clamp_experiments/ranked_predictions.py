@@ -21,7 +21,9 @@ import json
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from clamp_experiments.results_store import RESULTS_DB_FILE, ResultsStore
 
 
 @dataclass(frozen=True)
@@ -45,23 +47,42 @@ def _strip_post_eos(s: str, eos_token: Optional[str] = None) -> str:
     return s[: s.index(eos_token)]
 
 
-def load_clamp_outputs(
-    experiments_base_dir: Path, eos_token: Optional[str] = None
-) -> Dict[str, RankedPredictions]:
-    """Returns a dictionary of datum_id -> RankedPredictions"""
+def model_outputs_by_experiment(
+    experiments_base_dir: Path,
+) -> Iterator[Tuple[str, List[Dict]]]:
+    """Yields the name of each experiment and its JSON-decoded DatumResults."""
+    results_db = experiments_base_dir / RESULTS_DB_FILE
+    if results_db.exists():
+        results_store = ResultsStore(results_db)
+        try:
+            yield from results_store.all_model_outputs().items()
+        finally:
+            results_store.close()
+        return
 
-    ret = {}
-    error_cnt = 0
     for datum_id in os.listdir(experiments_base_dir):
         datum_id = str(datum_id)
         exp_dir = experiments_base_dir / datum_id
+        # Skip files like the work queue and search telemetry.
+        if not exp_dir.is_dir():
+            continue
         model_outputs_paths = list(exp_dir.glob("model_outputs*.json*"))
         latest_file = max(
             model_outputs_paths, key=os.path.getctime
         )  # get the latest model_outputs* file
-        model_outputs: List[Dict] = [
-            json.loads(line) for line in open(latest_file, "r")
-        ]
+        yield datum_id, [json.loads(line) for line in open(latest_file, "r")]
+
+
+def load_clamp_outputs(
+    experiments_base_dir: Path, eos_token: Optional[str] = None
+) -> Dict[str, RankedPredictions]:
+    """Returns a dictionary of datum_id -> RankedPredictions
+
+    If `experiments_base_dir` contains a ResultsStore, the outputs are read from it."""
+
+    ret = {}
+    error_cnt = 0
+    for datum_id, model_outputs in model_outputs_by_experiment(experiments_base_dir):
         if len(model_outputs) != 1:
             error_cnt += 1
             continue
@@ -0,0 +1,106 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Stores the outputs of decoding runs in a single SQLite file.
+
+By default, `run_experiment` writes a directory for every experiment, with the
+model outputs, logs, timings and metrics in separate files, and
+`load_clamp_outputs` finds them again by listing directories. With one
+experiment per datum, that is a lot of small files. A `ResultsStore` instead
+keeps the outputs and summaries of all experiments in one indexed database:
+- each model output is committed in its own transaction as soon as it's
+  decoded, so an interrupted experiment resumes after the last one;
+- finishing an experiment records its metrics and timings, so that it is
+  skipped when the run is repeated;
+- it uses SQLite's write-ahead log, so that several processes can write to it.
+"""
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# The name of the store in an output directory.
+RESULTS_DB_FILE = "results.sqlite"
+
+
+class ResultsStore:
+    def __init__(self, path: Path):
+        self.path = path
+        # Wait for other processes to finish writing, instead of failing.
+        self._conn = sqlite3.connect(str(path), timeout=600)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Commits survive this process crashing, though not the machine.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            # `position` is the index of the datum in the experiment's test data.
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS model_outputs ("
+                "experiment TEXT, position INTEGER, datum_id TEXT, model_output TEXT, "
+                "PRIMARY KEY (experiment, position))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS experiments ("
+                "experiment TEXT PRIMARY KEY, metrics TEXT, timings TEXT)"
+            )
+
+    def add_model_output(
+        self, experiment: str, position: int, datum_id: str, model_output: str
+    ) -> None:
+        """Commits `model_output`, a JSON-encoded DatumResult."""
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO model_outputs VALUES (?, ?, ?, ?)",
+                (experiment, position, datum_id, model_output),
+            )
+
+    def model_outputs(self, experiment: str) -> List[Dict[str, Any]]:
+        """Returns the model outputs committed so far for `experiment`, by position."""
+        rows = self._conn.execute(
+            "SELECT model_output FROM model_outputs WHERE experiment = ? ORDER BY position",
+            (experiment,),
+        )
+        return [json.loads(model_output) for model_output, in rows]
+
+    def all_model_outputs(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Returns the model outputs of every experiment, by position."""
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for experiment, model_output in self._conn.execute(
+            "SELECT experiment, model_output FROM model_outputs ORDER BY experiment, position"
+        ):
+            result.setdefault(experiment, []).append(json.loads(model_output))
+        return result
+
+    def finish_experiment(
+        self, experiment: str, metrics: Dict[str, float], timings: Dict[str, Any]
+    ) -> None:
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO experiments VALUES (?, ?, ?)",
+                (experiment, json.dumps(metrics), json.dumps(timings)),
+            )
+
+    def metrics(self, experiment: str) -> Optional[Dict[str, float]]:
+        """Returns the metrics of `experiment`, or None if it hasn't finished."""
+        row = self._conn.execute(
+            "SELECT metrics FROM experiments WHERE experiment = ?", (experiment,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self) -> None:
+        self._conn.close()
@@ -19,42 +19,92 @@
 
 import argparse
 import asyncio
+import dataclasses
+import functools
 import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from typing import (
+    Any,
+    AsyncContextManager,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import torch
-from tqdm import tqdm
 
+from clamp.async_tools.batch_helper import AdaptiveBatchingPolicy
 from clamp.decoding.partial_parse import PartialParse
 from clamp.decoding.uint8_earley_partial_parse import (
     UInt8EarleyPartialParse,
     UInt8GrammarTokenizerInfo,
 )
-from clamp.earley.cfg import load_grammar_from_directory
+from clamp.earley.cfg import (
+    grammar_digest,
+    load_grammar_from_directory,
+    read_grammar_fragments,
+)
+from clamp.earley.earley import EarleyStats
+from clamp.earley.earley_profile import EarleyProfile
+from clamp.search.beam_search_event_listener import BeamSearchEventListener
 from clamp.search.beam_search_semantic_parser import BeamSearchSemanticParser
+from clamp.search.beam_search_telemetry import (
+    TelemetryEventListener,
+    TelemetryFormat,
+    TelemetryWriter,
+)
 from clamp.search.datum import DatumSub, FullDatum
+from clamp.search.expansion_cache import ExpansionDiskCache, LRUExpansionCache
+from clamp.search.model import Model
 from clamp.search.problem_factory import ConstrainedDecodingProblemFactory
+from clamp.search.sampling import SamplingSemanticParser
 from clamp.search.seq2seq_decoding_step import PartialParseBuilder, Seq2SeqDecodingSetup
+from clamp.seq2seq.encoder_cache import EncoderCache
+from clamp.seq2seq.inference_server import (
+    InferenceServer,
+    InferenceServerExited,
+    RemoteSeq2SeqModel,
+    ServerConnection,
+)
+from clamp.seq2seq.prefix_cache import PrefixCache
+from clamp.seq2seq.quantization import Precision
 from clamp.seq2seq.seq2seq_bart import Seq2SeqBart
-from clamp.seq2seq.seq2seq_model import HS, AutoregressiveModel
+from clamp.seq2seq.seq2seq_model import HS, AutoregressiveModel, Seq2SeqModel
 from clamp.tokenization.clamp_tokenizer import ClampTokenizer
+from clamp.util.stage_timer import StageTimer
+from clamp.util.util import prefetch_map
 from clamp_experiments.codet5_model_config import CodeT5ModelConfig
+from clamp_experiments.datum_resources import ResourceTracker
 from clamp_experiments.eval_metrics import Metric, TopKExactMatch
-from clamp_experiments.experiment import Experiment, run_experiment
+from clamp_experiments.experiment import Experiment, is_finished, run_experiment
 from clamp_experiments.fit_max_steps import compute_and_print_fit
 from clamp_experiments.io_utils import load_data_from_json_file
+from clamp_experiments.results_store import RESULTS_DB_FILE, ResultsStore
+from clamp_experiments.work_queue import WORK_QUEUE_FILE, WorkQueue
 
 
 def create_partial_parse_builder(
-    tokenizer: ClampTokenizer, grammar_dir: str
+    tokenizer: ClampTokenizer,
+    grammar_dir: str,
+    earley_stats: Optional[EarleyStats] = None,
 ) -> PartialParseBuilder[FullDatum]:
 
     specialized_grammar = load_grammar_from_directory(grammar_dir)
     grammar_tokenizer_info = UInt8GrammarTokenizerInfo.from_clamp_tokenizer(
         specialized_grammar, tokenizer
     )
-    partial_parse = UInt8EarleyPartialParse.initial(grammar_tokenizer_info)
+    partial_parse = UInt8EarleyPartialParse.initial(
+        grammar_tokenizer_info, earley_stats
+    )
     partial_parse_builder = lambda _: partial_parse
     return partial_parse_builder
 
@@ -65,6 +115,14 @@ def make_semantic_parser(
     partial_parse_builder: Callable[[DatumSub], PartialParse],
     max_steps_fn: Optional[Callable[[DatumSub], Optional[int]]],
     keep_finished_nodes: bool = False,
+    event_listener_factory: Optional[
+        Callable[[DatumSub], BeamSearchEventListener]
+    ] = None,
+    length_normalization: float = 0.7,
+    expansion_cache: Optional[LRUExpansionCache] = None,
+    expansion_disk_cache: Optional[ExpansionDiskCache] = None,
+    allowed_token_logprobs: str = "full",
+    stage_timer: Optional[StageTimer] = None,
 ) -> BeamSearchSemanticParser:
     decoding_setup: Seq2SeqDecodingSetup = Seq2SeqDecodingSetup(
         partial_parse_builder=partial_parse_builder, seq2seq_model=lm  # type: ignore
@@ -73,8 +131,13 @@ def make_semantic_parser(
     problem_factory = ConstrainedDecodingProblemFactory(
         autoregressive_model=lm,
         decoding_setup=decoding_setup,
-        length_normalization=0.7,
+        length_normalization=length_normalization,
         top_k=beam_size,
+        cache=expansion_cache,
+        disk_cache=expansion_disk_cache,
+        restrict_to_allowed_tokens=allowed_token_logprobs != "full",
+        exact_normalizer=allowed_token_logprobs != "renormalized",
+        stage_timer=stage_timer,
     )
 
     return BeamSearchSemanticParser(
@@ -83,10 +146,52 @@ def make_semantic_parser(
         beam_size=beam_size,
         max_steps_fn=max_steps_fn,
         keep_finished_nodes=keep_finished_nodes,
+        event_listener_factory=event_listener_factory,
+        stage_timer=stage_timer,
+    )
+
+
+def make_sampling_semantic_parser(
+    lm: AutoregressiveModel[HS],
+    num_samples: int,
+    partial_parse_builder: Callable[[DatumSub], PartialParse],
+    max_steps_fn: Optional[Callable[[DatumSub], Optional[int]]],
+    temperature: float = 1.0,
+    top_p: float = 1.0,
+    seed: int = 0,
+    length_normalization: float = 0.7,
+) -> SamplingSemanticParser:
+    decoding_setup: Seq2SeqDecodingSetup = Seq2SeqDecodingSetup(
+        partial_parse_builder=partial_parse_builder, seq2seq_model=lm  # type: ignore
+    )
+    problem_factory = ConstrainedDecodingProblemFactory(
+        autoregressive_model=lm,
+        decoding_setup=decoding_setup,
+        length_normalization=length_normalization,
+    )
+    return SamplingSemanticParser(
+        problem_factory=problem_factory,
+        tokenizer=lm.tokenizer,
+        num_samples=num_samples,
+        temperature=temperature,
+        top_p=top_p,
+        seed=seed,
+        max_steps_fn=max_steps_fn,
     )
 
 
-def build_lm_and_tokenizer(model_config: CodeT5ModelConfig, train_data_jsonl: str):
+def build_seq2seq_bart(
+    model_config: CodeT5ModelConfig,
+    prefix_cache_max_bytes: int = 0,
+    max_batch_size: int = 1,
+    batch_latency_target: float = 0.0,
+    length_bucket_size: int = 1,
+    split_lm_head: bool = False,
+    executor: Optional[Executor] = None,
+    stage_timer: Optional[StageTimer] = None,
+    trace_model: bool = False,
+    encoder_cache: Optional[EncoderCache] = None,
+) -> Seq2SeqBart:
     model, tokenizer, _ = model_config.setup_model()
 
     # CodeT5Model can be loaded as a Seq2SeqBart since they both use the encoder-decoder architecture.
@@ -94,7 +199,71 @@ def build_lm_and_tokenizer(model_config: CodeT5ModelConfig, train_data_jsonl: st
         pretrained_model_dir=str(model_config.model_loc),
         model=model,
         clamp_tokenizer=tokenizer,
+        max_batch_size=max_batch_size,
+        length_bucket_size=length_bucket_size,
+        split_lm_head=split_lm_head,
+        executor=executor,
+        stage_timer=stage_timer,
+        trace_model=trace_model,
+        encoder_cache=encoder_cache,
+        batching_policy=AdaptiveBatchingPolicy(
+            batch_latency_target, max_batch_size=max_batch_size
+        )
+        if batch_latency_target > 0
+        else None,
     )
+    if trace_model and lm.traced is None:
+        print("The model can't be traced; running it eagerly")
+    if prefix_cache_max_bytes > 0:
+        lm.prefix_cache = PrefixCache(prefix_cache_max_bytes, lm.hidden_state_nbytes)
+    return lm
+
+
+def _build_served_lm(
+    model_config: CodeT5ModelConfig, model_thread: bool, **kwargs: Any
+) -> Seq2SeqBart:
+    """Builds the model in the InferenceServer process; see `build_seq2seq_bart`."""
+    # A single thread, so that model calls don't compete with each other.
+    executor = ThreadPoolExecutor(max_workers=1) if model_thread else None
+    return build_seq2seq_bart(model_config, executor=executor, **kwargs)
+
+
+def build_lm_and_tokenizer(
+    model_config: CodeT5ModelConfig,
+    train_data_jsonl: str,
+    prefix_cache_max_bytes: int = 0,
+    max_batch_size: int = 1,
+    batch_latency_target: float = 0.0,
+    length_bucket_size: int = 1,
+    split_lm_head: bool = False,
+    executor: Optional[Executor] = None,
+    stage_timer: Optional[StageTimer] = None,
+    trace_model: bool = False,
+    encoder_cache: Optional[EncoderCache] = None,
+    server_connection: Optional[ServerConnection] = None,
+):
+    """If `server_connection` is given, the model runs in that InferenceServer,
+    with the server's settings instead of the ones given here."""
+    lm: Seq2SeqModel
+    if server_connection is None:
+        lm = build_seq2seq_bart(
+            model_config,
+            prefix_cache_max_bytes,
+            max_batch_size,
+            batch_latency_target,
+            length_bucket_size,
+            split_lm_head,
+            executor,
+            stage_timer,
+            trace_model,
+            encoder_cache,
+        )
+        tokenizer = lm.tokenizer
+    else:
+        tokenizer = model_config.setup_tokenizer()
+        lm = RemoteSeq2SeqModel(
+            str(model_config.model_loc), tokenizer, server_connection
+        )
 
     print(f"Reading {train_data_jsonl}")
     train_data = load_data_from_json_file(train_data_jsonl)
@@ -121,76 +290,538 @@ def build_lm_and_tokenizer(model_config: CodeT5ModelConfig, train_data_jsonl: st
     return lm, tokenizer, max_steps_fn
 
 
+@dataclass(frozen=True)
+class DecodingSettings:
+    """The command line arguments; see `add_arguments` for what each one does.
+
+    The worker processes are started with the same settings as the parent."""
+
+    model_loc: str
+    train_data_jsonl: str
+    eval_data_jsonl: str
+    grammar_base_dir: str
+    output_dir: str
+    max_num_experiments: int = 0
+    search_log: str = "print"
+    search_log_sample_rate: float = 1.0
+    beam_size: int = 5
+    length_normalization: float = 0.7
+    expansion_cache_max_entries: int = 0
+    expansion_cache_max_bytes: int = 0
+    expansion_cache_db: Optional[str] = None
+    prefix_cache_max_bytes: int = 0
+    max_batch_size: int = 1
+    batch_latency_target: float = 0.0
+    length_bucket_size: int = 1
+    allowed_token_logprobs: str = "full"
+    model_thread: bool = False
+    precision: str = "fp32"
+    model_backend: str = "eager"
+    encoder_cache_max_bytes: int = 0
+    encoder_cache_dir: Optional[str] = None
+    num_workers: int = 0
+    search: str = "beam"
+    num_samples: int = 5
+    temperature: float = 1.0
+    top_p: float = 1.0
+    sampling_seed: int = 0
+    grammar_prefetch: int = 2
+    lease_seconds: float = 600.0
+    use_results_store: bool = False
+    earley_profile_dir: Optional[str] = None
+
+    @staticmethod
+    def from_args(args: argparse.Namespace) -> "DecodingSettings":
+        return DecodingSettings(
+            **{
+                field.name: getattr(args, field.name)
+                for field in dataclasses.fields(DecodingSettings)
+            }
+        )
+
+    def model_kwargs(self) -> Dict[str, Any]:
+        """The keyword arguments of `build_seq2seq_bart` given by these settings."""
+        return dict(
+            prefix_cache_max_bytes=self.prefix_cache_max_bytes,
+            max_batch_size=self.max_batch_size,
+            batch_latency_target=self.batch_latency_target,
+            length_bucket_size=self.length_bucket_size,
+            split_lm_head=self.allowed_token_logprobs != "full",
+            trace_model=self.model_backend == "traced",
+        )
+
+
 def create_experiments(
+    settings: DecodingSettings,
     model_config: CodeT5ModelConfig,
-    train_data_jsonl: str,
-    eval_data_jsonl: str,
-    max_num_experiments: int,
-    grammar_base_dir: str,
-) -> List[Tuple[str, Experiment]]:
-    print(f"Reading {eval_data_jsonl}")
-    eval_data = load_data_from_json_file(eval_data_jsonl)
+    event_listener_factory: Optional[
+        Callable[[FullDatum], BeamSearchEventListener]
+    ] = None,
+    expansion_cache: Optional[LRUExpansionCache] = None,
+    expansion_disk_cache: Optional[ExpansionDiskCache] = None,
+    executor: Optional[Executor] = None,
+    stage_timer: Optional[StageTimer] = None,
+    encoder_cache: Optional[EncoderCache] = None,
+    server_connection: Optional[ServerConnection] = None,
+    rank: int = 0,
+    world_size: int = 1,
+    work_queue: Optional[WorkQueue] = None,
+) -> Iterator[Tuple[str, Experiment]]:
+    """Lazily creates an experiment for every `world_size`th datum, starting from `rank`.
+
+    If `work_queue` is given, creates experiments for the data leased from it
+    instead. The caller must complete or release each one before asking for the
+    next experiment.
+
+    While the caller runs an experiment, the grammars of the next
+    `settings.grammar_prefetch` data are loaded on background threads. Each grammar is only kept alive by its
+    experiment, so it is released once the caller is done with it. Parsing and
+    compiling a grammar is pure Python and holds the GIL, so only reading its files
+    and the model's torch kernels overlap with it; the Python side of the search
+    slows down while a grammar loads. Prefetching pays off when grammars are read
+    from remote storage or their compiled form comes from the grammar cache.
+
+    With `settings.search="sampling"`, each experiment draws `settings.num_samples`
+    samples instead of running beam search.
+
+    If `settings.earley_profile_dir` is given, the work in each datum's Earley chart is
+    profiled, and written there once the caller is done with its experiment
+    (see EarleyProfile.dump)."""
+    print(f"Reading {settings.eval_data_jsonl}")
+    eval_data = load_data_from_json_file(settings.eval_data_jsonl)
     print(f"len(eval_data) = {len(eval_data)}")
-    if max_num_experiments > 0:
-        eval_data = eval_data[:max_num_experiments]
+    if settings.max_num_experiments > 0:
+        eval_data = eval_data[: settings.max_num_experiments]
         print(f"len(eval_data) = {len(eval_data)}")
+    if work_queue is None and world_size > 1:
+        eval_data = eval_data[rank::world_size]
+        print(f"len(eval_data) = {len(eval_data)} for rank {rank} of {world_size}")
 
-    lm, tokenizer, max_steps_fn = build_lm_and_tokenizer(model_config, train_data_jsonl)
-    beam_size = 5
+    lm, tokenizer, max_steps_fn = build_lm_and_tokenizer(
+        model_config,
+        settings.train_data_jsonl,
+        executor=executor,
+        stage_timer=stage_timer,
+        encoder_cache=encoder_cache,
+        server_connection=server_connection,
+        **settings.model_kwargs(),
+    )
     metrics: Dict[str, Metric[Sequence[str], FullDatum]] = {
-        "exact_match": TopKExactMatch(beam_size)
+        "exact_match": TopKExactMatch(
+            settings.beam_size if settings.search == "beam" else settings.num_samples
+        )
     }
 
-    experiments = []
-    for datum in tqdm(eval_data):
-        datum_id = f"{datum.dialogue_id}_{datum.turn_index}"
-        print(f"Creating experiment for {datum_id}")
-
+    def load_grammar(
+        datum: FullDatum,
+    ) -> Tuple[
+        PartialParseBuilder[FullDatum], ResourceTracker, Optional[ExpansionDiskCache]
+    ]:
+        start = time.perf_counter()
+        grammar_dir = os.path.join(settings.grammar_base_dir, _datum_id(datum))
+        earley_stats = (
+            EarleyStats() if settings.earley_profile_dir is None else EarleyProfile()
+        )
         partial_parse_builder = create_partial_parse_builder(
-            tokenizer, os.path.join(grammar_base_dir, datum_id)
+            tokenizer, grammar_dir, earley_stats
         )
-        parser = make_semantic_parser(
-            lm=lm,
-            beam_size=beam_size,
-            partial_parse_builder=partial_parse_builder,
-            max_steps_fn=max_steps_fn,
-            keep_finished_nodes=True,
+        resource_tracker = ResourceTracker(
+            stage_timer,
+            earley_stats,
+            initial={"grammar_load_seconds": time.perf_counter() - start},
         )
-        experiment = Experiment(
-            model=parser, client=lm, test_data=[datum], metrics=metrics
+        # The cached expansions depend on the grammar, which may have been regenerated.
+        grammar_disk_cache = (
+            None
+            if expansion_disk_cache is None
+            else expansion_disk_cache.for_grammar(
+                grammar_digest(read_grammar_fragments(grammar_dir))
+            )
         )
-        experiments.append((datum_id, experiment))
+        return partial_parse_builder, resource_tracker, grammar_disk_cache
 
-    return experiments
+    def create_experiment(
+        datum: FullDatum,
+        partial_parse_builder: PartialParseBuilder[FullDatum],
+        resource_tracker: ResourceTracker,
+        grammar_disk_cache: Optional[ExpansionDiskCache],
+    ) -> Experiment:
+        parser: Model[FullDatum]
+        if settings.search == "beam":
+            parser = make_semantic_parser(
+                lm=lm,
+                beam_size=settings.beam_size,
+                partial_parse_builder=partial_parse_builder,
+                max_steps_fn=max_steps_fn,
+                keep_finished_nodes=True,
+                event_listener_factory=event_listener_factory,
+                length_normalization=settings.length_normalization,
+                expansion_cache=expansion_cache,
+                expansion_disk_cache=grammar_disk_cache,
+                allowed_token_logprobs=settings.allowed_token_logprobs,
+                stage_timer=stage_timer,
+            )
+        else:
+            parser = make_sampling_semantic_parser(
+                lm=lm,
+                num_samples=settings.num_samples,
+                partial_parse_builder=partial_parse_builder,
+                max_steps_fn=max_steps_fn,
+                temperature=settings.temperature,
+                top_p=settings.top_p,
+                seed=settings.sampling_seed,
+                length_normalization=settings.length_normalization,
+            )
+        return Experiment(
+            model=parser,
+            client=lm,
+            test_data=[datum],
+            metrics=metrics,
+            resource_tracker=resource_tracker,
+        )
 
+    grammar_prefetch = settings.grammar_prefetch
+    earley_profile_dir = (
+        None
+        if settings.earley_profile_dir is None
+        else Path(settings.earley_profile_dir)
+    )
+    with ExitStack() as stack:
+        grammar_executor: Optional[Executor] = (
+            stack.enter_context(ThreadPoolExecutor(max_workers=grammar_prefetch))
+            if grammar_prefetch > 0
+            else None
+        )
+        for data in _data_rounds(eval_data, work_queue):
+            for datum, (
+                partial_parse_builder,
+                resource_tracker,
+                grammar_disk_cache,
+            ) in prefetch_map(load_grammar, data, grammar_executor, grammar_prefetch):
+                datum_id = _datum_id(datum)
+                print(f"Creating experiment for {datum_id}")
+                if work_queue is not None:
+                    # The lease started when the grammar was prefetched.
+                    work_queue.renew(datum_id)
+                yield datum_id, create_experiment(
+                    datum, partial_parse_builder, resource_tracker, grammar_disk_cache
+                )
+                del partial_parse_builder
+                if grammar_disk_cache is not None:
+                    grammar_disk_cache.flush()
+                if earley_profile_dir is not None:
+                    profile = resource_tracker.earley_stats
+                    assert isinstance(profile, EarleyProfile)
+                    profile.dump(earley_profile_dir, datum_id)
 
-def main(
-    model_loc: str,
-    train_data_jsonl: str,
+
+def _data_rounds(
+    eval_data: List[FullDatum], work_queue: Optional[WorkQueue]
+) -> Iterator[Iterable[FullDatum]]:
+    """Without a work queue, yields `eval_data`. Otherwise, yields the data
+    leased from it, in rounds: we can't wait for other workers' leases to expire
+    while we hold leases on prefetched data ourselves."""
+    if work_queue is None:
+        yield eval_data
+        return
+    data_by_id = {_datum_id(datum): datum for datum in eval_data}
+    while True:
+        yield (data_by_id[item] for item in work_queue)
+        if not work_queue.wait():
+            return
+
+
+async def _renew_leases(work_queue: WorkQueue) -> None:
+    """Renews the worker's leases every third of their length, until cancelled."""
+    while True:
+        await asyncio.sleep(work_queue.lease_seconds / 3)
+        work_queue.renew_leases()
+
+
+def _datum_id(datum: FullDatum) -> str:
+    return f"{datum.dialogue_id}_{datum.turn_index}"
+
+
+def _fill_work_queue(
+    work_queue: WorkQueue,
     eval_data_jsonl: str,
     max_num_experiments: int,
     grammar_base_dir: str,
-    output_dir: str,
+    output_dir: Path,
+    results_store: Optional[ResultsStore],
+) -> None:
+    """Queues the data which don't have results yet, longest expected decoding first.
+
+    The grammars are specialized to each datum, so the size of a grammar
+    predicts the length of the output better than the length of the input."""
+    eval_data = load_data_from_json_file(eval_data_jsonl)
+    if max_num_experiments > 0:
+        eval_data = eval_data[:max_num_experiments]
+    items = []
+    for datum in eval_data:
+        datum_id = _datum_id(datum)
+        if is_finished(datum_id, output_dir, results_store):
+            continue
+        grammar_size = sum(
+            path.stat().st_size
+            for path in Path(grammar_base_dir, datum_id).rglob("*.cfg")
+        )
+        items.append((datum_id, float(grammar_size or len(datum.natural))))
+    work_queue.reset(items)
+
+
+def main(
+    settings: DecodingSettings,
+    worker_rank: int = 0,
+    server_connection: Optional[ServerConnection] = None,
 ):
-    async def inner():
-        model_config = CodeT5ModelConfig(
-            model_loc=Path(model_loc),
-            device_map={0: list(range(4)), 1: list(range(4, 12))}
-            if torch.cuda.device_count() >= 2
+    """If `settings.num_workers` is positive, runs this in that many processes, which
+    lease data from a WorkQueue in the output directory and decode them with the
+    model in a shared InferenceServer."""
+    output_dir = Path(settings.output_dir)
+
+    async def inner(
+        event_listener_factory: Optional[
+            Callable[[FullDatum], BeamSearchEventListener]
+        ],
+        expansion_disk_cache: Optional[ExpansionDiskCache],
+        results_store: Optional[ResultsStore],
+        work_queue: Optional[WorkQueue],
+    ):
+        stage_timer.reset()
+        # All experiments share the same model.
+        client: Optional[AsyncContextManager] = None
+        for datum_id, exp in create_experiments(
+            settings,
+            model_config,
+            event_listener_factory=event_listener_factory,
+            expansion_cache=expansion_cache,
+            expansion_disk_cache=expansion_disk_cache,
+            executor=executor,
+            stage_timer=stage_timer,
+            encoder_cache=encoder_cache,
+            server_connection=server_connection,
+            rank=worker_rank,
+            world_size=max(settings.num_workers, 1),
+            work_queue=work_queue,
+        ):
+            client = exp.client
+            # Long data would otherwise outlive their leases, and be decoded again by
+            # another worker. The prefetched data also wait on this one.
+            lease_renewal = (
+                None
+                if work_queue is None
+                else asyncio.ensure_future(_renew_leases(work_queue))
+            )
+            try:
+                finished = await run_experiment(
+                    datum_id, exp, output_dir, results_store=results_store
+                )
+            finally:
+                if lease_renewal is not None:
+                    lease_renewal.cancel()
+            if work_queue is not None:
+                if finished:
+                    work_queue.complete(datum_id)
+                else:
+                    # Another worker, or this one in a later round, can retry it.
+                    work_queue.release(datum_id)
+            if isinstance(client, RemoteSeq2SeqModel) and client.server_exited:
+                # Every remaining datum would fail too.
+                raise InferenceServerExited("The inference server has exited")
+            # Release the grammar while the next one is loaded.
+            del exp
+        print(stage_timer.report())
+        if isinstance(client, Seq2SeqBart):
+            stats = client.batch_helper.stats
+            print(
+                f"Model calls: {stats.num_batches} batches, "
+                f"mean batch size {stats.mean_batch_size:.2f}, "
+                f"batch sizes {dict(sorted(stats.batch_sizes.items()))}"
+            )
+            if client.prefix_cache is not None:
+                print(f"Prefix cache: {client.prefix_cache.stats()}")
+        if expansion_cache is not None:
+            print(f"Expansion cache: {expansion_cache.stats()}")
+        if encoder_cache is not None:
+            print(f"Encoder cache: {encoder_cache.stats()}")
+
+    model_config = CodeT5ModelConfig(
+        model_loc=Path(settings.model_loc),
+        device_map={0: list(range(4)), 1: list(range(4, 12))}
+        if torch.cuda.device_count() >= 2
+        else None,
+        precision=Precision(settings.precision),
+    )
+
+    # Shared between all experiments, since the keys include the datum.
+    expansion_cache: Optional[LRUExpansionCache] = (
+        LRUExpansionCache(
+            max_entries=settings.expansion_cache_max_entries or None,
+            max_bytes=settings.expansion_cache_max_bytes or None,
+        )
+        if settings.expansion_cache_max_entries or settings.expansion_cache_max_bytes
+        else None
+    )
+
+    # Identifies the model in persistent caches. Its outputs differ with the precision.
+    model_namespace = str(Path(settings.model_loc).resolve()) + (
+        "" if settings.precision == "fp32" else f":{settings.precision}"
+    )
+    encoder_cache: Optional[EncoderCache] = (
+        EncoderCache(
+            model_namespace,
+            max_bytes=settings.encoder_cache_max_bytes,
+            directory=Path(settings.encoder_cache_dir)
+            if settings.encoder_cache_dir
             else None,
         )
-        experiments = create_experiments(
-            model_config=model_config,
-            train_data_jsonl=train_data_jsonl,
-            eval_data_jsonl=eval_data_jsonl,
-            grammar_base_dir=grammar_base_dir,
-            max_num_experiments=max_num_experiments,
+        # Workers use the one in the server.
+        if (settings.encoder_cache_max_bytes > 0 or settings.encoder_cache_dir)
+        and server_connection is None
+        else None
+    )
+
+    if settings.num_workers > 0 and server_connection is None:
+        _run_workers(settings, model_config, encoder_cache)
+        return
+
+    stage_timer = StageTimer()
+    with ExitStack() as stack:
+        # A single thread, so that model calls don't compete with each other.
+        executor: Optional[Executor] = (
+            stack.enter_context(ThreadPoolExecutor(max_workers=1))
+            if settings.model_thread
+            else None
+        )
+        event_listener_factory: Optional[Callable[[FullDatum], BeamSearchEventListener]]
+        if settings.search_log == "print":
+            event_listener_factory = None
+        elif settings.search_log == "none":
+            event_listener_factory = lambda _datum: BeamSearchEventListener()
+        else:
+            fmt = TelemetryFormat(settings.search_log)
+            output_dir.mkdir(exist_ok=True, parents=True)
+            telemetry_name = (
+                f"search_telemetry.{fmt.value}"
+                if server_connection is None
+                else f"search_telemetry.rank-{worker_rank:02d}.{fmt.value}"
+            )
+            writer = stack.enter_context(
+                TelemetryWriter(output_dir / telemetry_name, fmt)
+            )
+            event_listener_factory = lambda _datum: TelemetryEventListener(
+                writer,
+                f"{_datum.dialogue_id}_{_datum.turn_index}",
+                sample_rate=settings.search_log_sample_rate,
+            )
+
+        expansion_disk_cache: Optional[ExpansionDiskCache] = None
+        if settings.expansion_cache_db is not None:
+            expansion_disk_cache = ExpansionDiskCache(
+                Path(settings.expansion_cache_db),
+                # Log probabilities also differ when renormalized.
+                namespace=model_namespace
+                + (
+                    ":renormalized"
+                    if settings.allowed_token_logprobs == "renormalized"
+                    else ""
+                ),
+            )
+            stack.callback(expansion_disk_cache.close)
+
+        results_store: Optional[ResultsStore] = None
+        if settings.use_results_store:
+            output_dir.mkdir(exist_ok=True, parents=True)
+            results_store = ResultsStore(output_dir / RESULTS_DB_FILE)
+            stack.callback(results_store.close)
+
+        work_queue: Optional[WorkQueue] = None
+        if server_connection is not None:
+            work_queue = WorkQueue(
+                output_dir / WORK_QUEUE_FILE, lease_seconds=settings.lease_seconds
+            )
+            stack.callback(work_queue.close)
+
+        with torch.no_grad():
+            asyncio.run(
+                inner(
+                    event_listener_factory,
+                    expansion_disk_cache,
+                    results_store,
+                    work_queue,
+                )
+            )
+
+
+def _run_workers(
+    settings: DecodingSettings,
+    model_config: CodeT5ModelConfig,
+    encoder_cache: Optional[EncoderCache],
+) -> None:
+    """Runs `main` in `settings.num_workers` processes, which send their model calls
+    to one InferenceServer. Raises if the server or any of the workers fails."""
+    output_dir = Path(settings.output_dir)
+    model_factory = functools.partial(
+        _build_served_lm,
+        model_config,
+        settings.model_thread,
+        encoder_cache=encoder_cache,
+        **settings.model_kwargs(),
+    )
+    # The workers lease data from this queue, so that none of them is left
+    # with a much longer share than the others.
+    output_dir.mkdir(exist_ok=True, parents=True)
+    work_queue = WorkQueue(output_dir / WORK_QUEUE_FILE)
+    finished_store = (
+        ResultsStore(output_dir / RESULTS_DB_FILE)
+        if settings.use_results_store
+        else None
+    )
+    _fill_work_queue(
+        work_queue,
+        settings.eval_data_jsonl,
+        settings.max_num_experiments,
+        settings.grammar_base_dir,
+        output_dir,
+        finished_store,
+    )
+    if finished_store is not None:
+        finished_store.close()
+    work_queue.close()
+    context = torch.multiprocessing.get_context("spawn")
+    with InferenceServer.start(model_factory, settings.num_workers) as server:
+        workers = [
+            context.Process(target=_run_worker, args=(settings, rank, connection))
+            for rank, connection in enumerate(server.connections)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(timeout=10)
+                # The workers wait on the server, so they only stop if they
+                # know that it has exited.
+                server.check()
+    if server.process.exitcode not in (0, None):
+        raise RuntimeError(
+            f"The inference server exited with code {server.process.exitcode}"
         )
-        for datum_id, exp in experiments:
-            await run_experiment(datum_id, exp, Path(output_dir))
+    failed = {
+        rank: worker.exitcode
+        for rank, worker in enumerate(workers)
+        if worker.exitcode != 0
+    }
+    if failed:
+        raise RuntimeError(f"Workers exited with nonzero codes (by rank): {failed}")
+
 
-    with torch.no_grad():
-        asyncio.run(inner())
+def _run_worker(
+    settings: DecodingSettings, rank: int, server_connection: ServerConnection
+) -> None:
+    # The model runs in the server, so the workers don't need more threads.
+    torch.set_num_threads(1)
+    main(settings, worker_rank=rank, server_connection=server_connection)
 
 
 def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
@@ -215,6 +846,188 @@ def add_arguments(argument_parser: argparse.ArgumentParser) -> None:
     argument_parser.add_argument(
         "--output_dir", required=True, help="The output directory."
     )
+    argument_parser.add_argument(
+        "--search_log",
+        choices=["print", "none"] + [fmt.value for fmt in TelemetryFormat],
+        default="print",
+        help="How to log beam search steps: print them to stdout, skip them, "
+        "or record them to output_dir/search_telemetry.{jsonl,npy} "
+        "(see clamp_experiments.print_search_telemetry).",
+    )
+    argument_parser.add_argument(
+        "--search_log_sample_rate",
+        type=float,
+        default=1.0,
+        help="Fraction of beam search steps to record with --search_log=jsonl/npy.",
+    )
+    argument_parser.add_argument(
+        "--beam_size", type=int, default=5, help="The beam size."
+    )
+    argument_parser.add_argument(
+        "--search",
+        choices=["beam", "sampling"],
+        default="beam",
+        help="beam: beam search. sampling: draw --num_samples samples from the model, "
+        "restricted to the grammar, and rank the distinct ones by cost. "
+        "Sampling doesn't use the expansion caches or --search_log.",
+    )
+    argument_parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=5,
+        help="With --search=sampling, the number of samples per datum.",
+    )
+    argument_parser.add_argument(
+        "--temperature",
+        type=float,
+        default=1.0,
+        help="With --search=sampling, divide the log probabilities by this before sampling. "
+        "0 always picks the most likely token.",
+    )
+    argument_parser.add_argument(
+        "--top_p",
+        type=float,
+        default=1.0,
+        help="With --search=sampling, only sample from the most likely tokens "
+        "that cover this much probability.",
+    )
+    argument_parser.add_argument(
+        "--sampling_seed",
+        type=int,
+        default=0,
+        help="With --search=sampling, the seed of the random number generators.",
+    )
+    argument_parser.add_argument(
+        "--length_normalization",
+        type=float,
+        default=0.7,
+        help="The alpha parameter of the GNMT length penalty.",
+    )
+    argument_parser.add_argument(
+        "--expansion_cache_max_entries",
+        type=int,
+        default=0,
+        help="If positive, cache this many search node expansions in memory.",
+    )
+    argument_parser.add_argument(
+        "--expansion_cache_max_bytes",
+        type=int,
+        default=0,
+        help="If positive, limit the in-memory expansion cache to about this many bytes.",
+    )
+    argument_parser.add_argument(
+        "--expansion_cache_db",
+        help="If given, a SQLite file in which to persist expansions across runs, "
+        "so that decoding again with a different beam size or length normalization reuses them.",
+    )
+    argument_parser.add_argument(
+        "--prefix_cache_max_bytes",
+        type=int,
+        default=0,
+        help="If positive, keep up to this many bytes of decoder states for resuming from a "
+        "search node without rerunning its whole prefix.",
+    )
+    argument_parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1,
+        help="Batch up to this many model calls for hypotheses with the same lengths.",
+    )
+    argument_parser.add_argument(
+        "--batch_latency_target",
+        type=float,
+        default=0.0,
+        help="If positive, adapt the batch size and wait window (up to --max_batch_size) "
+        "so that a batched model call takes about this many seconds.",
+    )
+    argument_parser.add_argument(
+        "--length_bucket_size",
+        type=int,
+        default=1,
+        help="With --max_batch_size, also batch model calls whose lengths differ, "
+        "by padding them up to a multiple of this.",
+    )
+    argument_parser.add_argument(
+        "--allowed_token_logprobs",
+        choices=["full", "exact", "renormalized"],
+        default="full",
+        help="full: score the whole vocabulary at each step. "
+        "exact: only project the last position through the LM head, and keep the "
+        "tokens that the grammar allows; the scores are the same as with full. "
+        "renormalized: like exact, but normalize over the allowed tokens only, "
+        "so that only they are projected through the LM head. "
+        "exact and renormalized only save work with T5 and BART.",
+    )
+    argument_parser.add_argument(
+        "--model_thread",
+        action="store_true",
+        help="Run the model on a separate thread, so that parsing can proceed meanwhile.",
+    )
+    argument_parser.add_argument(
+        "--precision",
+        choices=[p.value for p in Precision],
+        default=Precision.FP32.value,
+        help="Precision of the model weights. int8 and bf16 run on the CPU; "
+        "see clamp_experiments.model_parity to compare them with fp32.",
+    )
+    argument_parser.add_argument(
+        "--model_backend",
+        choices=["eager", "traced"],
+        default="eager",
+        help="traced: run the encoder and each decoder step through TorchScript graphs "
+        "traced for fixed shapes (T5 only), which avoids most of the Python overhead of "
+        "small batches on the CPU. Each graph is checked against the eager model when traced.",
+    )
+    argument_parser.add_argument(
+        "--encoder_cache_max_bytes",
+        type=int,
+        default=0,
+        help="If positive, keep up to this many bytes of encoder outputs in memory, "
+        "so that each input is only encoded once.",
+    )
+    argument_parser.add_argument(
+        "--encoder_cache_dir",
+        help="If given, also persist encoder outputs in this directory, "
+        "and memory-map them in later runs with the same model and precision.",
+    )
+    argument_parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="If positive, load the model once in an inference server process, and decode "
+        "in this many worker processes which send it their model calls. Workers take "
+        "the data with the largest grammars first from a queue in output_dir. "
+        "With --max_batch_size, calls from different workers are batched together.",
+    )
+    argument_parser.add_argument(
+        "--grammar_prefetch",
+        type=int,
+        default=2,
+        help="Load the grammars of this many upcoming data on background threads "
+        "while decoding. 0 loads each grammar when its datum is decoded. Compiling "
+        "a grammar holds the GIL, so this mostly hides file reads, not compilation.",
+    )
+    argument_parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=600.0,
+        help="With --num_workers, a worker renews its leases on data every third of "
+        "this while it runs. If it stops renewing, e.g. because it crashed, another "
+        "worker takes over its data after this long.",
+    )
+    argument_parser.add_argument(
+        "--results_store",
+        dest="use_results_store",
+        action="store_true",
+        help=f"Write the results of all data to output_dir/{RESULTS_DB_FILE} instead of "
+        "a directory per datum. gather_decoding_results reads it from there.",
+    )
+    argument_parser.add_argument(
+        "--earley_profile_dir",
+        help="If given, profile the work of the Earley parser for each datum, and write "
+        "a report (<datum_id>.txt) and folded stacks for flamegraph.pl or speedscope "
+        "(<datum_id>.folded) to this directory.",
+    )
 
 
 if __name__ == "__main__":
@@ -222,11 +1035,4 @@ if __name__ == "__main__":
     add_arguments(cmdline_parser)
     args = cmdline_parser.parse_args()
 
-    main(
-        model_loc=args.model_loc,
-        train_data_jsonl=args.train_data_jsonl,
-        eval_data_jsonl=args.eval_data_jsonl,
-        max_num_experiments=args.max_num_experiments,
-        grammar_base_dir=args.grammar_base_dir,
-        output_dir=args.output_dir,
-    )
+    main(DecodingSettings.from_args(args))
@@ -0,0 +1,171 @@
+# Copyright (c) 2023 Microsoft Corporation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A queue of work items which several processes lease from a SQLite file.
+
+Splitting the data evenly between decoding workers makes the slowest share set
+the wall time. With a `WorkQueue`, each worker instead leases the next item
+when it is ready for one, most expensive first, so that the long items start
+early and the short ones fill in the gaps at the end. A worker renews its leases
+while it works. A lease expires if the worker stops renewing it without completing
+the item, e.g. because it crashed, and then another worker leases the item again. A worker which fails an item releases it
+right away. Either way, an item is leased at most `max_attempts` times.
+"""
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+# The name of the queue in an output directory.
+WORK_QUEUE_FILE = "work_queue.sqlite"
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        path: Path,
+        lease_seconds: float = 600.0,
+        poll_seconds: float = 5.0,
+        worker: Optional[str] = None,
+        max_attempts: int = 2,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.worker = (
+            worker if worker is not None else f"{socket.gethostname()}:{os.getpid()}"
+        )
+        # Transactions are managed explicitly, so that leasing is atomic.
+        self._conn = sqlite3.connect(str(path), timeout=600, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create_table()
+
+    def _create_table(self) -> None:
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "item TEXT PRIMARY KEY, priority REAL, worker TEXT, leased_until REAL, "
+            "done INTEGER, attempts INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS items_by_priority ON items (done, priority)"
+        )
+
+    def reset(self, items: Iterable[Tuple[str, float]]) -> None:
+        """Replaces the queue with `items`, which are (item, priority) pairs.
+
+        Items with a higher priority are leased first."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Recreated in case the file was written by an older version.
+            self._conn.execute("DROP TABLE IF EXISTS items")
+            self._create_table()
+            self._conn.executemany(
+                "INSERT INTO items VALUES (?, ?, NULL, NULL, 0, 0)", items
+            )
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def lease(self) -> Optional[str]:
+        """Leases the unfinished item with the highest priority that isn't leased,
+        or returns None if there is none."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT item FROM items WHERE done = 0 AND attempts < ? "
+                "AND (leased_until IS NULL OR leased_until < ?) "
+                "ORDER BY priority DESC LIMIT 1",
+                (self.max_attempts, now),
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE items SET worker = ?, leased_until = ?, "
+                    "attempts = attempts + 1 WHERE item = ?",
+                    (self.worker, now + self.lease_seconds, row[0]),
+                )
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return None if row is None else row[0]
+
+    def wait(self) -> bool:
+        """Waits until an item can be leased, because another worker's lease
+        expired, and returns True, or returns False once no item can be leased again.
+
+        Call this only after completing or releasing the items leased by this worker."""
+        while True:
+            (num_leasable,) = self._conn.execute(
+                "SELECT COUNT(*) FROM items WHERE done = 0 AND attempts < ? "
+                "AND (leased_until IS NULL OR leased_until < ?)",
+                (self.max_attempts, time.time()),
+            ).fetchone()
+            if num_leasable > 0:
+                return True
+            (num_unfinished,) = self._conn.execute(
+                "SELECT COUNT(*) FROM items WHERE done = 0 AND attempts < ?",
+                (self.max_attempts,),
+            ).fetchone()
+            if num_unfinished == 0:
+                return False
+            time.sleep(self.poll_seconds)
+
+    def renew(self, item: str) -> None:
+        """Extends the lease on `item`, e.g. when starting to work on it."""
+        self._conn.execute(
+            "UPDATE items SET worker = ?, leased_until = ? WHERE item = ?",
+            (self.worker, time.time() + self.lease_seconds, item),
+        )
+
+    def renew_leases(self) -> None:
+        """Extends the leases on all the unfinished items held by this worker,
+        including the ones it hasn't started on yet. Call this more often than every
+        `lease_seconds` while working, so that the leases don't expire."""
+        self._conn.execute(
+            "UPDATE items SET leased_until = ? "
+            "WHERE worker = ? AND done = 0 AND leased_until IS NOT NULL",
+            (time.time() + self.lease_seconds, self.worker),
+        )
+
+    def complete(self, item: str) -> None:
+        self._conn.execute("UPDATE items SET done = 1 WHERE item = ?", (item,))
+
+    def release(self, item: str) -> None:
+        """Gives up the lease on `item` without completing it, e.g. because it failed,
+        so that it can be leased again if it has attempts left."""
+        self._conn.execute(
+            "UPDATE items SET worker = NULL, leased_until = NULL WHERE item = ?",
+            (item,),
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        """Leases items until none are left to lease right now."""
+        while True:
+            item = self.lease()
+            if item is None:
+                return
+            yield item
+
+    def close(self) -> None:
+        self._conn.close()
@@ -14,5 +14,6 @@ python -m clamp_experiments.compute_evaluation_results \
   --data_tsv ${data_dir}/valid.tsv \
   --predictions_json ${predictions_json} \
   --output_dir ${output_dir} \
+  --metrics_cache output/metrics_cache.sqlite \
   1> ${output_dir}/stdout \
   2> ${output_dir}/stderr